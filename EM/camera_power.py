@@ -0,0 +1,193 @@
+# 誰も画像を見ていないときに，カメラを休ませるためのモジュールです
+# これまでの start_camera() は，ブラウザがつながっていなくても 100 ms ごとに撮影して JPEG にしていたので，
+# ラズパイの CPU を一番使い，熱くなる原因になっていました
+#
+# ・視聴者は FrameBuffer (frame_buffer.py) が数える．ストリームを送っている間と，写真を読まれてからしばらくの間
+# ・IDLE_AFTER 秒だれも見ていなければ休む．休み方は2通り
+#     'keepalive': エンコーダーだけ止め，KEEPALIVE_INTERVAL 秒ごとに1枚だけ撮る (/camera.jpg が古くなりすぎない)
+#     'stop':      カメラごと止める (一番省電力．見始めたときに少し時間がかかる)
+# ・見始められたら(FrameBuffer の add_viewer_listener)すぐに全速の撮影に戻す
+# ・撮影中に stall_timeout 秒画像が届かなければ，エンコーダーを再起動する (これまでの start_camera() と同じ)
+#
+# 例：camera = ViewerAwareCamera(picam2, start_gui.camera_output, logger=logger)
+#     camera.run()  # 戻らない
+
+import asyncio
+import io
+import threading
+import time
+
+from picamera2.encoders import JpegEncoder
+from picamera2.outputs import FileOutput
+
+IDLE_AFTER = 10.0  # [s] だれも見なくなってから，この間たったら休む
+KEEPALIVE_INTERVAL = 2.0  # [s] 'keepalive' で休んでいるときに1枚撮る間隔
+STALL_TIMEOUT = 5.0  # [s] 撮影中にこの間画像が届かなければエンコーダーを再起動する
+
+# 状態
+STREAMING = 'streaming'
+KEEPALIVE = 'keepalive'
+STOPPED = 'stopped'
+# 休み方 (idle_mode)
+IDLE_KEEPALIVE = 'keepalive'
+IDLE_STOP = 'stop'
+
+
+class ViewerAwareCamera:
+    """
+    camera: 設定済みの Picamera2
+    output: 画像の書き込み先 (FrameBuffer)．視聴者の数もここから読む
+    idle_mode: 'keepalive' か 'stop' (休み方)
+    run() / run_async() のどちらか一方だけを呼ぶ
+    """
+
+    def __init__(self, camera, output, *, idle_mode: str = IDLE_KEEPALIVE, idle_after: float = IDLE_AFTER,
+                 keepalive_interval: float = KEEPALIVE_INTERVAL, stall_timeout: float = STALL_TIMEOUT, logger=None):
+        if idle_mode not in (IDLE_KEEPALIVE, IDLE_STOP):
+            raise ValueError(f'idle_mode は {IDLE_KEEPALIVE!r} か {IDLE_STOP!r} です: {idle_mode!r}')
+        self.camera = camera
+        self.output = output
+        self.idle_mode = idle_mode
+        self.idle_after = idle_after
+        self.keepalive_interval = keepalive_interval
+        self.stall_timeout = stall_timeout
+        self.logger = logger
+        self.state = None  # まだ撮影を始めていない
+        self._count = 0  # 前に調べたときのフレーム番号
+        self._checked_at = 0.0
+        self._next_keepalive = 0.0
+        self.resumes = 0
+        self.idles = 0
+        self.keepalive_frames = 0
+        self.restarts = 0
+        self.last_resume = None  # [s] 撮影を再開するのにかかった時間
+        self._state_since = time.monotonic()
+        self._state_time = {STREAMING: 0.0, KEEPALIVE: 0.0, STOPPED: 0.0}
+
+    # ----- 状態の切り替え -----
+    def _set_state(self, state: str):
+        now = time.monotonic()
+        if self.state is not None:
+            self._state_time[self.state] += now - self._state_since
+        self.state = state
+        self._state_since = now
+
+    def _stream(self):
+        """全速の撮影を始める (起動時と，見始められたとき)"""
+        start = time.monotonic()
+        if self.state == KEEPALIVE:
+            self.camera.start_encoder(JpegEncoder(), FileOutput(self.output))  # カメラは動いたまま
+        else:
+            self.camera.start_recording(JpegEncoder(), FileOutput(self.output))
+        if self.state is not None:
+            self.resumes += 1
+            self.last_resume = time.monotonic() - start
+            if self.logger is not None:
+                self.logger.info('カメラ: 視聴者がいるので撮影を再開しました (%.3f s)', self.last_resume)
+        self._set_state(STREAMING)
+        self._count = self.output.count
+        self._checked_at = time.monotonic()
+
+    def _idle(self):
+        """だれも見ていないので休む"""
+        if self.idle_mode == IDLE_KEEPALIVE:
+            self.camera.stop_encoder()
+            self._set_state(KEEPALIVE)
+            self._next_keepalive = time.monotonic()
+        else:
+            self.camera.stop_recording()
+            self._set_state(STOPPED)
+        self.idles += 1
+        if self.logger is not None:
+            self.logger.info('カメラ: %.0f 秒だれも見ていないので休みます (%s)', self.idle_after, self.idle_mode)
+
+    def _capture_keepalive(self):
+        """1枚だけ撮って output に書く (エンコーダーと同じく，1回の write で JPEG を丸ごと渡す)"""
+        buf = io.BytesIO()
+        self.camera.capture_file(buf, format='jpeg')
+        self.output.write(buf.getvalue())
+        self.keepalive_frames += 1
+
+    def _restart_if_stalled(self):
+        if self.output.count == self._count:
+            if self.logger is not None:
+                self.logger.error('Camera error: no frame for %.1f s, restarting encoder', self.stall_timeout)
+            self.camera.stop_recording()
+            self.camera.start_recording(JpegEncoder(), FileOutput(self.output))
+            self.restarts += 1
+        self._count = self.output.count
+        self._checked_at = time.monotonic()
+
+    def step(self) -> float:
+        """状態を1回更新し，次に呼ぶまでの秒数を返す (None: 見始められるまで呼ばなくてよい)"""
+        if self.state is None:
+            self._stream()
+        idle = self.output.idle_for()
+        if self.state != STREAMING:
+            if idle == 0.0:
+                self._stream()
+            elif self.state == KEEPALIVE:
+                now = time.monotonic()
+                if now >= self._next_keepalive:
+                    self._capture_keepalive()
+                    self._next_keepalive = now + self.keepalive_interval
+                return self._next_keepalive - now
+            else:
+                return None
+        if idle >= self.idle_after:
+            self._idle()
+            return 0.0 if self.state == KEEPALIVE else None
+        if time.monotonic() - self._checked_at >= self.stall_timeout:
+            self._restart_if_stalled()
+        return min(self._checked_at + self.stall_timeout - time.monotonic(), self.idle_after - idle)
+
+    # ----- 動かす -----
+    def run(self):
+        """撮影を始め，視聴者に合わせて休む・再開するのを繰り返す (戻らない)"""
+        wake = threading.Event()
+        self.output.add_viewer_listener(wake.set)
+        while True:
+            wake.clear()
+            try:
+                delay = self.step()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error('Camera error: %s', e)
+                delay = self.stall_timeout
+            wake.wait(delay)
+
+    async def run_async(self):
+        """run() の asyncio 版．カメラの操作は待ち時間があるので，別のスレッドで行う"""
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        self.output.add_viewer_listener(lambda: loop.call_soon_threadsafe(wake.set))
+        while True:
+            wake.clear()
+            try:
+                delay = await asyncio.to_thread(self.step)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error('Camera error: %s', e)
+                delay = self.stall_timeout
+            try:
+                await asyncio.wait_for(wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計 (state_s は起動からそれぞれの状態でいた秒数)"""
+        state_time = dict(self._state_time)
+        if self.state is not None:
+            state_time[self.state] += time.monotonic() - self._state_since
+        return {
+            'state': self.state,
+            'idle_mode': self.idle_mode,
+            'viewers': self.output.viewers(),
+            'idle_s': self.output.idle_for(),
+            'resumes': self.resumes,
+            'idles': self.idles,
+            'keepalive_frames': self.keepalive_frames,
+            'restarts': self.restarts,
+            'last_resume_s': self.last_resume,
+            'state_s': state_time,
+        }
@@ -0,0 +1,189 @@
+# コントローラーやブラウザなど，複数の入力元から届くモーターへの指令を1か所で調停するためのモジュールです
+# 以前は「コントローラーを最後に操作してから1秒間はGUIを無視する」という判定を
+# 0.5〜0.8秒ごとに動くGUIのループの中で行っていたため，GUIの指令が遅れてまとめて反映されていました
+#
+# ・入力元はそれぞれ push() で時刻付きの指令(目標値)を送る
+# ・優先度の高い入力元が hold_off 秒以内に指令を出していれば，それより低い入力元の指令は保留する
+# ・採用された指令は，push() を呼んだスレッドでその場で apply() に渡す (ループの周期を待たない)
+# ・優先度の高い入力元が黙っても，保留していた指令を勝手に反映することはしない
+#   (低い入力元が次に指令を出したときに切り替わる)
+#
+# tick_rate [Hz] を指定すると周期実行のモードになる
+# スティックは1秒に数百回もイベントを出すので，そのたびにモーター(GPIO)へ書き込んでログを出すと，
+# カメラなどに使いたいCPUが取られてしまう．このモードでは push() は最新の目標値を覚えるだけで，
+# 専用のスレッドが1周期に1回だけ，前回と変わっていれば apply() に渡す
+# asyncio のループで全体を動かすとき(aio_runtime.py)は，run_ticks_async() をタスクにすると
+# 周期実行がループに移り，専用のスレッドは止まる
+#
+# 入力元ごとに，指令の時刻から apply() の中で mark_output() が呼ばれるまで(モーターに書き込んだ瞬間)の
+# 遅れを LatencyHistogram に記録する
+
+import asyncio
+import threading
+import time
+
+from latency_hist import LatencyHistogram
+
+HOLD_OFF = 1.0  # [s] 優先度の高い入力元の指令から，この時間は低い入力元の指令を保留する
+TICK_RATE = 100  # [Hz] 周期実行のモードで，モーターへ反映する頻度の例
+
+
+class CommandArbiter:
+    """
+    入力元ごとの最新の指令を持ち，勝った入力元の指令を apply(command, source) でモーターに反映する
+    priorities: {入力元の名前: 優先度}  数字が大きいほど優先．同じ優先度なら新しい指令が勝つ
+    initial:    各入力元の指令の初期値 (push() で一部の値だけ送ったとき，残りはこの値になる)
+    tick_rate:  0 ならすぐに反映する．正の値なら，その周波数[Hz]でまとめて反映する
+    """
+
+    def __init__(self, apply, priorities: dict, *, hold_off: float = HOLD_OFF, initial: dict = None, tick_rate: float = 0):
+        self._apply = apply
+        self.priorities = dict(priorities)
+        self.hold_off = hold_off
+        self._initial = dict(initial or {})
+        self._lock = threading.Lock()
+        self._commands = {}  # 入力元 → 最新の指令
+        self._stamps = {}  # 入力元 → 最新の指令の時刻 (time.monotonic())
+        self.active = None  # 最後に反映した入力元
+        self._applied = {source: 0 for source in self.priorities}
+        self._held = {source: 0 for source in self.priorities}
+        self._switches = 0
+        self._last_delay = 0.0
+        self.latency = {source: LatencyHistogram() for source in self.priorities}
+        self._output_timestamp = None  # apply() 中の指令の時刻
+
+        self.tick_rate = tick_rate
+        self._pending = None  # 次の周期で反映する (指令, 入力元, 時刻)
+        self._last_applied = None
+        self._ticks = 0
+        self._coalesced = 0  # 反映される前に新しい指令で上書きされた数
+        self._overruns = 0  # 周期に間に合わなかった数
+        self._loop_driven = False  # True: run_ticks_async() が周期実行している
+        if tick_rate > 0:
+            threading.Thread(target=self._run_ticks, daemon=True).start()
+
+    def push(self, source: str, *, timestamp: float = None, **values) -> bool:
+        """
+        source からの指令を受け取る．timestamp は指令が発生した time.monotonic() の時刻 (省略すると今)
+        指令が採用されたら True (周期実行のモードでは次の周期で反映される)，保留されたら False
+        """
+        now = time.monotonic()
+        if timestamp is None:
+            timestamp = now
+        with self._lock:
+            if timestamp < self._stamps.get(source, float('-inf')):
+                return False  # 後から届いた古い指令は捨てる
+            command = self._commands.setdefault(source, dict(self._initial))
+            command.update(values)
+            self._stamps[source] = timestamp
+            if not self._wins(source, now):
+                self._held[source] = self._held.get(source, 0) + 1
+                return False
+            if self.active != source:
+                self._switches += 1
+                self.active = source
+            if self.tick_rate > 0:
+                if self._pending is not None:
+                    self._coalesced += 1
+                self._pending = (dict(command), source, timestamp)
+                return True
+            self._apply_locked(dict(command), source, timestamp, now)
+            return True
+
+    def _apply_locked(self, command: dict, source: str, timestamp: float, now: float):
+        self._applied[source] = self._applied.get(source, 0) + 1
+        self._last_delay = now - timestamp
+        self._last_applied = command
+        self._output_timestamp = timestamp
+        # 入力元どうしで反映の順番が入れ替わらないように，ロックを持ったまま反映する
+        try:
+            self._apply(command, source)
+        finally:
+            self._output_timestamp = None
+
+    def mark_output(self, source: str):
+        """apply() の中で，モーターに書き込んだ直後に呼ぶ．指令の時刻からの遅れを記録する"""
+        timestamp = self._output_timestamp
+        if timestamp is None:
+            return
+        histogram = self.latency.get(source)
+        if histogram is None:
+            histogram = self.latency.setdefault(source, LatencyHistogram())
+        histogram.record(time.monotonic() - timestamp)
+
+    def _next_delay(self, next_tick: float) -> tuple:
+        """次の周期の時刻と，それまでの秒数．遅れた分の周期は飛ばす (まとめて何回も反映しない)"""
+        next_tick += 1 / self.tick_rate
+        delay = next_tick - time.monotonic()
+        if delay <= 0:
+            self._overruns += 1
+            return time.monotonic(), 0.0
+        return next_tick, delay
+
+    def _tick(self):
+        with self._lock:
+            self._ticks += 1
+            pending, self._pending = self._pending, None
+            if pending is None:
+                return
+            command, source, timestamp = pending
+            if command == self._last_applied:
+                return  # 変わっていなければGPIOに書き込まない
+            self._apply_locked(command, source, timestamp, time.monotonic())
+
+    def _run_ticks(self):
+        next_tick = time.monotonic()
+        while not self._loop_driven:
+            next_tick, delay = self._next_delay(next_tick)
+            if delay > 0:
+                time.sleep(delay)
+            if not self._loop_driven:
+                self._tick()
+
+    async def run_ticks_async(self):
+        """周期実行をイベントループのタスクで行う (専用のスレッドはここで止まる)"""
+        if self.tick_rate <= 0:
+            return
+        self._loop_driven = True
+        next_tick = time.monotonic()
+        while True:
+            next_tick, delay = self._next_delay(next_tick)
+            await asyncio.sleep(delay)
+            self._tick()
+
+    def _wins(self, source: str, now: float) -> bool:
+        priority = self.priorities.get(source, 0)
+        for other, other_priority in self.priorities.items():
+            if other != source and other_priority > priority and now - self._stamps.get(other, float('-inf')) < self.hold_off:
+                return False
+        return True
+
+    def release(self, source: str):
+        """
+        source が指令を出し終えたときに呼ぶ．hold_off を待たずに，優先度の低い入力元の次の指令が勝つようになる
+        (保留していた指令を反映することはしない)
+        """
+        with self._lock:
+            self._stamps.pop(source, None)
+
+    def command(self, source: str) -> dict:
+        """source の最新の指令 (保留中のものも含む)"""
+        with self._lock:
+            return dict(self._commands.get(source, self._initial))
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計"""
+        with self._lock:
+            return {
+                'active': self.active,
+                'hold_off_s': self.hold_off,
+                'applied': dict(self._applied),
+                'held': dict(self._held),
+                'switches': self._switches,
+                'last_delay_ms': self._last_delay * 1000,
+                'tick_rate_hz': self.tick_rate,
+                'ticks': self._ticks,
+                'coalesced': self._coalesced,
+                'overruns': self._overruns,
+                'latency': {source: histogram.stats() for source, histogram in self.latency.items()},
+            }
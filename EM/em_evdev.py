@@ -6,15 +6,21 @@
 
 # スピーカー設定をPWM出力可能にしておく(/boot/firmware/config.txtの末尾に"dtoverlay=audremap,pins_12_13"を追加)
 
-import json
+import asyncio
+import fcntl
+import functools
 from logging import getLogger, StreamHandler, Formatter, Logger, DEBUG, INFO, WARNING, ERROR, CRITICAL
 from logging.handlers import RotatingFileHandler
 import os
+import struct
 import subprocess
 import sys
 import threading
 import time
 
+import log_setup
+import startup
+
 # 本プログラムではむつめ祭来場者にログを見せる可能性や
 # プログラムに慣れない人がプログラムを実行する可能性を考慮し
 # ログの一部を日本語で出力しています．良い子はマネしないでね
@@ -35,22 +41,26 @@ logger.propagate = False
 
 s_handler = StreamHandler()
 s_handler.setLevel(INFO)
-logger.addHandler(s_handler)
 
 tsv_format = Formatter('%(asctime)s.%(msecs)d+09:00\t%(name)s\t%(filename)s\t%(lineno)d\t%(funcName)s\t%(levelname)s\t%(message)s', '%Y-%m-%dT%H:%M:%S')
 f_handler = RotatingFileHandler('fm.log', maxBytes=100*1000)
 f_handler.setLevel(DEBUG)
 f_handler.setFormatter(tsv_format)
-logger.addHandler(f_handler)
+
+# ログの書き込みはバックグラウンドのスレッドで行い，SDカードが遅くても制御のスレッドを止めない
+# DEBUG のログは呼び出し場所ごとに間引く．捨てた数・間引いた数は /stats.json で見られる
+queued_logging = log_setup.QueuedLogging(logger, s_handler, f_handler)
 #######################
 
 
+# 起動の段階ごとの時間を記録する (ログと /stats.json に出す)．時間はプロセスが起動したときから数える
+startup_timer = startup.StartupTimer(logger)
+
 logger.info('セットアップを開始します')
 
 logger.info('実行環境を確認しています')
 if sys.prefix == sys.base_prefix:
     logger.warning('<<警告>>\n仮想環境で実行していない可能性があります．仮想環境でない場合は次のコマンドを実行し再度このプログラムを起動してください．source fm_env/bin/activate')
-    time.sleep(10)
 logger.info('実行環境の確認が完了しました')
 
 logger.info('コントローラと無線接続を行います')
@@ -60,6 +70,9 @@ logger.info('PS4コントローラーのPSボタンとSHAREボタンを同時に
 
 
 logger.info('ライブラリをインポートしています')
+# 重いライブラリを並行してインポートしておく (下の from ... import はすぐに終わる)
+with startup_timer.phase('imports'):
+    startup_timer.import_modules('gpiozero', 'picamera2', 'evdev', 'start_gui')
 # from gpiozero import LED
 from gpiozero import Motor
 from gpiozero.pins.pigpio import PiGPIOFactory
@@ -71,7 +84,17 @@ from evdev import InputDevice, categorize, ecodes
 logger.info('ライブラリのインポートが完了しました')
 
 logger.info('別のPythonファイルを読み込んでいます')
+import aio_runtime
+import audio_engine
+import axis_map
+from camera_power import ViewerAwareCamera
+from command_arbiter import CommandArbiter
+import input_backend
+import input_hotplug
+import motor_selftest
+from shm_frames import CameraProcess
 import start_gui
+from telemetry_ring import TelemetryRecorder
 logger.info('別のPythonファイルの読み込みが完了しました')
 
 
@@ -86,71 +109,32 @@ PIN_L2 = 27
 motor_right = Motor(forward = PIN_R1, backward = PIN_R2, pin_factory = PiGPIOFactory())
 motor_left  = Motor(forward = PIN_L1, backward = PIN_L2, pin_factory = PiGPIOFactory())
 
-def motor_calib():
-    power = 0
-    delta_power = 0.2
-
-    logger.info("右モーターのテストを行います")
-    for i in range(int(1 / delta_power)):
-        if 0<=power<=1:
-            motor_right.value = power
-            power += delta_power
-    motor_right.value = 1
-    time.sleep(0.5)
-
-    for i in range((int(1 / delta_power))*2):
-        if -1<=power<=1:
-            motor_right.value = power
-            power -= delta_power
-    motor_right.value = -1
-    time.sleep(0.5)
-
-    for i in range(int(1 / delta_power)):
-        if -1<=power<=0:
-            motor_right.value = power
-            power += delta_power
-    motor_right.value = 0
-    time.sleep(0.5)
-
-    logger.info("左モーターのテストを行います")
-    for i in range(int(1 / delta_power)):
-        if 0<=power<=1:
-            motor_left.value = power
-            power += delta_power
-    motor_left.value = 1
-    time.sleep(0.5)
-
-    for i in range((int(1 / delta_power))*2):
-        if -1<=power<=1:
-            motor_left.value = power
-            power -= delta_power
-    motor_left.value = -1
-    time.sleep(0.5)
-
-    for i in range(int(1 / delta_power)):
-        if -1<=power<=0:
-            motor_left.value = power
-            power += delta_power
-    motor_left.value = 0
-    time.sleep(0.5)
-
 logger.info('モーターのセットアップが完了しました')
 
 ##### スピーカー #####
 
 logger.info('スピーカーのセットアップを開始しました')
 
-proces_aplay = None
-# .poll()は終了していなかったらNone，終了していたらそのステータスを返す．
-def audio_play(audio_path):
-    global proces_aplay
+SOUND_FILES = [
+    '/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav',
+    '/home/jaxai/Desktop/kane_tarinai.wav',
+    '/home/jaxai/Desktop/hatodokei.wav',
+    '/home/jaxai/Desktop/otoko_ou!.wav',
+]
+
+# 再生するたびに aplay を起動するのではなく，1つのプレーヤーを使い続ける (デバイスは開いたまま)
+# 効果音は起動時にバックグラウンドで読み込んでおく
+audio = audio_engine.AudioEngine(audio_engine.open_sink(), logger=logger)
+startup_timer.background('audio init', lambda: [audio.load(path) for path in SOUND_FILES])
+
+# priority: 鳴らせる数を超えたときは優先度の低い音から止める
+# overlap=False: 同じ音が鳴っている間は重ねない
+def audio_play(audio_path, priority=0, overlap=True):
     logger.debug('audio_path: %s', audio_path)
-    if (proces_aplay is None or proces_aplay.poll() != None):
-        proces_aplay = subprocess.Popen(f"aplay --device=hw:1,0 {audio_path}", shell=True)
-        # proces_aplay.returncode
+    if audio.play(audio_path, priority, overlap=overlap):
         logger.info("音楽の再生中です")
     else:
-        logger.info("音楽がすでに再生中のためキャンセルします")
+        logger.info("音楽を再生できなかったためキャンセルします")
 
 logger.info('スピーカーのセットアップが完了しました')
 
@@ -158,17 +142,55 @@ logger.info('スピーカーのセットアップが完了しました')
 ###### コントローラ #####
 logger.info('コントローラーによる制御システムのセットアップを開始しました')
 
-last_controll_time = time.time()
-
-# コントローラーの入力をモーターの-1~1の範囲の入力に修正する
-def transf(raw):
-    temp = (raw - 127.5) / 127.5
-    
-    # デッドゾーン
-    if abs(temp) < 0.05:
-        return 0
-    else:
-        return round(temp, 2)
+# コントローラーとGUIの指令の調停
+# コントローラーを操作してから CONTROLLER_HOLD_OFF 秒間は，GUIからの指令を保留する
+# 起動時のモーターの動作確認('selftest')はいちばん優先するが，コントローラーやGUIが操作を始めたら中止して譲る
+INPUT_PRIORITIES = {'selftest': 3, 'controller': 2, 'gui': 1}
+CONTROLLER_HOLD_OFF = 1.0  # [s]
+# スティックの操作では目標値を更新するだけで，モーターへの書き込みは1秒に CONTROL_TICK_HZ 回までにまとめる
+# (0 にするとイベントのたびに書き込む)
+CONTROL_TICK_HZ = 100
+
+# 調停で勝った指令をモーターに反映する (モーターに書き込むのはここだけ)
+def apply_motors(command, source):
+    motor_right.value = command['motor_r']
+    motor_left.value = command['motor_l']
+    arbiter.mark_output(source)  # 入力からモーター出力までの遅れを記録する
+    # 左右の出力と，そこから求めた前後(throttle)・旋回(steer)の成分を記録する
+    telemetry.record(motor_left.value, motor_right.value, (motor_left.value + motor_right.value) / 2, (motor_left.value - motor_right.value) / 2, source)
+    write_to_gui()  # ブラウザにもすぐ送る
+
+# モーターに反映した指令をバイナリで記録する (読むとき：python telemetry_ring.py telemetry.bin)
+telemetry = TelemetryRecorder('telemetry.bin')
+
+arbiter = CommandArbiter(apply_motors, INPUT_PRIORITIES, hold_off=CONTROLLER_HOLD_OFF, initial={'motor_l': 0.0, 'motor_r': 0.0}, tick_rate=CONTROL_TICK_HZ)
+
+# 起動時のモーターの動作確認．ほかの処理と並行してバックグラウンドで行い，結果はブラウザと /stats.json に出す
+# 環境変数 FAST_START=1 で起動すると動作確認を飛ばして，すぐに操作できるようにする (本番中に電圧が下がって再起動したときなど)
+FAST_START = os.environ.get('FAST_START') == '1'
+selftest = motor_selftest.MotorSelfTest(
+    arbiter,
+    # pigpio デーモンから GPIO ピンの実際の PWM を読み返す (Motor.value は書いた値を覚えているだけ)
+    motor_selftest.pigpio_readback({'motor_l': motor_left, 'motor_r': motor_right}),
+    on_change=lambda state: start_gui.gui_state.update_to_browser(selftest=state),
+    logger=logger,
+)
+
+# スティックの値(0~255，中心値 127.5)からモーターの出力(-1~1)への変換表．table[event.value] で引く
+# デッドゾーンや反応の曲線も表に入っている．コントローラーがつながるたびに，その軸の中心に合わせて作り直す
+STICK_DEADZONE = 0.05
+STICK_CURVE = 'linear'
+left_stick_table = axis_map.evdev_table(deadzone=STICK_DEADZONE, curve=STICK_CURVE)
+right_stick_table = axis_map.evdev_table(deadzone=STICK_DEADZONE, curve=STICK_CURVE)
+
+# つながったコントローラーの軸の範囲と，今の値(スティックを離しているはず)を中心にして表を作り直す
+def calibrate_sticks(device):
+    try:
+        controller_input.tables['left_y'] = axis_map.evdev_table(device.absinfo(ecodes.ABS_Y), deadzone=STICK_DEADZONE, curve=STICK_CURVE)
+        controller_input.tables['right_y'] = axis_map.evdev_table(device.absinfo(ecodes.ABS_RY), deadzone=STICK_DEADZONE, curve=STICK_CURVE)
+    except OSError:
+        # 読めなければ，0~255 の表のまま使う
+        logger.warning('スティックの中心を読み取れませんでした')
 
 # pyPS4Controller: -32768(上) ~ 32767(下)
 # evdev: 0(上) ~ 255(下) 中心値: 127.5
@@ -180,72 +202,112 @@ def connect():
 def disconnect():
     logger.warning('<<警告>>\nコントローラーとの接続が切れました')
 
+# イベントの時刻(event.timestamp())を time.monotonic() と同じ時計にする
+# 入力からモーター出力までの遅れを，イベントが発生した時刻から測るため
+EVIOCSCLOCKID = 0x400445a0  # _IOW('E', 0xa0, int)
+event_clock_monotonic = False
+
+def use_monotonic_clock(device):
+    global event_clock_monotonic
+    try:
+        fcntl.ioctl(device.fd, EVIOCSCLOCKID, struct.pack('i', time.CLOCK_MONOTONIC))
+        event_clock_monotonic = True
+    except OSError:
+        # 使えなければ，ハンドラーが呼ばれた時刻から測る
+        event_clock_monotonic = False
+
+# 'Wireless Controller' のデバイスを探す．/dev/input にデバイスが作られたらすぐに調べる
+# 一度調べたデバイスは開き直さない．切断からつながるまでの時間は /stats.json の controller に出る
+controller_watcher = input_hotplug.ControllerWatcher('Wireless Controller', logger=logger)
+
+# コントローラーのイベントは SYN_REPORT で区切られたフレームで届く (左右のスティックを同時に動かすと，1フレームに2つの軸)
+# フレームの中の変化は input_backend がためておき，SYN_REPORT で左右のモーターへの指令を1回の push() にまとめる
+# (左右が同時に変わり，GPIOへの書き込みも1回で済む)．(type, code) → 処理 の表は起動時に1回だけ作る
+def button_sound(label, audio_path):
+    def action():
+        logger.info('%sボタンが押されました', label)
+        audio_play(audio_path, priority=1)
+    return action
+
+controller_input = input_backend.DriveInput(
+    functools.partial(arbiter.push, 'controller'),
+    input_backend.tank_drive,
+    tables={'left_y': left_stick_table, 'right_y': right_stick_table},
+    actions={
+        'cross': button_sound('×', "/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav"),
+        'square': button_sound('□', "/home/jaxai/Desktop/kane_tarinai.wav"),
+        'circle': button_sound('○', "/home/jaxai/Desktop/hatodokei.wav"),
+        'triangle': button_sound('△', "/home/jaxai/Desktop/otoko_ou!.wav"),
+    },
+)
+evdev_input = input_backend.EvdevBackend(controller_input)
+
 def start_controller():
-    global last_controll_time
-    
     while True:
-        device = None
         logger.info("コントローラーデバイスを探しています... (PSボタンを押して接続してください)")
-        
-        while device is None:
-            try:
-                devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
-                for dev in devices:
-                    if 'Wireless Controller' in dev.name:
-                        device = dev
-                        break
-            except Exception:
-                pass
-            
-            if device is None:
-                time.sleep(2)
-        
+        device = controller_watcher.wait()
+
         connect()
         logger.info(f"Connected to {device.name} at {device.path}")
 
         try:
             # デバイスを占有
             device.grab()
+            use_monotonic_clock(device)
+            calibrate_sticks(device)
+            evdev_input.attach(device, monotonic=event_clock_monotonic)
             
+            # read_loop() は1回の read で届いているイベントをまとめて読む
             for event in device.read_loop():
-                if event.type == ecodes.EV_ABS:
-                    if event.code == ecodes.ABS_RY: # Right Stick Y
-                        last_controll_time = time.time()
-                        motor_right.value = -transf(event.value)
-
-                    elif event.code == ecodes.ABS_Y: # Left Stick Y
-                        last_controll_time = time.time()
-                        motor_left.value = -transf(event.value)
-                
-                elif event.type == ecodes.EV_KEY:
-                    if event.value == 1:
-                        last_controll_time = time.time()
-                        # ボタンマッピング (標準ドライバの場合)
-                        if event.code == ecodes.BTN_SOUTH or event.code == 304: # X
-                            logger.info('×ボタンが押されました')
-                            audio_play("/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav")
-                        elif event.code == ecodes.BTN_WEST or event.code == 308: # Square
-                            logger.info('□ボタンが押されました')
-                            audio_play("/home/jaxai/Desktop/kane_tarinai.wav")
-                        elif event.code == ecodes.BTN_EAST or event.code == 305: # Circle
-                            logger.info('○ボタンが押されました')
-                            audio_play("/home/jaxai/Desktop/hatodokei.wav")
-                        elif event.code == ecodes.BTN_NORTH or event.code == 307: # Triangle
-                            logger.info('△ボタンが押されました')
-                            audio_play("/home/jaxai/Desktop/otoko_ou!.wav")
+                evdev_input.handle(event)
         
         except OSError:
             disconnect()
-            time.sleep(1)
+            controller_watcher.lost(device)
         except Exception as e:
             logger.error(f'<<エラー>>\nコントローラー制御エラー: {e}')
             disconnect()
+            controller_watcher.lost()
             time.sleep(1)
         finally:
             try:
                 device.ungrab()
             except Exception:
                 pass
+            device.close()
+
+# start_controller() の asyncio 版 (USE_ASYNCIO = True のとき使う)
+async def start_controller_async():
+    while True:
+        logger.info("コントローラーデバイスを探しています... (PSボタンを押して接続してください)")
+        device = await controller_watcher.wait_async()
+
+        connect()
+        logger.info(f"Connected to {device.name} at {device.path}")
+
+        try:
+            device.grab()
+            use_monotonic_clock(device)
+            calibrate_sticks(device)
+            evdev_input.attach(device, monotonic=event_clock_monotonic)
+
+            async for event in device.async_read_loop():
+                evdev_input.handle(event)
+
+        except OSError:
+            disconnect()
+            controller_watcher.lost(device)
+        except Exception as e:
+            logger.error(f'<<エラー>>\nコントローラー制御エラー: {e}')
+            disconnect()
+            controller_watcher.lost()
+            await asyncio.sleep(1)
+        finally:
+            try:
+                device.ungrab()
+            except Exception:
+                pass
+            device.close()
 
 logger.info('コントローラーによる制御システムのセットアップが完了しました')
 
@@ -253,18 +315,12 @@ logger.info('コントローラーによる制御システムのセットアッ
 ##### GUI #####
 logger.info('GUIによる制御システムのセットアップを開始しました')
 
+# ブラウザから操作が届いたときに呼ぶ．モーターへの指令はコントローラーの操作中なら調停で保留される
 def read_from_gui():
-    global last_controll_time
-    if time.time() - last_controll_time < 1:
-        return
-    
-    data_from_browser = {}
-    with open('data_from_browser.json', 'r') as f:
-        data_from_browser = json.load(f)
+    _, received, data_from_browser = start_gui.gui_state.get_from_browser_timed()
     logger.debug('data_from_browser: %s', data_from_browser)
     
-    motor_right.value = float(data_from_browser['motor_r'])
-    motor_left.value = float(data_from_browser['motor_l'])
+    arbiter.push('gui', timestamp=received, motor_r=float(data_from_browser['motor_r']), motor_l=float(data_from_browser['motor_l']))
     if bool(data_from_browser['light']):
         # high_power_led.on()
         pass
@@ -272,27 +328,42 @@ def read_from_gui():
         # high_power_led.off()
         pass
     if bool(data_from_browser['buzzer']):
-        audio_play('/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav')
+        audio_play('/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav', overlap=False)
 
 def write_to_gui():
-    data_to_browser = {}
-    with open('data_to_browser.json', 'r') as f:
-        data_to_browser = json.load(f)
-
-    with open('data_to_browser.json', 'w') as f:
-        data_to_browser['motor_r'] = motor_right.value
-        data_to_browser['motor_l'] = motor_left.value
-        # data_to_browser['light'] = bool(high_power_led.value)
-        data_to_browser['light'] = False
-        data_to_browser['buzzer'] = False
-        f.write(json.dumps(data_to_browser))
+    start_gui.gui_state.update_to_browser(
+        motor_r=motor_right.value,
+        motor_l=motor_left.value,
+        # light=bool(high_power_led.value),
+        light=False,
+        buzzer=False,
+    )
 
 def update_gui():
+    version = start_gui.gui_state.from_version
+    while True:
+        try:
+            # ブラウザから操作が届いたら(WebSocket / POST)すぐに反映する．届かなくても0.8秒ごとに更新する
+            if start_gui.gui_state.wait_from_browser(version, timeout=0.8):
+                version = start_gui.gui_state.from_version
+                read_from_gui()
+            write_to_gui()
+        except Exception as e:
+            logger.error('<<エラー>>\nGUIによる制御中にエラーが発生しました: %s', e)
+
+# update_gui() の asyncio 版 (USE_ASYNCIO = True のとき使う)
+async def update_gui_async(runtime):
+    browser_changed = runtime.notifier(start_gui.gui_state)
+    version = start_gui.gui_state.from_version
     while True:
         try:
-            read_from_gui()
+            deadline = time.monotonic() + 0.8
+            while start_gui.gui_state.from_version == version and time.monotonic() < deadline:
+                await browser_changed.wait(deadline - time.monotonic())
+            if start_gui.gui_state.from_version != version:
+                version = start_gui.gui_state.from_version
+                read_from_gui()
             write_to_gui()
-            time.sleep(0.8)
         except Exception as e:
             logger.error('<<エラー>>\nGUIによる制御中にエラーが発生しました: %s', e)
 
@@ -302,66 +373,130 @@ logger.info('GUIによる制御システムのセットアップが完了しま
 ##### カメラ #####
 logger.info('カメラのセットアップを開始しました')
 
-picam2 = Picamera2()
-picam_config = picam2.create_preview_configuration()
-# picam_config["transform"] = libcamera.Transform(hflip=1, vflip=1)
-picam2.configure(picam_config)
-picam2.start()
+def init_camera():
+    camera = Picamera2()
+    picam_config = camera.create_preview_configuration()
+    # picam_config["transform"] = libcamera.Transform(hflip=1, vflip=1)
+    camera.configure(picam_config)
+    return camera
+
+CAMERA_TIMEOUT = 5  # [s] この間画像が届かなければエンコーダーを再起動する
+# だれも見ていないときは，エンコーダーを止めて数秒ごとに1枚だけ撮る ('stop' ならカメラごと止める)
+CAMERA_IDLE_MODE = 'keepalive'
+# True にすると，撮影とJPEGへの変換を別のプロセスで行う (shm_frames.py)．画像は共有メモリで受け取る
+# モーターの制御やサーバーと GIL を取り合わないので，カメラを動かしても制御の周期がぶれない
+CAMERA_PROCESS = False
+
+# カメラを開くのには1秒ほどかかるので，コントローラーやサーバーの起動と並行してバックグラウンドで行う
+# (CAMERA_PROCESS のときは撮影用のプロセスが開く)
+camera_ready = None if CAMERA_PROCESS else startup_timer.background('camera init', init_camera)
+
+# ブラウザが見ている間だけ全速で撮影する (camera_power.py)
+# エンコーダーが撮影のたびに start_gui.camera_output (メモリ上) へJPEGを書き込む．SDカードには書き込まない
+def viewer_aware_camera(picam2):
+    camera = ViewerAwareCamera(picam2, start_gui.camera_output,
+                               idle_mode=CAMERA_IDLE_MODE, stall_timeout=CAMERA_TIMEOUT, logger=logger)
+    start_gui.gui_state.add_stats('camera', camera.stats)
+    return camera
 
 def start_camera():
-    while True:
-        try:
-            picam2.capture_file('camera_temp.jpg')
-            os.rename("camera_temp.jpg", "camera.jpg")
-            time.sleep(0.1)
-        except Exception as e:
-            logger.error('<<エラー>>\nカメラによる画像撮影中にエラーが発生しました: %s', e)
-
-logger.info('カメラのセットアップが完了しました')
+    if CAMERA_PROCESS:
+        camera = CameraProcess(start_gui.camera_output,
+                               idle_mode=CAMERA_IDLE_MODE, stall_timeout=CAMERA_TIMEOUT, logger=logger)
+        start_gui.gui_state.add_stats('camera', camera.stats)
+        camera.run()
+        return
+    viewer_aware_camera(camera_ready.result()).run()  # カメラの設定が終わるまで待つ
 
+# start_camera() の asyncio 版 (USE_ASYNCIO = True のとき使う)
+# 画像はエンコーダーのスレッドから FrameBuffer に届き，ストリームには add_listener 経由でループ上に通知される
+async def start_camera_async():
+    await viewer_aware_camera(await asyncio.wrap_future(camera_ready)).run_async()
 
-##### モーターの動作確認 #####
-logger.info('モーターの動作確認を開始します')
-motor_calib()
-logger.info('モーターの動作確認が完了しました')
+logger.info('カメラのセットアップが完了しました')
 
 
 ##### 平行処理(daemon)を開始 #####
-logger.info('並行処理による同時実行システムの定義を行います')
+# True にすると，スレッドの代わりに1つの asyncio のイベントループで全体を動かす (aio_runtime.py)
+# ループの遅れなどの統計は http://ローカルIPアドレス:8000/stats.json で見られる
+USE_ASYNCIO = False
+
+# ローカルIPアドレスを調べ，ネットワークの変化(Wi-Fi のつなぎ直し)の監視を始める
+start_gui.init()
+start_gui.gui_state.add_stats('startup', startup_timer.stats)
+start_gui.gui_state.add_stats('arbiter', arbiter.stats)
+start_gui.gui_state.add_stats('logging', queued_logging.stats)
+start_gui.gui_state.add_stats('telemetry', telemetry.stats)
+start_gui.gui_state.add_stats('selftest', selftest.stats)
+start_gui.gui_state.add_stats('audio', audio.stats)
+start_gui.gui_state.add_stats('controller', controller_watcher.stats)
+start_gui.gui_state.add_stats('input', controller_input.stats)
+
+if USE_ASYNCIO:
+    logger.info('asyncio のイベントループで全体を起動します')
+    runtime = aio_runtime.AsyncRuntime(logger=logger)
+    gui_server = aio_runtime.AsyncGuiServer(runtime, start_gui.gui_state, start_gui.camera_output, host=start_gui.HOST, port=start_gui.PORT)
+    runtime.add_task('controller', start_controller_async)
+    runtime.add_task('arbiter', arbiter.run_ticks_async)  # モーターへの反映の周期もループで行う (調停のスレッドは止まる)
+    runtime.add_task('server', gui_server.serve)
+    runtime.add_task('gui', update_gui_async, runtime)
+    if CAMERA_PROCESS:
+        runtime.add_thread('camera', start_camera)  # 撮影用のプロセスからの知らせをスレッドで待つ
+    else:
+        runtime.add_task('camera', start_camera_async)
+    if FAST_START:
+        selftest.skip()
+    else:
+        runtime.add_task('selftest', selftest.run_async)
+    start_gui.gui_state.add_stats('runtime', runtime.stats)
+    logger.info('セットアップが完了しました')
+    startup_timer.ready()  # タスクはループが動き始めるとすぐに始まる
+    runtime.run()
+
+else:
+    logger.info('並行処理による同時実行システムの定義を行います')
 
-# コントローラーを起動
-controller_thread = threading.Thread(target=start_controller, daemon=True)
+    # コントローラーを起動
+    controller_thread = threading.Thread(target=start_controller, daemon=True)
 
-# GUI用のサーバーを起動
-server_thread = threading.Thread(target=start_gui.start_server, daemon=True)
+    # GUI用のサーバーを起動
+    server_thread = threading.Thread(target=start_gui.start_server, daemon=True)
 
-# GUIのデータを読み込み・書き込み
-gui_thread = threading.Thread(target=update_gui, daemon=True)
+    # GUIのデータを読み込み・書き込み
+    gui_thread = threading.Thread(target=update_gui, daemon=True)
 
-# カメラで撮影開始
-camera_thread = threading.Thread(target=start_camera, daemon=True)
+    # カメラで撮影開始
+    camera_thread = threading.Thread(target=start_camera, daemon=True)
 
-logger.info('コントローラーを起動します')
-controller_thread.start()
+    logger.info('コントローラーを起動します')
+    controller_thread.start()
 
-logger.info('GUI用のサーバーを起動します')
-server_thread.start()
+    logger.info('GUI用のサーバーを起動します')
+    server_thread.start()
 
-logger.info('GUIによる制御システムを起動します')
-gui_thread.start()
+    logger.info('GUIによる制御システムを起動します')
+    gui_thread.start()
 
-logger.info('カメラによる連続撮影を開始します')
-camera_thread.start()
+    logger.info('カメラによる連続撮影を開始します')
+    camera_thread.start()
 
-logger.info('セットアップが完了しました')
+    logger.info('セットアップが完了しました')
+    startup_timer.ready()
 
-first_thread_count = threading.active_count()
-while threading.active_count() != 1:
-    if first_thread_count == threading.active_count():
-        logger.info('正常に実行されています')
+    if FAST_START:
+        selftest.skip()
     else:
-        logger.error('<<エラー>>\nプログラムの一部が停止しています')
-    time.sleep(10)
+        logger.info('モーターの動作確認を開始します (操作を始めると中止します)')
+        selftest.start()
+
+    # 起動の途中や動作確認で一時的に動くスレッドもあるので，スレッドの数ではなく4つのスレッドそれぞれを確かめる
+    main_threads = (controller_thread, server_thread, gui_thread, camera_thread)
+    while any(thread.is_alive() for thread in main_threads):
+        if all(thread.is_alive() for thread in main_threads):
+            logger.info('正常に実行されています')
+        else:
+            logger.error('<<エラー>>\nプログラムの一部が停止しています')
+        time.sleep(10)
 
 ### 参考にしたサイト
 # thread関連
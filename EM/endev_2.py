@@ -1,12 +1,13 @@
-import json
+import functools
 from logging import getLogger, StreamHandler, Formatter, DEBUG
 from logging.handlers import RotatingFileHandler
 import os
-import subprocess
 import sys
 import threading
 import time
 
+import log_setup
+
 # =============================
 # basic setup
 # =============================
@@ -26,7 +27,6 @@ logger.propagate = False
 
 s_handler = StreamHandler()
 s_handler.setLevel(DEBUG)
-logger.addHandler(s_handler)
 
 tsv_format = Formatter(
     "%(asctime)s.%(msecs)d+09:00\t%(name)s\t%(filename)s\t%(lineno)d\t%(funcName)s\t%(levelname)s\t%(message)s",
@@ -35,7 +35,10 @@ tsv_format = Formatter(
 f_handler = RotatingFileHandler("fm.log", maxBytes=100 * 1000)
 f_handler.setLevel(DEBUG)
 f_handler.setFormatter(tsv_format)
-logger.addHandler(f_handler)
+
+# the handlers run on a background thread: logging never blocks the control thread on the SD card.
+# DEBUG records are rate limited per call site; dropped / rate-limited counts are in /stats.json
+queued_logging = log_setup.QueuedLogging(logger, s_handler, f_handler)
 
 logger.info("setup start")
 
@@ -46,12 +49,18 @@ if sys.prefix == sys.base_prefix:
 logger.info("importing libraries")
 from gpiozero import Motor
 from picamera2 import Picamera2
-from pyPS4Controller.controller import Controller
+import audio_engine
+import axis_map
+from camera_power import ViewerAwareCamera
+from command_arbiter import CommandArbiter
+import input_backend
+from shm_frames import CameraProcess
 import start_gui_2
+from telemetry_ring import TelemetryRecorder
 logger.info("libraries imported")
 
 # =============================
-# motors (same as your MyController)
+# motors
 # =============================
 
 PIN_AIN1 = 2
@@ -67,20 +76,50 @@ throttle = 0.0  # forward/back (-1..+1)
 steer = 0.0     # left/right  (-1..+1)
 
 
-def clamp(x: float, lo: float, hi: float) -> float:
-    return max(lo, min(hi, x))
+# stick handlers only update the target; the motors are written CONTROL_TICK_HZ times per second
+# at most (0: write on every event)
+CONTROL_TICK_HZ = 100
+
+# stick value (-32768 .. 32767, up / left negative) -> -1 .. +1, computed once at startup:
+# a stick handler is a single table lookup (deadzone and response curve are baked in)
+STICK_TABLE = axis_map.ps4_table(deadzone=0.15, curve="linear")
+
+
+def apply_motors(command: dict, source: str):
+    """Called by the arbiter once per control tick when the target changed."""
+    left_power = command["motor_l"]
+    right_power = command["motor_r"]
+
+    if abs(left_power) < 0.01 and abs(right_power) < 0.01:
+        motor_left.stop()
+        motor_right.stop()
+    else:
+        motor_left.value = left_power
+        motor_right.value = right_power
+    # latency from the controller callback (or GUI message) to the motor output
+    arbiter.mark_output(source)
+
+    logger.debug("motors(%s): L=%.2f R=%.2f", source, left_power, right_power)
+    telemetry.record(
+        left_power, right_power,
+        (left_power + right_power) / 2.0, (left_power - right_power) / 2.0,
+        source,
+    )
+    # push the new motor values to the browser right away
+    write_to_gui()
+
 
+# every applied command is also recorded in binary (read it with: python telemetry_ring.py telemetry.bin)
+telemetry = TelemetryRecorder("telemetry.bin")
 
-def scale_axis(v: int) -> float:
-    """
-    Same idea as your scale_axis:
-    PS4 axis value (-32768 .. 32767) -> |value| 0.0 .. 1.0 (with deadzone)
-    """
-    v = abs(v)
-    val = v / 32767.0
-    if val < 0.15:
-        return 0.0
-    return clamp(val, 0.0, 1.0)
+
+# single input source (the GUI has no motor control here), used for its control tick
+arbiter = CommandArbiter(
+    apply_motors,
+    {"controller": 1},
+    initial={"motor_l": 0.0, "motor_r": 0.0},
+    tick_rate=CONTROL_TICK_HZ,
+)
 
 
 def motor_init():
@@ -95,107 +134,48 @@ def motor_init():
 # speaker (optional)
 # =============================
 
-proces_aplay = None
+SOUND_FILES = [
+    "/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav",
+]
+
+# one long-lived player: clips are decoded once and the ALSA device stays open
+audio = audio_engine.AudioEngine(audio_engine.open_sink(), logger=logger)
+threading.Thread(target=lambda: [audio.load(path) for path in SOUND_FILES], daemon=True).start()
 
 
-def audio_play(path: str):
-    global proces_aplay
-    if proces_aplay is None or proces_aplay.poll() is not None:
-        proces_aplay = subprocess.Popen(
-            f"aplay --device=hw:1,0 {path}",
-            shell=True,
-        )
+def audio_play(path: str, priority: int = 0, overlap: bool = True):
+    if audio.play(path, priority, overlap=overlap):
         logger.info("audio play: %s", path)
     else:
-        logger.info("audio already playing, skip")
+        logger.info("audio skipped: %s", path)
 
 
 # =============================
-# PS4 controller (your MyController)
+# PS4 controller (input_backend: js0 read directly, table-driven dispatch)
 # =============================
 
-class MyController(Controller):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-        # use global motors
-        self.motor_left = motor_left
-        self.motor_right = motor_right
-
-        self.throttle = 0.0  # forward/back
-        self.steer = 0.0     # left/right
-
-        print("Motors initialized, waiting for controller...")
-
-    # ----- left stick Y -----
-    def on_L3_up(self, value):
-        p = scale_axis(value)
-        self.throttle = p
-        self.update_motors()
-
-    def on_L3_down(self, value):
-        p = scale_axis(value)
-        self.throttle = -p
-        self.update_motors()
-
-    def on_L3_y_at_rest(self):
-        self.throttle = 0.0
-        self.update_motors()
-
-    # ----- left stick X -----
-    def on_L3_right(self, value):
-        p = scale_axis(value)
-        self.steer = p
-        self.update_motors()
-
-    def on_L3_left(self, value):
-        p = scale_axis(value)
-        self.steer = -p
-        self.update_motors()
-
-    def on_L3_x_at_rest(self):
-        self.steer = 0.0
-        self.update_motors()
-
-    # ----- X button (emergency stop) -----
-    def on_x_press(self):
-        self.throttle = 0.0
-        self.steer = 0.0
-        self.motor_left.stop()
-        self.motor_right.stop()
-        print("X pressed: EMERGENCY STOP")
-        # audio_play("/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav")
-
-    def update_motors(self):
-        """
-        exactly your update_motors()
-        """
-        left_power = self.throttle + self.steer
-        right_power = self.throttle - self.steer
-
-        left_power = clamp(left_power, -1.0, 1.0)
-        right_power = clamp(right_power, -1.0, 1.0)
-
-        if abs(left_power) < 0.01 and abs(right_power) < 0.01:
-            self.motor_left.stop()
-            self.motor_right.stop()
-        else:
-            self.motor_left.value = left_power
-            self.motor_right.value = right_power
-
-        logger.debug(
-            "motors(MyController): L=%.2f R=%.2f (thr=%.2f steer=%.2f)",
-            left_power, right_power, self.throttle, self.steer
-        )
+def emergency_stop():
+    controller_input.stop()
+    print("X pressed: EMERGENCY STOP")
+    # audio_play("/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav", priority=1)
+
+
+# left stick: Y = throttle, X = steer
+controller_input = input_backend.DriveInput(
+    functools.partial(arbiter.push, "controller"),
+    input_backend.arcade_drive,
+    tables={"left_x": STICK_TABLE, "left_y": STICK_TABLE},
+    actions={"cross": emergency_stop},
+)
+joystick = input_backend.JoystickBackend(controller_input, input_backend.JS_HID_LAYOUT)
 
 
 def start_controller():
-    controller = MyController(
-        interface="/dev/input/js0",
-        connecting_using_ds4drv=False,
-    )
-    logger.info("Listening PS4 controller (left stick)...")
-    controller.listen()
+    print("Motors initialized, waiting for controller...")
+    while True:
+        logger.info("Listening PS4 controller (left stick)...")
+        joystick.listen("/dev/input/js0")
+        logger.warning("controller disconnected")
 
 
 # =============================
@@ -204,26 +184,17 @@ def start_controller():
 
 def read_from_gui():
     # ignore any commands from browser (no motor control via GUI)
-    try:
-        with open("data_from_browser.json") as f:
-            _ = json.load(f)
-    except Exception:
-        pass
+    pass
 
 
 def write_to_gui():
     # only expose current motor values to browser
-    try:
-        with open("data_to_browser.json") as f:
-            d = json.load(f)
-        d["motor_l"] = motor_left.value
-        d["motor_r"] = motor_right.value
-        d["light"] = False
-        d["buzzer"] = False
-        with open("data_to_browser.json", "w") as f:
-            f.write(json.dumps(d))
-    except Exception:
-        pass
+    start_gui_2.gui_state.update_to_browser(
+        motor_l=motor_left.value,
+        motor_r=motor_right.value,
+        light=False,
+        buzzer=False,
+    )
 
 
 def update_gui():
@@ -240,20 +211,37 @@ def update_gui():
 # camera
 # =============================
 
-picam2 = Picamera2()
-cfg = picam2.create_preview_configuration()
-picam2.configure(cfg)
-picam2.start()
+CAMERA_TIMEOUT = 5.0  # [s] restart the encoder when no frame arrives for this long
+# with no browser watching, stop the JPEG encoder and take one picture every few seconds ("stop": stop the camera)
+CAMERA_IDLE_MODE = "keepalive"
+# True: capture and encode in a separate process (shm_frames.py) so the camera never holds this process's GIL;
+# frames come back through shared memory. The worker opens the camera itself.
+CAMERA_PROCESS = False
+
+if CAMERA_PROCESS:
+    camera = CameraProcess(
+        start_gui_2.camera_output,
+        idle_mode=CAMERA_IDLE_MODE,
+        stall_timeout=CAMERA_TIMEOUT,
+        logger=logger,
+    )
+else:
+    picam2 = Picamera2()
+    cfg = picam2.create_preview_configuration()
+    picam2.configure(cfg)
+    camera = ViewerAwareCamera(
+        picam2,
+        start_gui_2.camera_output,
+        idle_mode=CAMERA_IDLE_MODE,
+        stall_timeout=CAMERA_TIMEOUT,
+        logger=logger,
+    )
 
 
 def start_camera():
-    while True:
-        try:
-            picam2.capture_file("camera_temp.jpg")
-            os.replace("camera_temp.jpg", "camera.jpg")
-            time.sleep(0.1)
-        except Exception as e:
-            logger.error("Camera error: %s", e)
+    # the encoder writes every JPEG into start_gui_2.camera_output (RAM only, nothing on the SD card),
+    # at full rate only while a browser is watching (camera_power.py)
+    camera.run()
 
 
 # =============================
@@ -262,6 +250,14 @@ def start_camera():
 
 logger.info("motor init")
 motor_init()
+# look up the local IP and follow network changes (Wi-Fi roaming); importing start_gui_2 does neither
+start_gui_2.init()
+start_gui_2.gui_state.add_stats("arbiter", arbiter.stats)
+start_gui_2.gui_state.add_stats("logging", queued_logging.stats)
+start_gui_2.gui_state.add_stats("telemetry", telemetry.stats)
+start_gui_2.gui_state.add_stats("audio", audio.stats)
+start_gui_2.gui_state.add_stats("input", controller_input.stats)
+start_gui_2.gui_state.add_stats("camera", camera.stats)
 
 threading.Thread(target=start_controller, daemon=True).start()
 threading.Thread(
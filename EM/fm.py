@@ -6,7 +6,7 @@
 
 # スピーカー設定をPWM出力可能にしておく(/boot/firmware/config.txtの末尾に"dtoverlay=audremap,pins_12_13"を追加)
 
-import json
+import functools
 from logging import getLogger, StreamHandler, Formatter, Logger, DEBUG, INFO, WARNING, ERROR, CRITICAL
 from logging.handlers import RotatingFileHandler
 import os
@@ -15,6 +15,9 @@ import sys
 import threading
 import time
 
+import log_setup
+import startup
+
 # 本プログラムではむつめ祭来場者にログを見せる可能性や
 # プログラムに慣れない人がプログラムを実行する可能性を考慮し
 # ログの一部を日本語で出力しています．良い子はマネしないでね
@@ -35,40 +38,55 @@ logger.propagate = False
 
 s_handler = StreamHandler()
 s_handler.setLevel(INFO)
-logger.addHandler(s_handler)
 
 tsv_format = Formatter('%(asctime)s.%(msecs)d+09:00\t%(name)s\t%(filename)s\t%(lineno)d\t%(funcName)s\t%(levelname)s\t%(message)s', '%Y-%m-%dT%H:%M:%S')
 f_handler = RotatingFileHandler('fm.log', maxBytes=100*1000)
 f_handler.setLevel(DEBUG)
 f_handler.setFormatter(tsv_format)
-logger.addHandler(f_handler)
+
+# ログの書き込みはバックグラウンドのスレッドで行い，SDカードが遅くても制御のスレッドを止めない
+# DEBUG のログは呼び出し場所ごとに間引く．捨てた数・間引いた数は /stats.json で見られる
+queued_logging = log_setup.QueuedLogging(logger, s_handler, f_handler)
 #######################
 
 
+# 起動の段階ごとの時間を記録する (ログと /stats.json に出す)．時間はプロセスが起動したときから数える
+startup_timer = startup.StartupTimer(logger)
+
 logger.info('セットアップを開始します')
 
 logger.info('実行環境を確認しています')
 if sys.prefix == sys.base_prefix:
     logger.warning('<<警告>>\n仮想環境で実行していない可能性があります．仮想環境でない場合は次のコマンドを実行し再度このプログラムを起動してください．source fm_env/bin/activate')
-    time.sleep(10)
 logger.info('実行環境の確認が完了しました')
 
 logger.info('コントローラと無線接続を行います')
 logger.info('PS4コントローラーのPSボタンとSHAREボタンを同時に，青いランプが光るまで長押ししてください')
+# ds4drv の接続を待たずに先へ進む．つながるまでは start_controller() が js0 を開き直し続ける
 subprocess.Popen('sudo ds4drv', shell=True, stdout=subprocess.DEVNULL)
-time.sleep(20)
 
 
 logger.info('ライブラリをインポートしています')
+# 重いライブラリを並行してインポートしておく (下の from ... import はすぐに終わる)
+with startup_timer.phase('imports'):
+    startup_timer.import_modules('gpiozero', 'picamera2', 'libcamera', 'start_gui')
 # from gpiozero import LED
 from gpiozero import Motor
 from gpiozero.pins.pigpio import PiGPIOFactory
 from picamera2 import Picamera2
-from pyPS4Controller.controller import Controller
+import libcamera
 logger.info('ライブラリのインポートが完了しました')
 
 logger.info('別のPythonファイルを読み込んでいます')
+import audio_engine
+import axis_map
+from camera_power import ViewerAwareCamera
+from command_arbiter import CommandArbiter
+import input_backend
+import motor_selftest
+from shm_frames import CameraProcess
 import start_gui
+from telemetry_ring import TelemetryRecorder
 logger.info('別のPythonファイルの読み込みが完了しました')
 
 
@@ -83,70 +101,32 @@ PIN_L2 = 27
 motor_right = Motor(forward = PIN_R1, backward = PIN_R2, pin_factory = PiGPIOFactory())
 motor_left  = Motor(forward = PIN_L1, backward = PIN_L2, pin_factory = PiGPIOFactory())
 
-def motor_calib():
-    power = 0
-    delta_power = 0.2
-
-    logger.info("右モーターのテストを行います")
-    for i in range(int(1 / delta_power)):
-        if 0<=power<=1:
-            motor_right.value = power
-            power += delta_power
-    motor_right.value = 1
-    time.sleep(0.5)
-
-    for i in range((int(1 / delta_power))*2):
-        if -1<=power<=1:
-            motor_right.value = power
-            power -= delta_power
-    motor_right.value = -1
-    time.sleep(0.5)
-
-    for i in range(int(1 / delta_power)):
-        if -1<=power<=0:
-            motor_right.value = power
-            power += delta_power
-    motor_right.value = 0
-    time.sleep(0.5)
-
-    logger.info("左モーターのテストを行います")
-    for i in range(int(1 / delta_power)):
-        if 0<=power<=1:
-            motor_left.value = power
-            power += delta_power
-    motor_left.value = 1
-    time.sleep(0.5)
-
-    for i in range((int(1 / delta_power))*2):
-        if -1<=power<=1:
-            motor_left.value = power
-            power -= delta_power
-    motor_left.value = -1
-    time.sleep(0.5)
-
-    for i in range(int(1 / delta_power)):
-        if -1<=power<=0:
-            motor_left.value = power
-            power += delta_power
-    motor_left.value = 0
-    time.sleep(0.5)
-
 logger.info('モーターのセットアップが完了しました')
 
 ##### スピーカー #####
 
 logger.info('スピーカーのセットアップを開始しました')
 
-# .poll()は終了していなかったらNone，終了していたらそのステータスを返す．
-def audio_play(audio_path):
-    global proces_aplay
+SOUND_FILES = [
+    '/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav',
+    '/home/jaxai/Desktop/kane_tarinai.wav',
+    '/home/jaxai/Desktop/hatodokei.wav',
+    '/home/jaxai/Desktop/otoko_ou!.wav',
+]
+
+# 再生するたびに aplay を起動するのではなく，1つのプレーヤーを使い続ける (デバイスは開いたまま)
+# 効果音は起動時にバックグラウンドで読み込んでおく
+audio = audio_engine.AudioEngine(audio_engine.open_sink(), logger=logger)
+startup_timer.background('audio init', lambda: [audio.load(path) for path in SOUND_FILES])
+
+# priority: 鳴らせる数を超えたときは優先度の低い音から止める
+# overlap=False: 同じ音が鳴っている間は重ねない
+def audio_play(audio_path, priority=0, overlap=True):
     logger.debug('audio_path: %s', audio_path)
-    if (proces_aplay is None or proces_aplay.poll() != None):
-        proces_aplay = subprocess.Popen(f"aplay --device=hw:1,0 {audio_path}", shell=True)
-        # proces_aplay.returncode
+    if audio.play(audio_path, priority, overlap=overlap):
         logger.info("音楽の再生中です")
     else:
-        logger.info("音楽がすでに再生中のためキャンセルします")
+        logger.info("音楽を再生できなかったためキャンセルします")
 
 logger.info('スピーカーのセットアップが完了しました')
 
@@ -154,95 +134,66 @@ logger.info('スピーカーのセットアップが完了しました')
 ###### コントローラ #####
 logger.info('コントローラーによる制御システムのセットアップを開始しました')
 
-last_controll_time = time.time()
-
-def transf(raw):
-    temp = raw / (1 << 15)
-    # Filter values that are too weak for the motors to move
-    if abs(temp) < 0.05:
-        return 0
-    # Return a value between 0.2 and 1.0
-    else:
-        return round(temp, 2)
-    
-last_r2_release_time = time.time()
-
-# 右スティック前：R2_press　負
-# 右スティック後：R2_press　正
-# 左スティック前：L3_up　負
-# 左スティック後：L3_down　正
-# ×ボタン→〇ボタン，〇ボタン→△ボタン，△ボタン→□ボタン，□ボタン→×ボタン
-class MyController(Controller):
-    def __init__(self, **kwargs):
-        Controller.__init__(self, **kwargs)
-    
-    def on_R2_press(self, value):
-        global last_controll_time
-        last_controll_time = time.time()
-        logger.debug('R2_press value: %f', value)
-        # 右モーター前進/後退
-        power = -transf(value)
-        motor_right.value = power
-        logger.info('右スティックの操作中. 右モーター出力: %f', motor_right.value)
-
-    def on_R2_release(self):
-        # global last_controll_time
-        # last_controll_time = time.time()
-        # 右モーター停止
-        if time.time() - last_r2_release_time < 0.2:
-            motor_right.value = 0
-            logger.info('右スティックが無操作. 右モーター出力: %f', motor_right.value)
-        last_r2_release_time = time.time()
-
-    def on_L3_up(self, value):
-        global last_controll_time
-        last_controll_time = time.time()
-        logger.debug('L3_up value: %f', value)
-        # 左モーター前進
-        power = -transf(value)
-        motor_left.value = power
-        logger.info('左スティックの操作中. 左モーター出力: %f', motor_left.value)
-
-    def on_L3_down(self, value):
-        global last_controll_time
-        last_controll_time = time.time()
-        logger.debug('L3_down value: %f', value)
-        # 左モーター後退
-        power = -transf(value)
-        motor_left.value = power
-        logger.info('左スティックの操作中. 左モーター出力: %f', motor_left.value)
-
-    def on_L3_y_at_rest(self):
-        # global last_controll_time
-        # last_controll_time = time.time()
-        # 左モーター停止
-        motor_left.value = 0
-        logger.info('左スティックが無操作. 左モーター出力: %f', motor_left.value)
-
-    def on_x_press(self):
-        logger.info('□ボタンが押されました')
-        global last_controll_time
-        last_controll_time = time.time()
-        # 音楽を再生
-        audio_play("/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav")
-    
-    def on_square_press(self):
-        logger.info('△ボタンが押されました')
-        global last_controll_time
-        last_controll_time = time.time()
-        audio_play("/home/jaxai/Desktop/kane_tarinai.wav")
-    
-    def on_circle_press(self):
-        logger.info('×ボタンが押されました')
-        global last_controll_time
-        last_controll_time = time.time()
-        audio_play("/home/jaxai/Desktop/hatodokei.wav")
-
-    def on_triangle_press(self):
-        logger.info('○ボタンが押されました')
-        global last_controll_time
-        last_controll_time = time.time()
-        audio_play("/home/jaxai/Desktop/otoko_ou!.wav")
+# コントローラーとGUIの指令の調停
+# コントローラーを操作してから CONTROLLER_HOLD_OFF 秒間は，GUIからの指令を保留する
+# 起動時のモーターの動作確認('selftest')はいちばん優先するが，コントローラーやGUIが操作を始めたら中止して譲る
+INPUT_PRIORITIES = {'selftest': 3, 'controller': 2, 'gui': 1}
+CONTROLLER_HOLD_OFF = 1.0  # [s]
+# スティックの操作では目標値を更新するだけで，モーターへの書き込みは1秒に CONTROL_TICK_HZ 回までにまとめる
+# (0 にするとイベントのたびに書き込む)
+CONTROL_TICK_HZ = 100
+
+# 調停で勝った指令をモーターに反映する (モーターに書き込むのはここだけ)
+# スティックのイベントごとではなく，値が変わった周期ごとにログを出す
+def apply_motors(command, source):
+    motor_right.value = command['motor_r']
+    motor_left.value = command['motor_l']
+    arbiter.mark_output(source)  # 入力(ハンドラーが呼ばれた時刻)からモーター出力までの遅れを記録する
+    logger.debug('モーター出力(%s): 左 %f, 右 %f', source, motor_left.value, motor_right.value)
+    # 左右の出力と，そこから求めた前後(throttle)・旋回(steer)の成分を記録する
+    telemetry.record(motor_left.value, motor_right.value, (motor_left.value + motor_right.value) / 2, (motor_left.value - motor_right.value) / 2, source)
+    write_to_gui()  # ブラウザにもすぐ送る
+
+# モーターに反映した指令をバイナリで記録する (読むとき：python telemetry_ring.py telemetry.bin)
+telemetry = TelemetryRecorder('telemetry.bin')
+
+arbiter = CommandArbiter(apply_motors, INPUT_PRIORITIES, hold_off=CONTROLLER_HOLD_OFF, initial={'motor_l': 0.0, 'motor_r': 0.0}, tick_rate=CONTROL_TICK_HZ)
+
+# 起動時のモーターの動作確認．ほかの処理と並行してバックグラウンドで行い，結果はブラウザと /stats.json に出す
+# 環境変数 FAST_START=1 で起動すると動作確認を飛ばして，すぐに操作できるようにする (本番中に電圧が下がって再起動したときなど)
+FAST_START = os.environ.get('FAST_START') == '1'
+selftest = motor_selftest.MotorSelfTest(
+    arbiter,
+    # pigpio デーモンから GPIO ピンの実際の PWM を読み返す (Motor.value は書いた値を覚えているだけ)
+    motor_selftest.pigpio_readback({'motor_l': motor_left, 'motor_r': motor_right}),
+    on_change=lambda state: start_gui.gui_state.update_to_browser(selftest=state),
+    logger=logger,
+)
+
+# スティックの値(-32768~32767)からモーターの出力(-1~1)への変換表．起動時に1回だけ作る
+# デッドゾーン(弱すぎてモーターが回らない範囲)や反応の曲線も表に入っている
+STICK_TABLE = axis_map.ps4_table(deadzone=0.05, curve='linear')
+
+# ds4drv の js0 は，右スティックの上下が 5 番の軸で，ボタンの番号もずれている (input_backend.JS_DS4DRV_LAYOUT)
+# 左スティックの上下で左のモーター，右スティックの上下で右のモーター
+def button_sound(label, audio_path):
+    def action():
+        logger.info('%sボタンが押されました', label)
+        audio_play(audio_path, priority=1)
+    return action
+
+controller_input = input_backend.DriveInput(
+    functools.partial(arbiter.push, 'controller'),
+    input_backend.tank_drive,
+    tables={'left_y': STICK_TABLE, 'right_y': STICK_TABLE},
+    actions={
+        'square': button_sound('□', "/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav"),
+        'triangle': button_sound('△', "/home/jaxai/Desktop/kane_tarinai.wav"),
+        'cross': button_sound('×', "/home/jaxai/Desktop/hatodokei.wav"),
+        'circle': button_sound('○', "/home/jaxai/Desktop/otoko_ou!.wav"),
+    },
+)
+joystick = input_backend.JoystickBackend(controller_input, input_backend.JS_DS4DRV_LAYOUT)
 
 
 def connect():
@@ -254,10 +205,11 @@ def disconnect():
 def start_controller():
     while True:
         try:
-            controller = MyController(interface="/dev/input/js0", connecting_using_ds4drv=False)
-            controller.listen(on_connect=connect, on_disconnect=disconnect)
+            # js0 がまだない(ds4drv が接続中)ときは，開けるまで listen() の中で待つ
+            joystick.listen('/dev/input/js0', on_connect=connect, on_disconnect=disconnect)
         except Exception as e:
             logger.error('<<エラー>>\nコントローラーによる制御でエラーが発生しました: %s', e)
+            time.sleep(1)
 
 logger.info('コントローラーによる制御システムのセットアップが完了しました')
 
@@ -265,18 +217,12 @@ logger.info('コントローラーによる制御システムのセットアッ
 ##### GUI #####
 logger.info('GUIによる制御システムのセットアップを開始しました')
 
+# ブラウザから操作が届いたときに呼ぶ．モーターへの指令はコントローラーの操作中なら調停で保留される
 def read_from_gui():
-    global last_controll_time
-    if time.time() - last_controll_time < 1:
-        return
-    
-    data_from_browser = {}
-    with open('data_from_browser.json', 'r') as f:
-        data_from_browser = json.load(f)
+    _, received, data_from_browser = start_gui.gui_state.get_from_browser_timed()
     logger.debug('data_from_browser: %s', data_from_browser)
     
-    motor_right.value = float(data_from_browser['motor_r'])
-    motor_left.value = float(data_from_browser['motor_l'])
+    arbiter.push('gui', timestamp=received, motor_r=float(data_from_browser['motor_r']), motor_l=float(data_from_browser['motor_l']))
     if bool(data_from_browser['light']):
         # high_power_led.on()
         pass
@@ -284,27 +230,26 @@ def read_from_gui():
         # high_power_led.off()
         pass
     if bool(data_from_browser['buzzer']):
-        audio_play('/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav')
+        audio_play('/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav', overlap=False)
 
 def write_to_gui():
-    data_to_browser = {}
-    with open('data_to_browser.json', 'r') as f:
-        data_to_browser = json.load(f)
-
-    with open('data_to_browser.json', 'w') as f:
-        data_to_browser['motor_r'] = motor_right.value
-        data_to_browser['motor_l'] = motor_left.value
-        # data_to_browser['light'] = bool(high_power_led.value)
-        data_to_browser['light'] = False
-        data_to_browser['buzzer'] = False
-        f.write(json.dumps(data_to_browser))
+    start_gui.gui_state.update_to_browser(
+        motor_r=motor_right.value,
+        motor_l=motor_left.value,
+        # light=bool(high_power_led.value),
+        light=False,
+        buzzer=False,
+    )
 
 def update_gui():
+    version = start_gui.gui_state.from_version
     while True:
         try:
-            read_from_gui()
+            # ブラウザから操作が届いたら(WebSocket / POST)すぐに反映する．届かなくても0.8秒ごとに更新する
+            if start_gui.gui_state.wait_from_browser(version, timeout=0.8):
+                version = start_gui.gui_state.from_version
+                read_from_gui()
             write_to_gui()
-            time.sleep(0.8)
         except Exception as e:
             logger.error('<<エラー>>\nGUIによる制御中にエラーが発生しました: %s', e)
 
@@ -314,33 +259,56 @@ logger.info('GUIによる制御システムのセットアップが完了しま
 ##### カメラ #####
 logger.info('カメラのセットアップを開始しました')
 
-picam2 = Picamera2()
-picam_config = picam2.create_preview_configuration()
-picam_config["transform"] = libcamera.Transform(hflip=1, vflip=1)
-picam2.configure(picam_config)
-picam2.start()
+def init_camera():
+    camera = Picamera2()
+    picam_config = camera.create_preview_configuration()
+    picam_config["transform"] = libcamera.Transform(hflip=1, vflip=1)
+    camera.configure(picam_config)
+    return camera
 
-def start_camera():
-    while True:
-        try:
-            picam2.capture_file('camera_temp.jpg')
-            os.rename("camera_temp.jpg", "camera.jpg")
-            time.sleep(0.1)
-        except Exception as e:
-            logger.error('<<エラー>>\nカメラによる画像撮影中にエラーが発生しました: %s', e)
+CAMERA_TIMEOUT = 5  # [s] この間画像が届かなければエンコーダーを再起動する
+# だれも見ていないときは，エンコーダーを止めて数秒ごとに1枚だけ撮る ('stop' ならカメラごと止める)
+CAMERA_IDLE_MODE = 'keepalive'
+# True にすると，撮影とJPEGへの変換を別のプロセスで行う (shm_frames.py)．画像は共有メモリで受け取る
+# モーターの制御やサーバーと GIL を取り合わないので，カメラを動かしても制御の周期がぶれない
+CAMERA_PROCESS = False
 
-logger.info('カメラのセットアップが完了しました')
+# カメラを開くのには1秒ほどかかるので，コントローラーやサーバーの起動と並行してバックグラウンドで行う
+# (CAMERA_PROCESS のときは撮影用のプロセスが開く)
+camera_ready = None if CAMERA_PROCESS else startup_timer.background('camera init', init_camera)
 
+def start_camera():
+    if CAMERA_PROCESS:
+        camera = CameraProcess(start_gui.camera_output, hflip=True, vflip=True,
+                               idle_mode=CAMERA_IDLE_MODE, stall_timeout=CAMERA_TIMEOUT, logger=logger)
+        start_gui.gui_state.add_stats('camera', camera.stats)
+        camera.run()
+        return
+    # エンコーダーが撮影のたびに start_gui.camera_output (メモリ上) へJPEGを書き込む．SDカードには書き込まない
+    # ブラウザが見ている間だけ全速で撮影する (camera_power.py)
+    picam2 = camera_ready.result()  # カメラの設定が終わるまで待つ
+    camera = ViewerAwareCamera(picam2, start_gui.camera_output,
+                               idle_mode=CAMERA_IDLE_MODE, stall_timeout=CAMERA_TIMEOUT, logger=logger)
+    start_gui.gui_state.add_stats('camera', camera.stats)
+    camera.run()
 
-##### モーターの動作確認 #####
-logger.info('モーターの動作確認を開始します')
-motor_calib()
-logger.info('モーターの動作確認が完了しました')
+logger.info('カメラのセットアップが完了しました')
 
 
 ##### 平行処理を開始 #####
 logger.info('並行処理による同時実行システムの定義を行います')
 
+# 調停の統計は http://ローカルIPアドレス:8000/stats.json で見られる
+# ローカルIPアドレスを調べ，ネットワークの変化(Wi-Fi のつなぎ直し)の監視を始める
+start_gui.init()
+start_gui.gui_state.add_stats('startup', startup_timer.stats)
+start_gui.gui_state.add_stats('arbiter', arbiter.stats)
+start_gui.gui_state.add_stats('logging', queued_logging.stats)
+start_gui.gui_state.add_stats('telemetry', telemetry.stats)
+start_gui.gui_state.add_stats('selftest', selftest.stats)
+start_gui.gui_state.add_stats('audio', audio.stats)
+start_gui.gui_state.add_stats('input', controller_input.stats)
+
 # コントローラーを起動
 controller_thread = threading.Thread(target=start_controller)
 
@@ -366,10 +334,18 @@ logger.info('カメラによる連続撮影を開始します')
 camera_thread.start()
 
 logger.info('セットアップが完了しました')
-
-first_thread_count = threading.active_count()
-while threading.active_count() != 1:
-    if first_thread_count == threading.active_count():
+startup_timer.ready()
+
+if FAST_START:
+    selftest.skip()
+else:
+    logger.info('モーターの動作確認を開始します (操作を始めると中止します)')
+    selftest.start()
+
+# 起動の途中や動作確認で一時的に動くスレッドもあるので，スレッドの数ではなく4つのスレッドそれぞれを確かめる
+main_threads = (controller_thread, server_thread, gui_thread, camera_thread)
+while any(thread.is_alive() for thread in main_threads):
+    if all(thread.is_alive() for thread in main_threads):
         logger.info('正常に実行されています')
     else:
         logger.error('<<エラー>>\nプログラムの一部が停止しています')
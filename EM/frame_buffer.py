@@ -0,0 +1,107 @@
+# カメラで撮影した画像をメモリ上で受け渡すためのモジュールです
+# Picamera2 のエンコーダーの出力先(FileOutput)として使い，GUI用のサーバーがそこから画像を読み出します
+# camera_temp.jpg を書いて camera.jpg にリネームする必要がないので，SDカードが傷まず，
+# ブラウザが書きかけのJPEGを受け取ることもありません
+#
+# 画像を見ている人(視聴者)の数も数えます．誰も見ていないときにカメラを休ませるため (camera_power.py)
+# ・ストリーム(/stream.mjpg)は，送っている間 watching() で数える
+# ・写真(/camera.jpg)を読んだクライアントは，touch() から VIEWER_TIMEOUT 秒の間だけ数える (1秒ごとに読み直すため)
+
+import contextlib
+import io
+import threading
+import time
+
+VIEWER_TIMEOUT = 3.0  # [s] /camera.jpg を読んだクライアントを，この間は視聴者として数える
+
+
+class FrameBuffer(io.BufferedIOBase):
+    """
+    Picamera2 の JpegEncoder から JPEG を1枚ずつ受け取り，最新の1枚だけを保持する
+    count は受け取った画像の枚数(フレーム番号)で，新しい画像が届くたびに1つ増える
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.count = 0
+        self._listeners = []
+        self._streams = 0
+        self._last_touch = float('-inf')
+        self._last_stream_end = time.monotonic()
+        self._viewer_listeners = []
+
+    def add_listener(self, callback):
+        """画像が届くたびに callback() を呼ぶ (エンコーダーのスレッドから呼ばれる)"""
+        self._listeners.append(callback)
+
+    def write(self, buf):
+        with self.condition:
+            self.frame = buf
+            self.count += 1
+            self.condition.notify_all()
+        for callback in self._listeners:
+            callback()
+        return len(buf)
+
+    def latest(self) -> tuple[int, bytes]:
+        """(フレーム番号, 最新の画像) を返す．まだ1枚も届いていなければ画像は None"""
+        with self.condition:
+            return self.count, self.frame
+
+    def wait_for_frame(self, count: int, timeout: float = None):
+        """
+        フレーム番号が count より新しい画像が届くまで待ち，(フレーム番号, 画像) を返す
+        timeout 秒以内に届かなければ None
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.count != count, timeout):
+                return None
+            return self.count, self.frame
+
+    # ----- 視聴者 -----
+    def add_viewer_listener(self, callback):
+        """誰も見ていない状態から見始められたときに callback() を呼ぶ (サーバーのスレッドから呼ばれる)"""
+        self._viewer_listeners.append(callback)
+
+    @contextlib.contextmanager
+    def watching(self):
+        """with camera_output.watching(): で囲んだ間，視聴者として数える (ストリーム)"""
+        with self.condition:
+            was_watched = self._watched_locked()
+            self._streams += 1
+        self._notify_viewer(was_watched)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self._streams -= 1
+                if self._streams == 0:
+                    self._last_stream_end = time.monotonic()
+
+    def touch(self):
+        """写真を1枚読まれた．VIEWER_TIMEOUT 秒の間，視聴者として数える"""
+        with self.condition:
+            was_watched = self._watched_locked()
+            self._last_touch = time.monotonic()
+        self._notify_viewer(was_watched)
+
+    def _watched_locked(self) -> bool:
+        return self._streams > 0 or time.monotonic() - self._last_touch < VIEWER_TIMEOUT
+
+    def _notify_viewer(self, was_watched: bool):
+        if not was_watched:
+            for callback in self._viewer_listeners:
+                callback()
+
+    def viewers(self) -> int:
+        """今の視聴者の数 (写真を読みに来るクライアントは，まとめて1と数える)"""
+        with self.condition:
+            return self._streams + (time.monotonic() - self._last_touch < VIEWER_TIMEOUT)
+
+    def idle_for(self) -> float:
+        """誰も見なくなってからの秒数．今見ている人がいれば 0"""
+        with self.condition:
+            if self._watched_locked():
+                return 0.0
+            return time.monotonic() - max(self._last_stream_end, self._last_touch + VIEWER_TIMEOUT)
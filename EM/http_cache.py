@@ -0,0 +1,24 @@
+# GUI用のサーバーで，変わっていないデータを送り直さないための条件付きGET(ETag / If-None-Match)のモジュールです
+# ブラウザは camera.jpg と data_to_browser.json を1秒ごとに読み込むので，機体が止まっていても同じバイト列を送り続けていました
+# ETag にはカメラのフレーム番号や共有データのバージョンを使い，変わっていなければ 304 Not Modified だけを返します
+
+import os
+
+# サーバーを起動するたびに変わる値．再起動でフレーム番号が0に戻っても，前のETagと一致しないようにする
+INSTANCE_ID = os.urandom(4).hex()
+
+
+def make_etag(name: str, version: int) -> str:
+    """name (camera / state) と version から ETag を作る"""
+    return f'"{INSTANCE_ID}-{name}-{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match ヘッダーに etag が含まれていれば True (弱いETag W/ も同じものとして扱う)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
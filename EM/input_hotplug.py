@@ -0,0 +1,246 @@
+# コントローラー(evdev のデバイス)がつながったことを，すぐに見つけるためのモジュールです
+# これまでの find_controller() は，2秒ごとに /dev/input の全部のデバイスを開き直して名前を調べていたので，
+# Bluetooth がつなぎ直されてから操作できるようになるまで，最大で2秒余計にかかっていました
+#
+# ・inotify で /dev/input を監視し，デバイスのファイルが作られた(権限が変わった)ときだけ調べ直す
+# ・一度調べたデバイスが探しているものかどうかはパスごとに覚えておき，ファイルが消えるか作り直されるまで開き直さない
+# ・DS4 は 'Wireless Controller' のほかに 'Wireless Controller Touchpad' と 'Wireless Controller Motion Sensors' の
+#   デバイスも作るので，名前だけでなく，スティック(ABS_X / ABS_Y)と×ボタン(BTN_SOUTH)があるかも調べる
+# ・デバイスは番号順(event2, event8, event10 …)に調べる
+# ・切断(lost())からつながる(wait() が戻る)までの時間を記録し，stats() で返す
+# ・inotify が使えない環境では，これまでどおり POLL_INTERVAL ごとに調べる
+#
+# 例：watcher = ControllerWatcher('Wireless Controller')
+#     device = watcher.wait()  # つながるまで待つ
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+import evdev
+
+INPUT_DIR = '/dev/input'
+POLL_INTERVAL = 2.0  # [s] inotify が使えないときに調べる間隔
+RESCAN_INTERVAL = 30.0  # [s] inotify が使えるときも，念のためこの間隔で調べ直す
+
+# <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def event_index(path: str) -> tuple:
+    """/dev/input/event10 → (10, path)．番号順に並べるためのキー (文字列のままだと event10 が event8 より前になる)"""
+    digits = path[len(path.rstrip('0123456789')):]
+    return (int(digits) if digits else -1, path)
+
+
+def is_gamepad(device) -> bool:
+    """スティックの X / Y 軸と×ボタン(BTN_SOUTH)があるデバイスか (タッチパッドやモーションセンサーを除く)"""
+    capabilities = device.capabilities()
+    axes = {code if isinstance(code, int) else code[0] for code in capabilities.get(evdev.ecodes.EV_ABS, [])}
+    return {evdev.ecodes.ABS_X, evdev.ecodes.ABS_Y} <= axes and evdev.ecodes.BTN_SOUTH in capabilities.get(evdev.ecodes.EV_KEY, [])
+
+
+def open_inotify(path: str = INPUT_DIR):
+    """path を監視する inotify のファイルディスクリプタ．使えなければ None"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path.encode(), IN_CREATE | IN_ATTRIB | IN_DELETE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def read_inotify(fd: int) -> list:
+    """届いている inotify のイベントを全部読み，変化のあったファイル名の一覧を返す"""
+    names = []
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.append(data[offset:offset + length].rstrip(b'\0').decode(errors='replace'))
+            offset += length
+
+
+class ControllerWatcher:
+    """
+    名前に name を含む evdev のデバイスを探す
+    wait() / wait_async() はつながるまで待ち，開いた InputDevice を返す
+    """
+
+    def __init__(self, name: str, *, logger=None):
+        self.name = name
+        self.logger = logger
+        self._fd = open_inotify()
+        self._lock = threading.Lock()
+        self._known = {}  # パス → 探しているデバイスか (調べたもの)
+        self._stale = set()  # 切断したデバイスのパス (消えるか作り直されるまで開かない)
+        self._lost_at = time.monotonic()  # 起動時も「切断中」として数える
+        self.probes = 0
+        self.cache_hits = 0
+        self.events = 0
+        self.reconnects = 0
+        self.last_reconnect = None
+        self.max_reconnect = None
+        self._total_reconnect = 0.0
+        if self._fd is None and self.logger is not None:
+            self.logger.warning('inotify が使えないため，%.0f 秒ごとにコントローラーを探します', POLL_INTERVAL)
+
+    # ----- 探す -----
+    def matches(self, device) -> bool:
+        """探しているコントローラーか (名前に name を含み，スティックと×ボタンがある)"""
+        return self.name in device.name and is_gamepad(device)
+
+    def _probe(self, path: str):
+        """path のデバイスを開いて，探しているものかどうかを覚える．探しているデバイスなら開いたまま返す"""
+        self.probes += 1
+        try:
+            device = evdev.InputDevice(path)
+            match = self.matches(device)
+        except OSError:
+            return None  # 権限がまだ設定されていないなど．IN_ATTRIB で調べ直す
+        with self._lock:
+            self._known[path] = match
+        if match:
+            return device
+        device.close()
+        return None
+
+    def find(self):
+        """つながっていれば開いた InputDevice，なければ None (調べたことのないデバイスだけを開く)"""
+        paths = sorted(evdev.list_devices(), key=event_index)
+        with self._lock:
+            self._stale &= set(paths)
+        for path in paths:
+            with self._lock:
+                if path in self._stale:
+                    continue
+                match = self._known.get(path)
+            if match is None:
+                device = self._probe(path)
+            else:
+                self.cache_hits += 1
+                if not match:
+                    continue
+                try:
+                    device = evdev.InputDevice(path)
+                except OSError:
+                    self._forget(os.path.basename(path))
+                    continue
+            if device is not None:
+                self._connected()
+                return device
+        return None
+
+    def _forget(self, filename: str):
+        path = os.path.join(INPUT_DIR, filename)
+        with self._lock:
+            self._known.pop(path, None)
+            self._stale.discard(path)
+
+    def _drain(self):
+        """inotify のイベントを読み，作り直された・消えたデバイスの名前を忘れる"""
+        for filename in read_inotify(self._fd):
+            self.events += 1
+            self._forget(filename)
+
+    # ----- 待つ -----
+    def wait(self, timeout: float = None):
+        """つながるまで待つ．timeout 秒待ってもつながらなければ None"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            device = self.find()
+            if device is not None:
+                return device
+            interval = RESCAN_INTERVAL if self._fd is not None else POLL_INTERVAL
+            if deadline is not None:
+                interval = min(interval, deadline - time.monotonic())
+                if interval <= 0:
+                    return None
+            if self._fd is None:
+                time.sleep(interval)
+                continue
+            readable, _, _ = select.select([self._fd], [], [], interval)
+            if readable:
+                self._drain()
+
+    async def wait_async(self):
+        """wait() の asyncio 版"""
+        loop = asyncio.get_running_loop()
+        while True:
+            device = self.find()
+            if device is not None:
+                return device
+            if self._fd is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            changed = asyncio.Event()
+            loop.add_reader(self._fd, changed.set)
+            try:
+                await asyncio.wait_for(changed.wait(), RESCAN_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.remove_reader(self._fd)
+            self._drain()
+
+    # ----- 再接続の時間 -----
+    def lost(self, device=None):
+        """
+        コントローラーとの接続が切れたときに呼ぶ
+        device を渡すと，そのパスのファイルが消えるか作り直されるまで開き直さない (消える直前のファイルを開かないように)
+        """
+        self._lost_at = time.monotonic()
+        if device is not None:
+            with self._lock:
+                self._stale.add(device.path)
+
+    def _connected(self):
+        if self._lost_at is None:
+            return
+        elapsed = time.monotonic() - self._lost_at
+        self._lost_at = None
+        self.reconnects += 1
+        self.last_reconnect = elapsed
+        self.max_reconnect = elapsed if self.max_reconnect is None else max(self.max_reconnect, elapsed)
+        self._total_reconnect += elapsed
+        if self.logger is not None:
+            self.logger.info('コントローラーが %.2f 秒でつながりました', elapsed)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計 (reconnect は切断から次につながるまで．最初の接続は起動から)"""
+        return {
+            'inotify': self._fd is not None,
+            'known_devices': len(self._known),
+            'probes': self.probes,
+            'cache_hits': self.cache_hits,
+            'events': self.events,
+            'reconnects': self.reconnects,
+            'last_reconnect_s': self.last_reconnect,
+            'max_reconnect_s': self.max_reconnect,
+            'mean_reconnect_s': self._total_reconnect / self.reconnects if self.reconnects else None,
+        }
@@ -0,0 +1,80 @@
+# 入力からモーター出力までの遅れを，ヒストグラムで記録するためのモジュールです
+# 「カメラを動かしているとステアリングが遅れる」という声に，数字で答えられるようにします
+#
+# ・値を1つずつ保存せず，対数で区切ったビンの個数を数えるだけなので，何時間動かしてもメモリは増えない
+# ・ビンの幅は GROWTH 倍ずつ広がるので，パーセンタイルの誤差は 5% 程度
+# ・最大値だけは正確に覚えておく
+
+import math
+import threading
+
+MIN_VALUE = 1e-5  # [s] これより短い遅れは最初のビンに入れる
+MAX_VALUE = 100.0  # [s] これより長い遅れは最後のビンに入れる
+GROWTH = 1.1  # 隣のビンとの幅の比
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    """record(秒) で遅れを記録し，stats() で p50/p95/p99/max をミリ秒で返す．どのスレッドから呼んでもよい"""
+
+    def __init__(self, min_value: float = MIN_VALUE, max_value: float = MAX_VALUE, growth: float = GROWTH):
+        self.min_value = min_value
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._counts = [0] * (int(math.log(max_value / min_value) / self._log_growth) + 2)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, value: float) -> int:
+        if value <= self.min_value:
+            return 0
+        return min(int(math.log(value / self.min_value) / self._log_growth) + 1, len(self._counts) - 1)
+
+    def _upper_bound(self, index: int) -> float:
+        return self.min_value * self.growth ** index
+
+    def record(self, seconds: float):
+        index = self._index(seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """p パーセンタイル [s] (そのビンの上端．最大値を超えることはない)"""
+        with self._lock:
+            return self._percentile_locked(p)
+
+    def _percentile_locked(self, p: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * len(self._counts)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計 (単位はミリ秒)"""
+        with self._lock:
+            result = {
+                'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            }
+            for p in PERCENTILES:
+                result[f'p{p}_ms'] = self._percentile_locked(p) * 1000
+            result['max_ms'] = self.max * 1000
+            return result
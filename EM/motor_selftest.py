@@ -0,0 +1,222 @@
+# 起動時のモーターの動作確認を，バックグラウンドで行うためのモジュールです
+# これまでの motor_calib() は，スレッドを起動する前に time.sleep(0.5) を何度も待っていたので，
+# 動作確認が終わるまでカメラもサーバーもコントローラーも使えませんでした
+# (本番中に電圧が下がって再起動したとき，操作できるようになるまでが長い)
+#
+# ・左右のモーターを 0 → 1 → -1 → 0 と順に動かす．指令は調停(CommandArbiter)の 'selftest' として送る
+#   'selftest' の優先度をいちばん高くしておけば，確認中にほかの指令が割り込むことはない
+# ・コントローラーやブラウザから 0 でない指令が届いたら，すぐに中止して操作を譲る
+# ・各段階で，GPIO ピンに実際に出ている PWM のデューティ比を pigpio デーモンから読み返し，指令と違えば失敗とする
+#   (gpiozero の Motor.value は書き込んだ値を覚えているだけなので，読み返しても何も確かめられない)
+#   読み返せるのはピンの出力まで．モータードライバーや配線，モーター自体の故障は，電流やエンコーダーがないと分からない
+# ・読み返す方法がないとき(read_outputs=None)は，合否を出さずに「何段階動かしたか」だけを報告する (state は 'ran')
+# ・結果は state / stats() で見られる
+# ・スレッドで動かすときは start()，asyncio のイベントループで動かすときは run_async() を使う
+
+import asyncio
+import threading
+import time
+
+SOURCE = 'selftest'
+RAMP_STEP = 0.2  # 1段階で変える出力
+RAMP_TIME = 0.05  # [s] 1段階の時間
+HOLD_TIME = 0.5  # [s] 1, -1, 0 に着いたあと待つ時間
+POLL_INTERVAL = 0.05  # [s] 待っている間に，ほかの入力元の指令を確かめる間隔
+TOLERANCE = 0.01  # 指令と読み返した値の差がこれより大きければ失敗
+
+# state の値
+PENDING = 'pending'
+RUNNING = 'running'
+PASSED = 'passed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+SKIPPED = 'skipped'
+RAN = 'ran'  # 読み返す方法がないので，動かしただけ (合否は分からない)
+
+
+def _ramp(start: float, end: float) -> list:
+    count = max(1, round(abs(end - start) / RAMP_STEP))
+    return [round(start + (end - start) * i / count, 6) for i in range(1, count + 1)]
+
+
+def make_steps() -> list:
+    """(モーター名, 出力, 待つ時間) の列．右 → 左の順に 0 → 1 → -1 → 0"""
+    steps = []
+    for motor in ('motor_r', 'motor_l'):
+        for start, end in ((0.0, 1.0), (1.0, -1.0), (-1.0, 0.0)):
+            ramp = _ramp(start, end)
+            steps += [(motor, value, RAMP_TIME) for value in ramp[:-1]]
+            steps.append((motor, ramp[-1], HOLD_TIME))
+    return steps
+
+
+def pigpio_readback(motors: dict):
+    """
+    motors {'motor_l': Motor, 'motor_r': Motor} の出力(-1~1)を，pigpio デーモンから GPIO ピンの実際のデューティ比として読む関数
+    (前進側のピン - 後退側のピン)．PiGPIOFactory 以外のモーターがあれば None (ピンの状態を読み返せない)
+    """
+    try:
+        from gpiozero.pins.pigpio import PiGPIOFactory
+    except ImportError:
+        return None
+    for motor in motors.values():
+        for device in (motor.forward_device, motor.backward_device):
+            if not isinstance(device.pin.factory, PiGPIOFactory):
+                return None
+
+    def read_outputs() -> dict:
+        # PiGPIOPin.state はデーモンに get_PWM_dutycycle() を問い合わせる
+        return {name: motor.forward_device.pin.state - motor.backward_device.pin.state for name, motor in motors.items()}
+    return read_outputs
+
+
+class MotorSelfTest:
+    """
+    arbiter: CommandArbiter ('selftest' をいちばん高い優先度で登録しておく)
+    read_outputs: モーターの実際の出力を {'motor_l': ..., 'motor_r': ...} で返す関数 (pigpio_readback())
+                  None なら読み返さず，state は PASSED / FAILED ではなく RAN になる
+    on_change: state が変わるたびに state を渡して呼ぶ (ブラウザへの表示など)
+    """
+
+    def __init__(self, arbiter, read_outputs, *, on_change=None, logger=None):
+        self.arbiter = arbiter
+        self.read_outputs = read_outputs
+        self.on_change = on_change
+        self.logger = logger
+        self.state = PENDING
+        self.message = ''
+        self.started = None
+        self.elapsed = 0.0
+        self._steps = make_steps()
+        self._done = 0
+        self._cancel = threading.Event()
+
+    # ----- 開始・中止 -----
+    def start(self) -> threading.Thread:
+        """バックグラウンドのスレッドで動作確認を始めて，すぐに戻る"""
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def skip(self):
+        """FAST_START のとき．動作確認をせずに操作できるようにする"""
+        self._finish(SKIPPED, 'skipped (fast start)')
+
+    def cancel(self, reason: str = 'cancelled'):
+        """動作確認を中止する (どのスレッドから呼んでもよい)"""
+        self.message = reason
+        self._cancel.set()
+
+    # ----- 実行 -----
+    def run(self):
+        self._begin()
+        try:
+            for motor, value, duration in self._steps:
+                if not self._apply(motor, value):
+                    break
+                deadline = time.monotonic() + duration
+                while not self._should_stop():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cancel.wait(min(POLL_INTERVAL, remaining))
+                if not self._check(motor, value):
+                    break
+        except Exception as e:
+            self._finish(FAILED, f'{type(e).__name__}: {e}')
+        finally:
+            self._end()
+
+    async def run_async(self):
+        """run() の asyncio 版．AsyncRuntime.add_task() に渡す"""
+        self._begin()
+        try:
+            for motor, value, duration in self._steps:
+                if not self._apply(motor, value):
+                    break
+                deadline = time.monotonic() + duration
+                while not self._should_stop():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    await asyncio.sleep(min(POLL_INTERVAL, remaining))
+                if not self._check(motor, value):
+                    break
+        except Exception as e:
+            self._finish(FAILED, f'{type(e).__name__}: {e}')
+        finally:
+            self._end()
+
+    def _begin(self):
+        self.started = time.monotonic()
+        self._set_state(RUNNING)
+
+    def _apply(self, motor: str, value: float) -> bool:
+        if self._should_stop():
+            return False
+        command = {'motor_l': 0.0, 'motor_r': 0.0}
+        command[motor] = value
+        self.arbiter.push(SOURCE, **command)
+        return True
+
+    def _check(self, motor: str, value: float) -> bool:
+        """読み返した値が指令どおりなら True (読み返せないときは，動かした段階を数えるだけ)"""
+        if self._should_stop():
+            return False
+        if self.read_outputs is None:
+            self._done += 1
+            return True
+        actual = self.read_outputs().get(motor)
+        if actual is None or abs(actual - value) > TOLERANCE:
+            self._finish(FAILED, f'{motor}: commanded {value:.2f}, read back {actual}')
+            return False
+        self._done += 1
+        return True
+
+    def _should_stop(self) -> bool:
+        if self.state != RUNNING:
+            return True
+        if not self._cancel.is_set():
+            # コントローラーやブラウザが操作を始めたら，すぐに譲る
+            for source in self.arbiter.priorities:
+                if source != SOURCE and any(self.arbiter.command(source).values()):
+                    self.cancel(f'{source} took over')
+                    break
+        if self._cancel.is_set():
+            self._finish(CANCELLED, self.message)
+            return True
+        return False
+
+    def _end(self):
+        # モーターを止めてから，ほかの入力元に譲る (hold_off を待たせない)
+        self.arbiter.push(SOURCE, motor_l=0.0, motor_r=0.0)
+        self.arbiter.release(SOURCE)
+        if self.read_outputs is None:
+            self._finish(RAN, f'ran {self._done} steps (no feedback)')
+        else:
+            self._finish(PASSED, f'{self._done} steps (GPIO PWM read back)')
+
+    def _finish(self, state: str, message: str):
+        if self.state in (PASSED, FAILED, CANCELLED, SKIPPED, RAN):
+            return  # 最初の結果を残す
+        self.message = message
+        if self.started is not None:
+            self.elapsed = time.monotonic() - self.started
+        self._set_state(state)
+
+    def _set_state(self, state: str):
+        self.state = state
+        if self.logger is not None:
+            self.logger.info('モーターの動作確認: %s %s', state, self.message)
+        if self.on_change is not None:
+            self.on_change(state)
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計"""
+        return {
+            'state': self.state,
+            'message': self.message,
+            'steps_done': self._done,
+            'steps_total': len(self._steps),
+            'elapsed_s': self.elapsed,
+        }
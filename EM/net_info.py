@@ -0,0 +1,127 @@
+# 機体のローカルIPアドレスを調べるためのモジュールです
+# これまでは start_gui をインポートしたときに，シェル経由で ip addr を実行して文字列を解析していました
+# (インポートが遅く，Wi-Fi がつなぎ直されてアドレスが変わっても，表示されるアドレスは古いままでした)
+#
+# ・アドレスはソケットの ioctl(SIOCGIFADDR) で，インターフェースごとに直接読む．外部のコマンドは使わない
+# ・調べるのは最初に必要になったとき．結果は覚えておく
+# ・netlink でインターフェースやアドレスの変化を受け取り，変わったら調べ直して callback を呼ぶ
+# ・Linux 以外では socket.gethostbyname() で調べる
+
+import socket
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Linux 以外
+    fcntl = None
+
+SIOCGIFADDR = 0x8915
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+ROUTE_PROBE = ('192.0.2.1', 9)  # 既定の経路を調べるための宛先 (実際には送信しない)
+
+
+def interface_addresses() -> dict:
+    """{インターフェース名: IPv4アドレス} (アドレスのないインターフェースとループバックは入らない)"""
+    if fcntl is None or not hasattr(socket, 'if_nameindex'):
+        return {}
+    addresses = {}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            try:
+                ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', name.encode()[:15]))
+            except OSError:
+                continue  # アドレスがない (つながっていない)
+            address = socket.inet_ntoa(ifreq[20:24])
+            if not address.startswith('127.'):
+                addresses[name] = address
+    return addresses
+
+
+def route_address() -> str:
+    """既定の経路で使われるアドレス．経路がなければ '' (UDP の connect は経路を選ぶだけで，パケットは送らない)"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(ROUTE_PROBE)
+            address = sock.getsockname()[0]
+    except OSError:
+        return ''
+    return '' if address.startswith(('0.', '127.')) else address
+
+
+def primary_address() -> str:
+    """ブラウザからつなぐときのアドレス．既定の経路のアドレス，なければ最後のインターフェースのアドレス"""
+    address = route_address()
+    if address:
+        return address
+    addresses = interface_addresses()
+    if addresses:
+        return list(addresses.values())[-1]  # ip addr の最後の inet と同じ (wlan0 など)
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except OSError:
+        return ''
+
+
+class AddressWatcher:
+    """
+    address で今のアドレスを返す．最初に読んだときに調べ，start() のあとはネットワークが変わるたびに調べ直す
+    on_change(address) はアドレスが変わったときに，監視のスレッドから呼ばれる
+    """
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._address = None  # None: まだ調べていない
+        self.changes = 0
+        self._thread = None
+
+    @property
+    def address(self) -> str:
+        with self._lock:
+            if self._address is None:
+                self._address = primary_address()
+            return self._address
+
+    def refresh(self) -> str:
+        """調べ直す．変わっていれば on_change を呼ぶ"""
+        address = primary_address()
+        with self._lock:
+            changed = self._address is not None and address != self._address
+            self._address = address
+            if changed:
+                self.changes += 1
+        if changed and self.on_change is not None:
+            self.on_change(address)
+        return address
+
+    def start(self) -> bool:
+        """netlink の監視を始める．使えない環境なら False (address は最初に調べた値のまま)"""
+        if self._thread is not None:
+            return True
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        except (AttributeError, OSError):
+            return False
+        self._thread = threading.Thread(target=self._watch, args=(sock,), daemon=True)
+        self._thread.start()
+        return True
+
+    def _watch(self, sock):
+        with sock:
+            while True:
+                try:
+                    sock.recv(65536)  # 中身は見ない．何か変わったら調べ直す
+                    sock.settimeout(0.2)
+                    # DHCP などで続けて届く通知は，まとめて1回にする
+                    while True:
+                        try:
+                            sock.recv(65536)
+                        except socket.timeout:
+                            break
+                    sock.settimeout(None)
+                    self.refresh()
+                except OSError:
+                    return
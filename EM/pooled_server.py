@@ -0,0 +1,204 @@
+# GUI用のHTTPサーバーを，決まった数のワーカースレッドで並行処理するためのモジュールです
+# socketserver.TCPServer は1リクエストずつしか処理できないので，
+# 遅いスマホが camera.jpg を受信している間，ほかのブラウザの操作(POST)が止まってしまいます
+#
+# ・ワーカーは max_workers 本だけ起動し，それ以上は増やさない
+# ・HTTP/1.1 の持続的接続(keep-alive)に対応する
+# ・次のリクエストを待っているだけの接続はワーカーを占有せず，selectorで待機させる
+#   受信用のバッファ(rfile)は接続と一緒に残す．パイプラインで先に届いていたリクエストは，待たせずにすぐ処理する
+# ・MJPEGのストリームなど長時間続く送信は，ワーカーから切り離した専用スレッドで行う
+
+import queue
+import selectors
+import socket
+import socketserver
+import threading
+import time
+
+MAX_WORKERS = 8  # ワーカースレッドの数
+MAX_PENDING = 64  # 処理待ちの接続がこれを超えたら，新しい接続を断る
+KEEP_ALIVE_TIMEOUT = 15  # [s] 次のリクエストが来ない接続を閉じるまでの時間
+REQUEST_TIMEOUT = 10  # [s] リクエストの受信・レスポンスの送信のタイムアウト
+MAX_DETACHED = 64  # 専用スレッドに切り離せる接続の数 (ブラウザ1台で WebSocket とストリームの2つ)
+
+
+class KeepAliveHandlerMixin:
+    """
+    PooledHTTPServer 用のハンドラに混ぜて使う
+    1回の呼び出しでは1リクエストだけ処理し，接続の維持はサーバー側に任せる
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = REQUEST_TIMEOUT
+    detached = False
+
+    def setup(self):
+        super().setup()
+        # ヘッダーと本文を別々に送るので，Nagleアルゴリズムで遅れないようにする
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # 前のリクエストのときに読み込んでいたバッファを使い続ける (先に届いていたリクエストを捨てないように)
+        reader = self.server.take_reader(self.request)
+        if reader is not None:
+            self.rfile.close()
+            self.rfile = reader
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        if self.detached:
+            return
+        if self.close_connection:
+            super().finish()
+            return
+        # 接続を続けるときは，受信用のバッファを閉じずにサーバーに預ける
+        try:
+            self.wfile.flush()
+        except OSError:
+            pass
+        self.wfile.close()
+        self.server.keep_reader(self.request, self.rfile)
+
+    def pending(self) -> bool:
+        """次のリクエストがすでに届いているか (パイプライン)．待たずに調べる"""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except (OSError, ValueError):
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def detach(self, target) -> bool:
+        """
+        長時間続く送信を，ワーカーから切り離した専用スレッドの target() で行う
+        切り離せる数を超えていたら何もせず False を返す
+        """
+        if not self.server.detached_slots.acquire(blocking=False):
+            return False
+        self.detached = True
+        self.close_connection = True
+        threading.Thread(target=self._run_detached, args=(target,), daemon=True).start()
+        return True
+
+    def _run_detached(self, target):
+        try:
+            target()
+        except (ConnectionError, TimeoutError):
+            pass  # ブラウザが閉じられた
+        except Exception:
+            self.server.handle_error(self.request, self.client_address)
+        finally:
+            try:
+                super().finish()
+            except OSError:
+                pass
+            self.server.shutdown_request(self.request)
+            self.server.detached_slots.release()
+
+
+class PooledHTTPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+    request_queue_size = MAX_PENDING
+
+    def __init__(self, server_address, RequestHandlerClass, *, max_workers: int = MAX_WORKERS, max_pending: int = MAX_PENDING, max_detached: int = MAX_DETACHED):
+        super().__init__(server_address, RequestHandlerClass)
+        self.max_pending = max_pending
+        self.detached_slots = threading.BoundedSemaphore(max_detached)
+        self._ready = queue.SimpleQueue()  # リクエストを処理できる接続
+        self._parking = queue.SimpleQueue()  # keep-alive で次のリクエストを待たせる接続
+        self._readers = {}  # 接続 → 受信用のバッファ (keep-alive の間，ハンドラをまたいで使う)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._closed = False
+
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max_workers)]
+        self._threads.append(threading.Thread(target=self._watch_idle, daemon=True))
+        for t in self._threads:
+            t.start()
+
+    # serve_forever() から新しい接続ごとに呼ばれる
+    def process_request(self, request, client_address):
+        if self._ready.qsize() >= self.max_pending:
+            # 混みすぎているので断る
+            self.shutdown_request(request)
+            return
+        self._ready.put((request, client_address))
+
+    def _worker(self):
+        while True:
+            item = self._ready.get()
+            if item is None:
+                return
+            request, client_address = item
+            handler = None
+            try:
+                handler = self.RequestHandlerClass(request, client_address, self)
+            except Exception:
+                self.handle_error(request, client_address)
+            if handler is not None and handler.detached:
+                continue  # 専用スレッドが接続を閉じる
+            if handler is not None and not handler.close_connection and not self._closed:
+                if handler.pending():
+                    self._ready.put((request, client_address))  # バッファに届いている分は select では分からない
+                    continue
+                self._parking.put((request, client_address))
+                self._wakeup_w.send(b"\0")
+            else:
+                self.shutdown_request(request)
+
+    def keep_reader(self, request, reader):
+        self._readers[request] = reader
+
+    def take_reader(self, request):
+        return self._readers.pop(request, None)
+
+    def shutdown_request(self, request):
+        reader = self._readers.pop(request, None)
+        if reader is not None:
+            reader.close()
+        super().shutdown_request(request)
+
+    # 次のリクエストを待っている接続を監視し，データが届いたらワーカーに渡す
+    def _watch_idle(self):
+        deadlines = {}
+        while not self._closed:
+            while not self._parking.empty():
+                request, client_address = self._parking.get()
+                self._selector.register(request, selectors.EVENT_READ, client_address)
+                deadlines[request] = time.monotonic() + KEEP_ALIVE_TIMEOUT
+
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self._selector.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                self._ready.put((key.fileobj, key.data))
+
+            now = time.monotonic()
+            for request in [r for r, d in deadlines.items() if d < now]:
+                self._selector.unregister(request)
+                del deadlines[request]
+                self.shutdown_request(request)
+
+        for request in deadlines:
+            self.shutdown_request(request)
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def server_close(self):
+        self._closed = True
+        super().server_close()
+        for _ in range(len(self._threads) - 1):
+            self._ready.put(None)
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass  # 監視スレッドがすでに終了している
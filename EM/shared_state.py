@@ -0,0 +1,97 @@
+# ブラウザとやり取りするデータをメモリ上で共有するためのモジュールです
+# start_gui の HTTP ハンドラと fm.py の制御ループが同じ SharedState を直接読み書きするので，
+# data_from_browser.json / data_to_browser.json をSDカードに書き込む必要がありません
+
+import json
+import threading
+import time
+
+
+class SharedState:
+    """
+    スレッドセーフでバージョン付きの共有データ
+    from_browser: ブラウザから受信した操作 (motor_l, motor_r, light, buzzer)
+    to_browser:   ブラウザへ送信するテレメトリ (motor_l, motor_r, lat, lon, grav, mag, local_ip など)
+    値が変わるたびにバージョンが1つ増えます
+    """
+
+    def __init__(self, from_browser: dict, to_browser: dict):
+        self._cond = threading.Condition()
+        self._from_browser = dict(from_browser)
+        self._to_browser = dict(to_browser)
+        self._to_browser_json = None  # to_browser をJSONにしたもののキャッシュ
+        self.from_version = 0
+        self.from_time = time.monotonic()  # 最後にブラウザから操作が届いた時刻 (time.monotonic())
+        self.to_version = 0
+        self._listeners = []
+        self._stats = {}
+
+    def add_listener(self, callback):
+        """値が変わるたびに callback() を呼ぶ (変更したスレッドから，ロックの外で呼ばれる)"""
+        self._listeners.append(callback)
+
+    def _notify_listeners(self):
+        for callback in self._listeners:
+            callback()
+
+    # ----- ブラウザ → マイコン -----
+    def set_from_browser(self, data: dict) -> int:
+        with self._cond:
+            self._from_browser.update(data)
+            self.from_version += 1
+            self.from_time = time.monotonic()
+            version = self.from_version
+            self._cond.notify_all()
+        self._notify_listeners()
+        return version
+
+    def get_from_browser(self) -> tuple[int, dict]:
+        with self._cond:
+            return self.from_version, dict(self._from_browser)
+
+    def get_from_browser_timed(self) -> tuple[int, float, dict]:
+        """(バージョン, 届いた時刻, 操作) を返す"""
+        with self._cond:
+            return self.from_version, self.from_time, dict(self._from_browser)
+
+    def wait_from_browser(self, version: int, timeout: float = None) -> bool:
+        """from_version が version から変わるまで待つ．変わったら True"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.from_version != version, timeout)
+
+    # ----- マイコン → ブラウザ -----
+    def update_to_browser(self, **values) -> int:
+        with self._cond:
+            if all(k in self._to_browser and self._to_browser[k] == v for k, v in values.items()):
+                return self.to_version  # 変化がなければバージョンはそのまま
+            self._to_browser.update(values)
+            self._to_browser_json = None
+            self.to_version += 1
+            version = self.to_version
+            self._cond.notify_all()
+        self._notify_listeners()
+        return version
+
+    def get_to_browser(self) -> tuple[int, dict]:
+        with self._cond:
+            return self.to_version, dict(self._to_browser)
+
+    def to_browser_json(self) -> tuple[int, bytes]:
+        """to_browser をJSONのバイト列で返す．同じバージョンの間は作り直さない"""
+        with self._cond:
+            if self._to_browser_json is None:
+                self._to_browser_json = json.dumps(self._to_browser).encode("utf-8")
+            return self.to_version, self._to_browser_json
+
+    def wait_to_browser(self, version: int, timeout: float = None) -> bool:
+        """to_version が version から変わるまで待つ．変わったら True"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.to_version != version, timeout)
+
+    # ----- 実行中の統計 (/stats.json で見られる) -----
+    def add_stats(self, name: str, provider):
+        """provider() が返す dict を，/stats.json の name の項目として公開する"""
+        self._stats[name] = provider
+
+    def get_stats(self) -> dict:
+        return {name: provider() for name, provider in self._stats.items()}
@@ -0,0 +1,336 @@
+# カメラの撮影とJPEGへの変換を，別のプロセスで行うためのモジュールです
+# これまではカメラも fm.py と同じプロセスのスレッドで動いていたので，モーターの制御やGUI用のサーバーと GIL を取り合い，
+# カメラを動かすと制御の周期がぶれていました
+#
+# ・撮影用のプロセス(このファイルを python で実行する)が，JPEG を共有メモリ(multiprocessing.shared_memory)に書く
+# ・共有メモリは2枚ぶんの領域(ダブルバッファ)とフレーム番号．書く側は使っていない方に書いてからフレーム番号を進める
+#   領域ごとの番号(書き込み中は奇数)を読む前後で比べ，読んでいる間に書き換えられていたら読み直す (seqlock)
+# ・書いたことはパイプで1バイト送って知らせる．受け取る側のスレッドは read で待つので，その間 GIL を使わない
+# ・受け取った JPEG は共有メモリから1回だけコピーして FrameBuffer に渡す (pickle やパイプで画像を送らない)
+#   画像を共有メモリのまま渡さないのは，遅いブラウザに送っている途中で2枚後の画像に書き換えられてしまうため
+# ・視聴者の数(camera_power.py)は，fm.py 側の FrameBuffer から共有メモリに書き写し，撮影用のプロセスに伝える
+#
+# 例：camera = CameraProcess(start_gui.camera_output, logger=logger)
+#     camera.run()  # 撮影用のプロセスを起動し，画像を受け取り続ける (戻らない)
+
+import argparse
+import atexit
+import io
+import logging
+import os
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+FRAME_CAPACITY = 1 << 20  # [byte] 1枚の JPEG の最大の大きさ (これより大きい画像は捨てる)
+VIEWER_SYNC_INTERVAL = 0.5  # [s] 画像が届かなくても，この間隔で視聴者の数を書き写す
+RESTART_DELAY = 2.0  # [s] 撮影用のプロセスが終わってしまったときに，起動し直すまでの時間
+READ_RETRIES = 3  # 読んでいる間に書き換えられたときに読み直す回数
+
+# 共有メモリの先頭: フレーム番号, 視聴者の数, 大きすぎて捨てた画像の数, 視聴者がいなくなった時刻 (time.monotonic())
+HEADER = struct.Struct('=QIId')
+HEADER_SIZE = 64
+SEQ = struct.Struct('=Q')  # HEADER のうち，フレーム番号だけを読み書きする (書く側ごとに自分の項目だけを書く)
+VIEWERS = struct.Struct('=I')
+VIEWERS_OFFSET = 8
+OVERSIZE = struct.Struct('=I')
+OVERSIZE_OFFSET = 12
+IDLE_SINCE = struct.Struct('=d')
+IDLE_SINCE_OFFSET = 16
+# 領域ごとの先頭: 領域の番号 (フレーム番号 n を書き終えたら 2n，書いている間は 2n-1), 画像の大きさ
+SLOT = struct.Struct('=QQ')
+
+
+class SharedFrames:
+    """
+    共有メモリ上のダブルバッファ
+    create=True で作る(fm.py 側)．name を渡すと，作られたものを開く(撮影用のプロセス側)
+    publish() は1つのプロセスだけが呼ぶ
+    """
+
+    def __init__(self, name: str = None, *, capacity: int = FRAME_CAPACITY, create: bool = False):
+        self.capacity = capacity
+        self._slot_size = SLOT.size + capacity
+        if create:
+            self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + 2 * self._slot_size)
+            HEADER.pack_into(self.shm.buf, 0, 0, 0, 0, time.monotonic())
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # 開いただけのプロセスが終わったときに，共有メモリが消されないようにする (作った側が消す)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.torn_reads = 0
+
+    def _slot(self, seq: int) -> int:
+        return HEADER_SIZE + (seq % 2) * self._slot_size
+
+    @property
+    def seq(self) -> int:
+        """書き終えた画像の枚数 (最新のフレーム番号)"""
+        return SEQ.unpack_from(self.shm.buf, 0)[0]
+
+    # ----- 撮影用のプロセス -----
+    def publish(self, frame) -> bool:
+        """使っていない方の領域に frame を書き，フレーム番号を進める．大きすぎれば捨てて False"""
+        buf = self.shm.buf
+        if len(frame) > self.capacity:
+            OVERSIZE.pack_into(buf, OVERSIZE_OFFSET, OVERSIZE.unpack_from(buf, OVERSIZE_OFFSET)[0] + 1)
+            return False
+        seq = SEQ.unpack_from(buf, 0)[0] + 1
+        offset = self._slot(seq)
+        SLOT.pack_into(buf, offset, 2 * seq - 1, 0)  # 書き込み中
+        start = offset + SLOT.size
+        buf[start:start + len(frame)] = frame
+        SLOT.pack_into(buf, offset, 2 * seq, len(frame))
+        SEQ.pack_into(buf, 0, seq)
+        return True
+
+    def viewers(self) -> int:
+        return VIEWERS.unpack_from(self.shm.buf, VIEWERS_OFFSET)[0]
+
+    def idle_for(self) -> float:
+        """fm.py 側で誰も見なくなってからの秒数．今見ている人がいれば 0 (FrameBuffer.idle_for() と同じ)"""
+        _, viewers, _, idle_since = HEADER.unpack_from(self.shm.buf, 0)
+        return 0.0 if viewers else max(0.0, time.monotonic() - idle_since)
+
+    # ----- fm.py 側 -----
+    def read(self, last: int = 0):
+        """フレーム番号が last より新しい画像があれば (フレーム番号, 画像のコピー)，なければ None"""
+        buf = self.shm.buf
+        for _ in range(READ_RETRIES):
+            seq = self.seq
+            if seq == last:
+                return None
+            offset = self._slot(seq)
+            slot_seq, length = SLOT.unpack_from(buf, offset)
+            if slot_seq == 2 * seq:
+                start = offset + SLOT.size
+                frame = bytes(buf[start:start + length])
+                if SLOT.unpack_from(buf, offset)[0] == slot_seq:
+                    return seq, frame
+            self.torn_reads += 1  # 読んでいる間に(2枚後の画像に)書き換えられた
+        return None
+
+    def set_viewers(self, viewers: int, idle_for: float):
+        """視聴者の数を書き写す (フレーム番号は撮影用のプロセスが書くので，そこには書かない)"""
+        IDLE_SINCE.pack_into(self.shm.buf, IDLE_SINCE_OFFSET, time.monotonic() - idle_for)
+        VIEWERS.pack_into(self.shm.buf, VIEWERS_OFFSET, viewers)
+
+    def oversize(self) -> int:
+        return OVERSIZE.unpack_from(self.shm.buf, OVERSIZE_OFFSET)[0]
+
+    def close(self, *, unlink: bool = False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class SharedFrameOutput(io.BufferedIOBase):
+    """
+    撮影用のプロセスで，FrameBuffer の代わりにエンコーダーの出力先(FileOutput)にするもの
+    ViewerAwareCamera から見ると FrameBuffer と同じように，count，viewers()，idle_for()，add_viewer_listener() が使える
+    """
+
+    def __init__(self, frames: SharedFrames, notify_fd: int):
+        self.frames = frames
+        self._notify_fd = notify_fd
+        os.set_blocking(notify_fd, False)
+        self._viewer_listeners = []
+
+    @property
+    def count(self) -> int:
+        return self.frames.seq
+
+    def write(self, buf):
+        if self.frames.publish(buf):
+            try:
+                os.write(self._notify_fd, b'\0')
+            except BlockingIOError:
+                pass  # 知らせがたまっている．受け取る側はまとめて読むので，1回ぶん減っても困らない
+        return len(buf)
+
+    def viewers(self) -> int:
+        return self.frames.viewers()
+
+    def idle_for(self) -> float:
+        return self.frames.idle_for()
+
+    def add_viewer_listener(self, callback):
+        self._viewer_listeners.append(callback)
+
+    def wake(self):
+        """fm.py 側で見始められた"""
+        for callback in self._viewer_listeners:
+            callback()
+
+
+class CameraProcess:
+    """
+    fm.py 側．撮影用のプロセスを起動し，届いた画像を output (FrameBuffer) に書き込む
+    hflip / vflip: 画像の反転．idle_mode / stall_timeout: ViewerAwareCamera と同じ
+    """
+
+    def __init__(self, output, *, hflip: bool = False, vflip: bool = False, idle_mode: str = 'keepalive',
+                 stall_timeout: float = 5.0, capacity: int = FRAME_CAPACITY, logger=None):
+        self.output = output
+        self.options = ['--idle-mode', idle_mode, '--stall-timeout', str(stall_timeout), '--capacity', str(capacity)]
+        if hflip:
+            self.options.append('--hflip')
+        if vflip:
+            self.options.append('--vflip')
+        self.logger = logger
+        self.frames = SharedFrames(capacity=capacity, create=True)
+        self._notify_r = None
+        self._wake_w = None
+        self.process = None
+        self.seq = 0
+        self.received = 0
+        self.starts = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        output.add_viewer_listener(self._wake)
+        atexit.register(self.close)
+
+    def _sync_viewers(self):
+        self.frames.set_viewers(self.output.viewers(), self.output.idle_for())
+
+    def _wake(self):
+        """見始められたら，すぐに撮影用のプロセスに知らせる (サーバーのスレッドから呼ばれる)"""
+        self._sync_viewers()
+        with self._lock:
+            if self._wake_w is None:
+                return
+            try:
+                os.write(self._wake_w, b'\0')
+            except (BlockingIOError, BrokenPipeError):
+                pass
+
+    def start(self):
+        """撮影用のプロセスを起動する"""
+        self._sync_viewers()  # 起動してすぐ「誰も見ていない」と思われないように，先に書いておく
+        notify_r, notify_w = os.pipe()
+        wake_r, wake_w = os.pipe()
+        os.set_blocking(wake_w, False)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), self.frames.name, str(notify_w), str(wake_r), *self.options],
+            pass_fds=(notify_w, wake_r),
+        )
+        os.close(notify_w)
+        os.close(wake_r)
+        with self._lock:
+            self._close_pipes()
+            self._notify_r, self._wake_w = notify_r, wake_w
+        self.starts += 1
+        if self.logger is not None:
+            self.logger.info('カメラ: 撮影用のプロセスを起動しました (pid %d)', self.process.pid)
+
+    def _close_pipes(self):
+        for fd in (self._notify_r, self._wake_w):
+            if fd is not None:
+                os.close(fd)
+        self._notify_r = self._wake_w = None
+
+    def receive(self, timeout: float) -> bool:
+        """timeout 秒まで待ち，届いていた最新の画像を output に書き込む．撮影用のプロセスが終わっていれば False"""
+        readable, _, _ = select.select([self._notify_r], [], [], timeout)
+        if readable and not os.read(self._notify_r, 4096):
+            return False
+        self._sync_viewers()
+        new_frame = self.frames.read(self.seq)
+        if new_frame is not None:
+            self.seq, frame = new_frame
+            self.output.write(frame)
+            self.received += 1
+        return self.process.poll() is None
+
+    def run(self):
+        """撮影用のプロセスを起動し，画像を受け取り続ける．プロセスが終わってしまったら起動し直す (戻らない)"""
+        while not self.closed:
+            self.start()
+            while self.receive(VIEWER_SYNC_INTERVAL):
+                pass
+            code = self.process.wait()
+            if self.closed:
+                return
+            if self.logger is not None:
+                self.logger.error('<<エラー>>\nカメラ: 撮影用のプロセスが終了しました (終了コード %s)．%.0f 秒後に起動し直します', code, RESTART_DELAY)
+            time.sleep(RESTART_DELAY)
+
+    def close(self):
+        """撮影用のプロセスを止めて，共有メモリの名前を消す (終了時に自動で呼ばれる)"""
+        if self.closed:
+            return
+        self.closed = True
+        with self._lock:
+            if self._wake_w is not None:
+                os.close(self._wake_w)  # 撮影用のプロセスは wake のパイプが閉じられると終わる
+                self._wake_w = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        # 受け取るスレッドがまだ読んでいるかもしれないので，閉じずに名前だけを消す (プロセスが終われば解放される)
+        self.frames.shm.unlink()
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計"""
+        return {
+            'pid': None if self.process is None else self.process.pid,
+            'alive': self.process is not None and self.process.poll() is None,
+            'starts': self.starts,
+            'published': self.seq,
+            'received': self.received,
+            'torn_reads': self.frames.torn_reads,
+            'oversize': self.frames.oversize(),
+            'viewers': self.output.viewers(),
+        }
+
+
+# ----- 撮影用のプロセス -----
+def worker_main(argv=None):
+    parser = argparse.ArgumentParser(description='カメラの撮影用のプロセス (CameraProcess が起動する)')
+    parser.add_argument('shm_name')
+    parser.add_argument('notify_fd', type=int)
+    parser.add_argument('wake_fd', type=int)
+    parser.add_argument('--idle-mode', default='keepalive')
+    parser.add_argument('--stall-timeout', type=float, default=5.0)
+    parser.add_argument('--capacity', type=int, default=FRAME_CAPACITY)
+    parser.add_argument('--hflip', action='store_true')
+    parser.add_argument('--vflip', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s camera-worker %(levelname)s: %(message)s')
+    logger = logging.getLogger('camera-worker')
+
+    # picamera2 などは撮影用のプロセスでだけ使うので，ここでインポートする
+    from picamera2 import Picamera2
+    from camera_power import ViewerAwareCamera
+
+    frames = SharedFrames(args.shm_name, capacity=args.capacity)
+    output = SharedFrameOutput(frames, args.notify_fd)
+    picam2 = Picamera2()
+    config = picam2.create_preview_configuration()
+    if args.hflip or args.vflip:
+        import libcamera
+        config['transform'] = libcamera.Transform(hflip=int(args.hflip), vflip=int(args.vflip))
+    picam2.configure(config)
+    camera = ViewerAwareCamera(picam2, output, idle_mode=args.idle_mode, stall_timeout=args.stall_timeout, logger=logger)
+    threading.Thread(target=camera.run, daemon=True).start()
+
+    # fm.py からの「見始められた」を待つ．パイプが閉じられたら(fm.py が終わったら)終わる
+    while os.read(args.wake_fd, 64):
+        output.wake()
+    try:
+        picam2.stop_recording()
+    except Exception as e:
+        logger.error('stop_recording: %s', e)
+    frames.close()
+
+
+if __name__ == '__main__':
+    worker_main()
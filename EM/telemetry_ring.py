@@ -0,0 +1,213 @@
+# モーターに反映した指令を，バイナリで記録するためのモジュールです
+# これまでは DEBUG のログ(テキスト)しか残らず，fm.log が 100kB でローテーションされると消えていました
+#
+# ・1件は (時刻, motor_l, motor_r, throttle, steer, 入力元) の固定長 28 バイト
+# ・記録はメモリ上のリングバッファ(bytearray)に書くだけで，ファイルには触らない
+# ・バックグラウンドのスレッドが，たまった分をまとめてメモリマップしたファイル(これもリングバッファ)へコピーする
+#   SDカードへの実際の書き込みはOSがまとめて行う
+#
+# 記録を読むとき：python telemetry_ring.py telemetry.bin --tail 100
+
+import argparse
+import atexit
+import datetime
+import mmap
+import os
+import struct
+import threading
+import time
+
+RECORD = struct.Struct('<dffffB3x')  # 時刻[s], motor_l, motor_r, throttle, steer, 入力元の番号
+HEADER = struct.Struct('<4sHHIQ')  # マジックナンバー, バージョン, 1件のサイズ, ファイルに入る件数, これまでに書いた件数
+MAGIC = b'FMTL'
+VERSION = 1
+MAX_SOURCES = 8  # 記録できる入力元の種類
+SOURCE_NAME_SIZE = 16  # [byte] 入力元の名前の長さ
+HEADER_SIZE = 256  # [byte] HEADER と入力元の名前の表
+SOURCE_TABLE = struct.Struct('<' + f'{SOURCE_NAME_SIZE}s' * MAX_SOURCES)
+
+FILE_CAPACITY = 1 << 20  # ファイルに残す件数 (約 29MB．100Hz で書き続けても約3時間)
+BUFFER_CAPACITY = 4096  # メモリ上のリングバッファの件数
+FLUSH_INTERVAL = 1.0  # [s] ファイルへまとめてコピーする間隔
+
+
+class TelemetryRecorder:
+    """
+    record() はどのスレッドから呼んでもよい (ロックを取り，28バイトを書くだけ)
+    ファイルが同じ形式ですでにあれば，その続きに記録する
+    """
+
+    def __init__(self, path: str, *, file_capacity: int = FILE_CAPACITY, buffer_capacity: int = BUFFER_CAPACITY, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        # メモリ上のリングバッファ
+        self._buffer = bytearray(RECORD.size * buffer_capacity)
+        self._buffer_capacity = buffer_capacity
+        self._written = 0  # record() で書いた件数
+        self._flushed = 0  # そのうちファイルへコピーした件数
+        self.overwritten = 0  # ファイルへコピーする前に上書きされてしまった件数
+
+        self._file, self._map, self.file_capacity, self._total, self._sources = _open_file(path, file_capacity)
+
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, motor_l: float, motor_r: float, throttle: float, steer: float, source: str, timestamp: float = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            source_id = self._source_id(source)
+            RECORD.pack_into(self._buffer, (self._written % self._buffer_capacity) * RECORD.size, timestamp, motor_l, motor_r, throttle, steer, source_id)
+            self._written += 1
+
+    def _source_id(self, source: str) -> int:
+        try:
+            return self._sources.index(source)
+        except ValueError:
+            pass
+        if len(self._sources) >= MAX_SOURCES:
+            return MAX_SOURCES - 1  # 表がいっぱいなら最後の番号にまとめる
+        self._sources.append(source)
+        return len(self._sources) - 1
+
+    def flush(self):
+        """メモリ上にたまった記録を，まとめてファイルへコピーする"""
+        with self._flush_lock:
+            with self._lock:
+                written = self._written
+                start = max(self._flushed, written - self._buffer_capacity)
+                self.overwritten += start - self._flushed
+                chunk = _ring_slice(self._buffer, self._buffer_capacity, start, written)
+                sources = list(self._sources)
+            self._flushed = written
+            if not chunk or self._map is None:
+                return
+
+            # ファイル側のリングバッファへ，折り返しに気をつけてコピーする
+            count = len(chunk) // RECORD.size
+            if count > self.file_capacity:
+                chunk = chunk[-self.file_capacity * RECORD.size:]
+                self._total += count - self.file_capacity
+                count = self.file_capacity
+            position = self._total % self.file_capacity
+            first = min(count, self.file_capacity - position) * RECORD.size
+            offset = HEADER_SIZE + position * RECORD.size
+            self._map[offset:offset + first] = chunk[:first]
+            if first < len(chunk):
+                self._map[HEADER_SIZE:HEADER_SIZE + len(chunk) - first] = chunk[first:]
+            self._total += count
+
+            # 記録を書いてから件数を更新する
+            _write_header(self._map, self.file_capacity, self._total, sources)
+
+    def _run(self):
+        while not self._closed:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        with self._flush_lock:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.close()
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計"""
+        return {
+            'path': self.path,
+            'recorded': self._written,
+            'in_file': min(self._total, self.file_capacity),
+            'overwritten': self.overwritten,
+        }
+
+
+def _ring_slice(buffer, capacity: int, start: int, end: int) -> bytes:
+    """リングバッファの start 件目から end 件目の手前までを，つなげたバイト列で返す"""
+    if start >= end:
+        return b''
+    first = start % capacity
+    last = end % capacity
+    if first < last:
+        return bytes(buffer[first * RECORD.size:last * RECORD.size])
+    return bytes(buffer[first * RECORD.size:]) + bytes(buffer[:last * RECORD.size])
+
+
+def _write_header(buffer, capacity: int, total: int, sources: list):
+    names = [name.encode('utf-8')[:SOURCE_NAME_SIZE] for name in sources]
+    names += [b''] * (MAX_SOURCES - len(names))
+    SOURCE_TABLE.pack_into(buffer, HEADER.size, *names)
+    HEADER.pack_into(buffer, 0, MAGIC, VERSION, RECORD.size, capacity, total)
+
+
+def _read_header(buffer):
+    magic, version, record_size, capacity, total = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        return None
+    sources = [name.rstrip(b'\0').decode('utf-8') for name in SOURCE_TABLE.unpack_from(buffer, HEADER.size)]
+    return capacity, total, [name for name in sources if name]
+
+
+def _open_file(path: str, capacity: int):
+    """記録用のファイルを開いてメモリマップする．形式が違えば作り直す"""
+    size = HEADER_SIZE + RECORD.size * capacity
+    file = open(path, 'a+b')
+    header = None
+    if os.path.getsize(path) >= HEADER_SIZE:
+        file.seek(0)
+        header = _read_header(file.read(HEADER_SIZE))
+    if header is not None and os.path.getsize(path) == HEADER_SIZE + RECORD.size * header[0]:
+        capacity, total, sources = header
+    else:
+        file.truncate(0)
+        file.truncate(size)
+        total, sources = 0, []
+    file.flush()
+    buffer = mmap.mmap(file.fileno(), 0)
+    _write_header(buffer, capacity, total, sources)
+    return file, buffer, capacity, total, sources
+
+
+def read_records(path: str, tail: int = 0):
+    """記録を古い順に (時刻, motor_l, motor_r, throttle, steer, 入力元) で返す．tail を指定すると最後の tail 件だけ"""
+    with open(path, 'rb') as file:
+        data = file.read()
+    header = _read_header(data)
+    if header is None:
+        raise ValueError(f'{path} is not a telemetry file')
+    capacity, total, sources = header
+    count = min(total, capacity)
+    start = total % capacity if total > capacity else 0
+    if 0 < tail < count:
+        start += count - tail
+        count = tail
+    for i in range(count):
+        offset = HEADER_SIZE + ((start + i) % capacity) * RECORD.size
+        timestamp, motor_l, motor_r, throttle, steer, source_id = RECORD.unpack_from(data, offset)
+        source = sources[source_id] if source_id < len(sources) else str(source_id)
+        yield timestamp, motor_l, motor_r, throttle, steer, source
+
+
+def main():
+    parser = argparse.ArgumentParser(description='telemetry.bin をタブ区切りで表示する')
+    parser.add_argument('path', nargs='?', default='telemetry.bin')
+    parser.add_argument('--tail', type=int, default=0, help='最後の N 件だけ表示する')
+    args = parser.parse_args()
+
+    print('time\tsource\tmotor_l\tmotor_r\tthrottle\tsteer')
+    for timestamp, motor_l, motor_r, throttle, steer, source in read_records(args.path, args.tail):
+        time_text = datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')
+        print(f'{time_text}\t{source}\t{motor_l:.3f}\t{motor_r:.3f}\t{throttle:.3f}\t{steer:.3f}')
+
+
+if __name__ == '__main__':
+    main()
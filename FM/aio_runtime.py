@@ -0,0 +1,387 @@
+# fm.py を1つの asyncio のイベントループで動かすためのモジュールです (USE_ASYNCIO = True のとき使う)
+# スレッドごとに time.sleep で回していたコントローラー・GUI用のサーバー・GUIの更新・カメラを，
+# すべて1つのループ上のタスクとして動かすので，Piの小さなコアでのスレッド切り替えやGILの取り合いが減ります
+#
+# ・LoopLagMonitor: ループの遅れ(スケジューリング遅延)を測る．/stats.json で見られる
+# ・AsyncRuntime: タスクを起動し，エラーで止まったら再起動する
+# ・AsyncGuiServer: start_gui.Handler と同じ内容(HTTP/MJPEG/WebSocket)を asyncio で提供する
+
+import asyncio
+from collections import deque
+from logging import getLogger, NullHandler, Logger
+import json
+import mimetypes
+import os
+import posixpath
+import socket
+import time
+import urllib.parse
+
+from http_cache import etag_matches, make_etag
+from ws_server import OP_CLOSE, OP_CONTINUATION, OP_PING, OP_PONG, OP_TEXT, MAX_MESSAGE_SIZE, accept_key, encode_frame, unmask
+
+LAG_INTERVAL = 0.05  # [s] ループの遅れを測る間隔
+LAG_WINDOW = 1200  # 統計に使う直近の測定回数 (0.05秒ごとなら1分ぶん)
+KEEP_ALIVE_TIMEOUT = 15  # [s] 次のリクエストが来ない接続を閉じるまでの時間
+STREAM_TIMEOUT = 5  # [s] この間カメラから画像が届かなければストリームを終える
+WS_PING_INTERVAL = 5  # [s] WebSocketの生存確認(ping)の間隔
+WS_MIN_INTERVAL = 0.02  # [s] WebSocketでテレメトリを送る最短の間隔
+MAX_HEADERS = 100
+
+
+class Notifier:
+    """
+    別のスレッドで起きた更新(SharedState や FrameBuffer の add_listener)を，イベントループ上で待てるようにする
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, source=None):
+        self._loop = loop
+        self._waiters = set()
+        if source is not None:
+            source.add_listener(self.notify_threadsafe)
+
+    def notify_threadsafe(self):
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def wait(self, timeout: float = None) -> bool:
+        """次の更新まで待つ．timeout 秒以内に更新がなければ False"""
+        waiter = self._loop.create_future()
+        self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.discard(waiter)
+
+
+class LoopLagMonitor:
+    """
+    interval 秒ごとに起きるはずのタスクが，どれだけ遅れて起きたかを記録する
+    """
+
+    def __init__(self, interval: float = LAG_INTERVAL, window: int = LAG_WINDOW):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.max = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.samples.append(lag)
+            self.count += 1
+            self.max = max(self.max, lag)
+
+    def stats(self) -> dict:
+        samples = sorted(self.samples)
+        if not samples:
+            return {"count": 0}
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+        return {
+            "count": self.count,
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": pick(0.50),
+            "p99_ms": pick(0.99),
+            "max_recent_ms": samples[-1] * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class AsyncRuntime:
+    """
+    登録したタスクを1つのイベントループで動かす
+    タスクが例外で止まったら，ログを残して1秒後に再起動する
+    """
+
+    def __init__(self, *, logger: Logger = None, lag_interval: float = LAG_INTERVAL):
+        if logger is None:
+            logger = getLogger(__name__)
+            logger.addHandler(NullHandler())
+        self.logger = logger
+        self.lag = LoopLagMonitor(lag_interval)
+        self.loop = None
+        self._task_factories = []
+        self._tasks = {}
+
+    def add_task(self, name: str, coro_func, *args):
+        """coro_func(*args) をタスクとして動かす"""
+        self._task_factories.append((name, coro_func, args))
+
+    def add_thread(self, name: str, func, *args):
+        """asyncio に対応していない処理(撮影用のプロセスからの知らせを待つ CameraProcess.run など)は，スレッドで動かしてループから待つ"""
+        self.add_task(name, asyncio.to_thread, func, *args)
+
+    def notifier(self, source) -> Notifier:
+        """source (SharedState / FrameBuffer) が更新されるたびに起きる Notifier を作る"""
+        return Notifier(self.loop, source)
+
+    def stats(self) -> dict:
+        return {
+            "loop_lag": self.lag.stats(),
+            "tasks": {name: not task.done() for name, task in self._tasks.items()},
+        }
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self._tasks["loop_lag"] = asyncio.create_task(self.lag.run())
+        for name, coro_func, args in self._task_factories:
+            self._tasks[name] = asyncio.create_task(self._supervise(name, coro_func, args), name=name)
+        await asyncio.gather(*self._tasks.values())
+
+    async def _supervise(self, name, coro_func, args):
+        while True:
+            try:
+                await coro_func(*args)
+                self.logger.warning('タスク %s が終了しました', name)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error('<<エラー>>\nタスク %s でエラーが発生しました: %s', name, e)
+                await asyncio.sleep(1)
+
+
+class AsyncGuiServer:
+    """
+    start_gui.Handler と同じ内容を asyncio で提供するGUI用のサーバー
+    /data_to_browser.json, POST, /camera.jpg, /stream.mjpg, /ws, /stats.json と，カレントディレクトリのファイル
+    """
+
+    def __init__(self, runtime: AsyncRuntime, gui_state, camera_output, *, host: str = '', port: int = 8000, directory: str = '.'):
+        self.runtime = runtime
+        self.gui_state = gui_state
+        self.camera_output = camera_output
+        self.host = host
+        self.port = port
+        self.directory = os.path.abspath(directory)
+
+    async def serve(self):
+        self.state_changed = self.runtime.notifier(self.gui_state)
+        self.frame_arrived = self.runtime.notifier(self.camera_output)
+        server = await asyncio.start_server(self._handle_connection, self.host or None, self.port, reuse_address=True)
+        self.runtime.logger.info('サーバーが稼働しました！  ポート %d で待っています (asyncio)', self.port)
+        async with server:
+            await server.serve_forever()
+
+    # ----- HTTP -----
+    async def _handle_connection(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE_TIMEOUT)
+                if request is None:
+                    return
+                keep_alive = await self._route(reader, writer, *request)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, version = request_line.decode('latin-1').split()
+        headers = {}
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError('too many headers')
+        body = b''
+        if 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        return method, target, headers, body, keep_alive
+
+    def _write_response(self, writer, code: int, reason: str, body: bytes = b'', content_type: str = None, keep_alive: bool = True, headers: dict = None):
+        lines = [f'HTTP/1.1 {code} {reason}', f'Content-Length: {len(body)}']
+        if content_type is not None:
+            lines.append(f'Content-Type: {content_type}')
+        for name, value in (headers or {}).items():
+            lines.append(f'{name}: {value}')
+        if not keep_alive:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+    def _write_cacheable(self, writer, headers, body, content_type, etag, keep_alive):
+        """If-None-Match が etag と一致すれば 304，そうでなければ ETag 付きで本文を返す"""
+        cache_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag_matches(headers.get('if-none-match'), etag):
+            writer.write(('HTTP/1.1 304 Not Modified\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in cache_headers.items())
+                          + ('' if keep_alive else 'Connection: close\r\n') + '\r\n').encode('latin-1'))
+            return
+        self._write_response(writer, 200, 'OK', body, content_type, keep_alive, cache_headers)
+
+    async def _route(self, reader, writer, method, target, headers, body, keep_alive) -> bool:
+        path = urllib.parse.urlsplit(target).path
+        if method == 'POST':
+            try:
+                data = json.loads(body.decode('utf-8'))
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                self._write_response(writer, 400, 'Bad Request', b'Invalid JSON', 'text/plain', keep_alive)
+                return keep_alive
+            self.gui_state.set_from_browser(data)
+            _, body = self.gui_state.to_browser_json()
+            self._write_response(writer, 201, 'Created', body, 'application/json', keep_alive, {'Cache-Control': 'no-store'})
+        elif method != 'GET':
+            self._write_response(writer, 501, 'Not Implemented', keep_alive=keep_alive)
+        elif path == '/data_to_browser.json':
+            version, body = self.gui_state.to_browser_json()
+            self._write_cacheable(writer, headers, body, 'application/json', make_etag('state', version), keep_alive)
+        elif path == '/stats.json':
+            body = json.dumps(self.gui_state.get_stats()).encode('utf-8')
+            self._write_response(writer, 200, 'OK', body, 'application/json', keep_alive, {'Cache-Control': 'no-store'})
+        elif path == '/camera.jpg' and self.camera_output.frame is not None:
+            self.camera_output.touch()  # 写真を読みに来るブラウザも視聴者として数える
+            count, frame = self.camera_output.latest()
+            self._write_cacheable(writer, headers, frame, 'image/jpeg', make_etag('camera', count), keep_alive)
+        elif path == '/stream.mjpg':
+            await self._stream_camera(writer)
+            return False
+        elif path == '/ws':
+            if headers.get('upgrade', '').lower() != 'websocket' or 'sec-websocket-key' not in headers:
+                self._write_response(writer, 400, 'Bad Request', b'WebSocket upgrade required', 'text/plain', keep_alive)
+                return keep_alive
+            await self._run_websocket(reader, writer, headers['sec-websocket-key'])
+            return False
+        else:
+            await self._send_file(writer, path, keep_alive)
+        return keep_alive
+
+    async def _send_file(self, writer, path, keep_alive):
+        path = posixpath.normpath(urllib.parse.unquote(path)).lstrip('/')
+        if path in ('', '.'):
+            path = 'index.html'
+        file_path = os.path.join(self.directory, path)
+        if path.startswith('..') or not os.path.isfile(file_path):
+            self._write_response(writer, 404, 'Not Found', b'File not found', 'text/plain', keep_alive)
+            return
+
+        def read():
+            with open(file_path, 'rb') as f:
+                return f.read()
+        body = await asyncio.to_thread(read)
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        self._write_response(writer, 200, 'OK', body, content_type, keep_alive)
+
+    # ----- MJPEG -----
+    async def _stream_camera(self, writer):
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Cache-Control: no-cache, private\r\n'
+            b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n'
+            b'Connection: close\r\n\r\n'
+        )
+        count = 0
+        with self.camera_output.watching():  # 送っている間はカメラを休ませない
+            while True:
+                if self.camera_output.count == count and not await self.frame_arrived.wait(STREAM_TIMEOUT):
+                    return
+                count, frame = self.camera_output.latest()
+                if frame is None:
+                    continue
+                writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame))
+                writer.write(frame)
+                writer.write(b'\r\n')
+                await writer.drain()  # 遅いブラウザには，送り終わった時点の最新の画像を送る
+
+    # ----- WebSocket -----
+    async def _run_websocket(self, reader, writer, key):
+        writer.write((
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Accept: {accept_key(key)}\r\n\r\n'
+        ).encode('latin-1'))
+        await writer.drain()
+        pusher = asyncio.create_task(self._push_to_browser(writer))
+        try:
+            while True:
+                message = await self._ws_recv(reader, writer)
+                if message is None:
+                    return
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    continue
+                if isinstance(data, dict):
+                    self.gui_state.set_from_browser(data)
+        finally:
+            pusher.cancel()
+
+    async def _ws_recv(self, reader, writer):
+        message = b''
+        message_opcode = None
+        while True:
+            # フレームごとに待つ (ping への pong も数える)．2回ぶんの ping の間に何も届かなければ切断する
+            b0, b1 = await asyncio.wait_for(reader.readexactly(2), WS_PING_INTERVAL * 2)
+            opcode = b0 & 0x0F
+            length = b1 & 0x7F
+            if length == 126:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await reader.readexactly(8), 'big')
+            if length > MAX_MESSAGE_SIZE:
+                raise ConnectionError('websocket message too large')
+            mask = await reader.readexactly(4) if b1 & 0x80 else None
+            payload = await reader.readexactly(length)
+            if mask is not None:
+                payload = unmask(payload, mask)
+            if opcode == OP_CLOSE:
+                writer.write(encode_frame(OP_CLOSE, (1000).to_bytes(2, 'big')))
+                return None
+            if opcode == OP_PING:
+                writer.write(encode_frame(OP_PONG, payload))
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode != OP_CONTINUATION:
+                message_opcode = opcode
+            message += payload
+            if len(message) > MAX_MESSAGE_SIZE:
+                raise ConnectionError('websocket message too large')
+            if b0 & 0x80:
+                return message.decode('utf-8') if message_opcode == OP_TEXT else message
+
+    async def _push_to_browser(self, writer):
+        version = -1
+        last_ping = time.monotonic()
+        try:
+            while True:
+                if self.gui_state.to_version == version:
+                    await self.state_changed.wait(WS_PING_INTERVAL)
+                if self.gui_state.to_version != version:
+                    version, body = self.gui_state.to_browser_json()
+                    writer.write(encode_frame(OP_TEXT, body))
+                    await writer.drain()
+                    await asyncio.sleep(WS_MIN_INTERVAL)
+                if time.monotonic() - last_ping >= WS_PING_INTERVAL:
+                    writer.write(encode_frame(OP_PING))
+                    last_ping = time.monotonic()
+        except ConnectionError:
+            pass
@@ -0,0 +1,376 @@
+# 効果音を鳴らすためのモジュールです
+# これまでの audio_play() は，ボタンを押すたびにシェル経由で aplay を起動し，WAVファイルを読み直していました
+# また，再生中に押したボタンの音は何も言わずに捨てていました
+#
+# ・WAVファイルは起動時に1回だけ読み込み，再生用の形式(16bit，RATE Hz，CHANNELS ch)に変換してメモリに置く
+# ・再生は1つのスレッドが行い，出力先(ALSAのデバイス)は開いたままにする
+# ・同時に MAX_VOICES 個まで重ねて鳴らす(ミックスする)．あふれた分は優先度の順に待たせ，
+#   優先度の高い音が来たら，いちばん優先度の低い音を止めて鳴らす
+# ・まだ読み込んでいない音を play() されたら，再生のスレッドで読み込んでから鳴らす (呼んだスレッドを待たせない)
+# ・ミックスは numpy (picamera2 と一緒に入っている) で，なければ audioop でまとめて計算する
+# ・出力先は pyalsaaudio があればそれを，なければ常駐させた aplay 1つを使う
+#   サウンドカードがなくても試せるように，捨てるだけの NullSink と WAV に書き出す FileSink もある
+#
+# 例：engine = AudioEngine(open_sink())
+#     engine.load('/home/jaxai/Desktop/hatodokei.wav')
+#     engine.play('/home/jaxai/Desktop/hatodokei.wav', priority=1)
+
+import array
+import heapq
+import itertools
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import wave
+
+try:
+    import alsaaudio  # pyalsaaudio (なくてもよい)
+except ImportError:
+    alsaaudio = None
+
+try:
+    import numpy  # picamera2 と一緒に入っている (なくてもよい)
+except ImportError:
+    numpy = None
+    try:
+        import audioop  # Python 3.12 まで
+    except ImportError:
+        audioop = None
+
+try:
+    import fcntl
+except ImportError:  # Linux 以外
+    fcntl = None
+
+DEVICE = 'hw:1,0'  # aplay --device=hw:1,0 と同じ
+RATE = 44100  # [Hz]
+CHANNELS = 2
+SAMPLE_WIDTH = 2  # [byte] 16bit
+PERIOD_FRAMES = 1024  # 1回に出力するフレーム数 (約23ms)
+BUFFER_TIME = 0.05  # [s] aplay に持たせるバッファ (小さいほど押してから鳴るまでが短い)
+MAX_VOICES = 4  # 同時に鳴らす数
+QUEUE_TIMEOUT = 2.0  # [s] これより長く待たされた音は鳴らさない
+F_SETPIPE_SZ = 1031
+
+
+# ----- WAVの読み込み -----
+def load_wav(path: str, rate: int = RATE, channels: int = CHANNELS) -> bytes:
+    """WAVファイルを読み，16bit・rate Hz・channels ch の PCM (リトルエンディアン) にして返す"""
+    with wave.open(path, 'rb') as wav:
+        width = wav.getsampwidth()
+        source_channels = wav.getnchannels()
+        source_rate = wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+
+    if (width, source_channels, source_rate) == (SAMPLE_WIDTH, channels, rate):
+        return raw  # そのまま使える (ほとんどの効果音)
+
+    # 16bit にする
+    if width == 1:
+        samples = array.array('h', ((b - 128) << 8 for b in raw))
+    elif width == 2:
+        samples = array.array('h', raw)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+    else:
+        # 24/32bit は上位の2バイトだけを使う
+        samples = array.array('h', (int.from_bytes(raw[i + width - 2:i + width], 'little', signed=True) for i in range(0, len(raw), width)))
+
+    # チャンネル数をそろえる (モノラルは左右に同じ音，3ch 以上は最初の2つ)
+    frames = [samples[i:i + source_channels] for i in range(0, len(samples), source_channels)]
+    frames = [(frame * channels)[:channels] if len(frame) == 1 else frame[:channels] for frame in frames]
+
+    # サンプリング周波数をそろえる (いちばん近いフレームを使う．効果音なのでこれで十分)
+    if source_rate != rate and frames:
+        count = int(len(frames) * rate / source_rate)
+        frames = [frames[min(len(frames) - 1, int(i * source_rate / rate))] for i in range(count)]
+
+    result = array.array('h')
+    for frame in frames:
+        result.extend(frame)
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result.tobytes()
+
+
+def mix(chunks: list) -> bytes:
+    """同じ長さの16bit PCM を足し合わせる (はみ出した値は切り詰める)"""
+    if len(chunks) == 1:
+        return chunks[0]
+    if numpy is not None:
+        # 32bit で足してから，まとめて切り詰める
+        total = numpy.frombuffer(chunks[0], '<i2').astype(numpy.int32)
+        for chunk in chunks[1:]:
+            total += numpy.frombuffer(chunk, '<i2')
+        return numpy.clip(total, -32768, 32767).astype('<i2').tobytes()
+    if audioop is not None:
+        total = chunks[0]
+        for chunk in chunks[1:]:
+            total = audioop.add(total, chunk, SAMPLE_WIDTH)  # はみ出した値は audioop が切り詰める
+        return total
+    total = array.array('h', chunks[0])
+    for chunk in chunks[1:]:
+        total = array.array('h', [max(-32768, min(32767, a + b)) for a, b in zip(total, array.array('h', chunk))])
+    return total.tobytes()
+
+
+# ----- 出力先 -----
+class NullSink:
+    """音を捨てる出力先．realtime=True なら実際のデバイスと同じ速さで待つ"""
+
+    def __init__(self, *, rate: int = RATE, channels: int = CHANNELS, realtime: bool = True):
+        self.bytes_per_second = rate * channels * SAMPLE_WIDTH
+        self.realtime = realtime
+        self.written = 0
+        self._next = None
+
+    def write(self, data: bytes):
+        self.written += len(data)
+        if not self.realtime:
+            return
+        now = time.monotonic()
+        if self._next is None or self._next < now:
+            self._next = now
+        self._next += len(data) / self.bytes_per_second
+        time.sleep(max(0.0, self._next - now - BUFFER_TIME))
+
+    def close(self):
+        pass
+
+
+class FileSink(NullSink):
+    """出力した音を WAV ファイルに書き出す (サウンドカードなしで確かめるとき)"""
+
+    def __init__(self, path: str, *, rate: int = RATE, channels: int = CHANNELS, realtime: bool = False):
+        super().__init__(rate=rate, channels=channels, realtime=realtime)
+        self._wav = wave.open(path, 'wb')
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(SAMPLE_WIDTH)
+        self._wav.setframerate(rate)
+
+    def write(self, data: bytes):
+        self._wav.writeframes(data)
+        super().write(data)
+
+    def close(self):
+        self._wav.close()
+
+
+class AlsaSink:
+    """pyalsaaudio で ALSA のデバイスに直接書き込む"""
+
+    def __init__(self, device: str = DEVICE, *, rate: int = RATE, channels: int = CHANNELS):
+        self._pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, device=device, channels=channels, rate=rate,
+                                  format=alsaaudio.PCM_FORMAT_S16_LE, periodsize=PERIOD_FRAMES)
+
+    def write(self, data: bytes):
+        self._pcm.write(data)
+
+    def close(self):
+        self._pcm.close()
+
+
+class AplaySink:
+    """
+    aplay を1つだけ起動したままにして，標準入力に PCM を書き込む (デバイスは開いたまま)
+    パイプのバッファを小さくして，書き込んでから鳴るまでの遅れを BUFFER_TIME 程度にする
+    aplay が終了していたら，次に書き込むときに起動し直す
+    """
+
+    def __init__(self, device: str = DEVICE, *, rate: int = RATE, channels: int = CHANNELS):
+        self.command = ['aplay', '-q', '-D', device, '-t', 'raw', '-f', 'S16_LE', '-r', str(rate), '-c', str(channels),
+                        f'--buffer-time={int(BUFFER_TIME * 1e6)}']
+        self._process = None
+        self.restarts = 0
+
+    def _start(self):
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        if fcntl is not None:
+            try:
+                fcntl.fcntl(self._process.stdin.fileno(), F_SETPIPE_SZ, PERIOD_FRAMES * CHANNELS * SAMPLE_WIDTH)
+            except OSError:
+                pass
+
+    def write(self, data: bytes):
+        if self._process is None or self._process.poll() is not None:
+            if self._process is not None:
+                self.restarts += 1
+            self._start()
+        try:
+            self._process.stdin.write(data)
+        except BrokenPipeError:
+            self._process = None
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait(timeout=1)
+
+
+def open_sink(device: str = DEVICE):
+    """使える出力先を返す．pyalsaaudio → aplay → NullSink の順"""
+    if alsaaudio is not None:
+        try:
+            return AlsaSink(device)
+        except alsaaudio.ALSAAudioError:
+            pass
+    if shutil.which('aplay'):
+        return AplaySink(device)
+    return NullSink()
+
+
+# ----- 再生 -----
+class _Voice:
+    def __init__(self, name: str, data: bytes, priority: int):
+        self.name = name
+        self.data = data
+        self.priority = priority
+        self.position = 0
+
+
+class AudioEngine:
+    """
+    play() はどのスレッドから呼んでもよく，すぐに戻る．再生は専用のスレッドが行う
+    鳴らす音がないときは，スレッドは眠っていて何も出力しない
+    """
+
+    def __init__(self, sink, *, max_voices: int = MAX_VOICES, logger=None):
+        self.sink = sink
+        self.max_voices = max_voices
+        self.logger = logger
+        self.period_bytes = PERIOD_FRAMES * CHANNELS * SAMPLE_WIDTH
+        self._clips = {}
+        self._cond = threading.Condition()
+        self._queue = []  # (-優先度, 順番, 受け付けた時刻, 名前)
+        self._loads = []  # 再生のスレッドで読み込む名前
+        self._order = itertools.count()
+        self._voices = []
+        self._closed = False
+        self.played = 0
+        self.preempted = 0
+        self.expired = 0
+        self.skipped = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name='audio', daemon=True)
+        self._thread.start()
+
+    def load(self, name: str, path: str = None) -> bool:
+        """path (省略すると name) の WAV を読み込んで name で登録する．読めなければ False"""
+        try:
+            data = load_wav(path or name)
+        except (OSError, EOFError, wave.Error) as e:
+            if self.logger is not None:
+                self.logger.warning('効果音を読み込めませんでした: %s (%s)', path or name, e)
+            return False
+        with self._cond:
+            self._clips[name] = data
+        return True
+
+    def play(self, name: str, priority: int = 0, *, overlap: bool = True) -> bool:
+        """
+        name の音を鳴らす．読み込んでいなければ，再生のスレッドで読み込んでから鳴らす (読めなければ鳴らさない)
+        overlap=False なら，同じ音が鳴っている(待っている)間は重ねない (ブザーのボタンを押し続けたときなど)
+        """
+        with self._cond:
+            if not overlap and (any(v.name == name for v in self._voices) or any(item[3] == name for item in self._queue)):
+                self.skipped += 1
+                return False
+            if name not in self._clips and name not in self._loads:
+                self._loads.append(name)
+            heapq.heappush(self._queue, (-priority, next(self._order), time.monotonic(), name))
+            self._cond.notify()
+        return True
+
+    def stop(self):
+        """鳴っている音と待っている音を全部止める"""
+        with self._cond:
+            self._voices.clear()
+            self._queue.clear()
+
+    def playing(self) -> bool:
+        with self._cond:
+            return bool(self._voices or self._queue)
+
+    def _start_voices_locked(self):
+        """待っている音を，優先度の高い順に鳴らし始める"""
+        now = time.monotonic()
+        while self._queue:
+            negative_priority, _, queued, name = self._queue[0]
+            if now - queued > QUEUE_TIMEOUT:
+                heapq.heappop(self._queue)
+                self.expired += 1
+                continue
+            if name not in self._clips:
+                if name in self._loads:
+                    return  # 読み込むまで待つ
+                heapq.heappop(self._queue)  # 読み込めなかった
+                continue
+            priority = -negative_priority
+            if len(self._voices) >= self.max_voices:
+                lowest = min(self._voices, key=lambda v: v.priority)
+                if lowest.priority >= priority:
+                    return  # 空くまで待つ
+                self._voices.remove(lowest)
+                self.preempted += 1
+            heapq.heappop(self._queue)
+            self._voices.append(_Voice(name, self._clips[name], priority))
+            self.played += 1
+
+    def _next_period_locked(self) -> bytes:
+        chunks = []
+        for voice in self._voices:
+            chunk = voice.data[voice.position:voice.position + self.period_bytes]
+            voice.position += self.period_bytes
+            chunks.append(chunk.ljust(self.period_bytes, b'\0'))
+        self._voices = [v for v in self._voices if v.position < len(v.data)]
+        return mix(chunks)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._start_voices_locked()
+                while not self._voices and not self._loads and not self._closed:
+                    # 鳴らす音がなければ眠る (待っている音の期限切れを確かめるために，ときどき起きる)
+                    self._cond.wait(QUEUE_TIMEOUT if self._queue else None)
+                    self._start_voices_locked()
+                if self._closed:
+                    return
+                data = self._next_period_locked() if self._voices else None
+                loads = list(self._loads)
+            if data is not None:
+                try:
+                    self.sink.write(data)  # デバイスが受け取れるまで待つので，これが再生の速さになる
+                except Exception as e:
+                    self.errors += 1
+                    if self.logger is not None:
+                        self.logger.error('<<エラー>>\n効果音の再生中にエラーが発生しました: %s', e)
+                    time.sleep(1)
+            for name in loads:
+                # ロックの外で読み込む．終わってから _loads から外す (それまで待っている音は鳴らさない)
+                self.load(name)
+                with self._cond:
+                    self._loads.remove(name)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=1)
+        self.sink.close()
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計"""
+        with self._cond:
+            return {
+                'sink': type(self.sink).__name__,
+                'clips': len(self._clips),
+                'voices': len(self._voices),
+                'queued': len(self._queue),
+                'played': self.played,
+                'preempted': self.preempted,
+                'expired': self.expired,
+                'skipped': self.skipped,
+                'errors': self.errors,
+            }
@@ -0,0 +1,89 @@
+# コントローラーのスティックの値を，モーターの出力(-1~1)に変換する表を作るモジュールです
+# これまではイベントのたびに割り算・デッドゾーン・丸めを計算していて，EM と FM で少しずつ違う式になっていました
+#
+# ・起動時に，とりうる全ての値について出力を計算して list にしておく
+#   イベントの処理は table[value] の1回だけになる
+# ・デッドゾーン，反応の曲線(linear / expo / cubic)，軸ごとの中心のずれは，表を作るときに入れておく
+# ・負の値は Python の負のインデックス(末尾から数える)の位置に入れるので，
+#   pyPS4Controller の値(-32768~32767)も evdev の値(0~255)も，そのまま添字に使える
+#
+# 例：STICK_TABLE = axis_map.ps4_table(deadzone=0.15)
+#     power = STICK_TABLE[value]
+
+DEADZONE = 0.05  # 中心からこの割合までは 0 にする (倒し始めは，モーターが回らないくらい弱い)
+CURVE = 'linear'
+EXPO = 0.5  # curve='expo' のときの曲がり具合 (0: linear と同じ，1: cubic と同じ)
+RESOLUTION = 0.01  # 出力をこの刻みに丸める (スティックの小さな揺れで指令が変わり続けないように)
+
+PS4_MIN = -32768  # pyPS4Controller
+PS4_MAX = 32767
+EVDEV_MIN = 0  # evdev (DS4 のスティック)．中心値は 127.5
+EVDEV_MAX = 255
+CENTER_TOLERANCE = 0.1  # 起動時のスティックの位置を中心とみなしてよい範囲 (片側の幅に対する割合)
+
+
+def curve_value(x: float, curve: str = CURVE, expo: float = EXPO) -> float:
+    """0~1 の倒し量に反応の曲線をかける．expo は中心付近をゆるやかにし，端では linear と同じく 1 になる"""
+    if curve == 'linear':
+        return x
+    if curve == 'expo':
+        return (1 - expo) * x + expo * x ** 3
+    if curve == 'cubic':
+        return x ** 3
+    raise ValueError(f'unknown curve: {curve}')
+
+
+def axis_table(minimum: int, maximum: int, *, center: float = None, deadzone: float = DEADZONE, curve: str = CURVE,
+               expo: float = EXPO, resolution: float = RESOLUTION, invert: bool = False) -> list:
+    """
+    minimum~maximum の値を -1~1 に変換する表を作る．table[value] で引く
+    center はスティックを離したときの値 (省略すると minimum と maximum の真ん中)
+    中心から minimum 側・maximum 側をそれぞれ -1~0, 0~1 にするので，中心がずれていても両端で ±1 になる
+    """
+    if center is None:
+        center = (minimum + maximum) / 2
+    curve_value(0.0, curve, expo)  # 曲線の名前をここで確かめる
+
+    values = {}  # 同じ値の float を使い回す (表の大きさは値の数だけで済む)
+
+    def convert(raw):
+        if raw >= center:
+            x = (raw - center) / (maximum - center) if maximum > center else 0.0
+        else:
+            x = (raw - center) / (center - minimum) if center > minimum else 0.0
+        magnitude = abs(x)
+        if magnitude <= deadzone:
+            return 0.0
+        # デッドゾーンの端から 0 になめらかにつながるように，残りの幅を 0~1 に広げる
+        magnitude = curve_value(min(1.0, (magnitude - deadzone) / (1 - deadzone)), curve, expo)
+        if resolution:
+            magnitude = round(round(magnitude / resolution) * resolution, 6)
+        power = -magnitude if (x < 0) != invert else magnitude
+        return values.setdefault(power, power)
+
+    low = min(minimum, 0)
+    table = [0.0] * (maximum - low + 1)
+    for raw in range(low, maximum + 1):
+        table[raw] = convert(max(raw, minimum))  # raw が負なら末尾から数えた位置に入る
+    return table
+
+
+def ps4_table(*, center: float = 0, **kwargs) -> list:
+    """pyPS4Controller のスティックの値(-32768~32767)用の表．上・左が負"""
+    return axis_table(PS4_MIN, PS4_MAX, center=center, **kwargs)
+
+
+def evdev_table(absinfo=None, **kwargs) -> list:
+    """
+    evdev のスティックの値用の表．上・左が負
+    absinfo (device.absinfo(code)) を渡すと，その軸の範囲を使い，今の値(スティックを離しているはず)を中心にする
+    今の値が中心から離れすぎているとき(起動時に倒していた)は，範囲の真ん中を中心にする
+    """
+    if absinfo is None:
+        return axis_table(EVDEV_MIN, EVDEV_MAX, **kwargs)
+    middle = (absinfo.min + absinfo.max) / 2
+    center = absinfo.value
+    if abs(center - middle) > (absinfo.max - absinfo.min) / 2 * CENTER_TOLERANCE:
+        center = middle
+    kwargs.setdefault('center', center)
+    return axis_table(absinfo.min, absinfo.max, **kwargs)
@@ -1,12 +1,15 @@
-import json
+import asyncio
+import functools
 from logging import getLogger, StreamHandler, Formatter, DEBUG
 from logging.handlers import RotatingFileHandler
 import os
-import subprocess
 import sys
 import threading
 import time
 
+import log_setup
+import startup
+
 # =============================
 # basic setup
 # =============================
@@ -26,7 +29,6 @@ logger.propagate = False
 
 s_handler = StreamHandler()
 s_handler.setLevel(DEBUG)
-logger.addHandler(s_handler)
 
 tsv_format = Formatter(
     "%(asctime)s.%(msecs)d+09:00\t%(name)s\t%(filename)s\t%(lineno)d\t%(funcName)s\t%(levelname)s\t%(message)s",
@@ -35,23 +37,38 @@ tsv_format = Formatter(
 f_handler = RotatingFileHandler("fm.log", maxBytes=100 * 1000)
 f_handler.setLevel(DEBUG)
 f_handler.setFormatter(tsv_format)
-logger.addHandler(f_handler)
+
+# the handlers run on a background thread: logging never blocks the control thread on the SD card.
+# DEBUG records are rate limited per call site; dropped / rate-limited counts are in /stats.json
+queued_logging = log_setup.QueuedLogging(logger, s_handler, f_handler)
+
+# per-phase startup timing (log + /stats.json); the clock starts at process start, not here
+startup_timer = startup.StartupTimer(logger)
 
 logger.info("setup start")
 
 if sys.prefix == sys.base_prefix:
     logger.warning("WARNING: not running in virtualenv")
-    time.sleep(1)
 
 logger.info("importing libraries")
+# the heavy imports run concurrently; the from-imports below then find them in sys.modules
+with startup_timer.phase("imports"):
+    startup_timer.import_modules("gpiozero", "picamera2", "start_gui")
 from gpiozero import Motor
 from picamera2 import Picamera2
-from pyPS4Controller.controller import Controller
+import aio_runtime
+import audio_engine
+import axis_map
+from camera_power import ViewerAwareCamera
+from command_arbiter import CommandArbiter
+import input_backend
+from shm_frames import CameraProcess
 import start_gui
+from telemetry_ring import TelemetryRecorder
 logger.info("libraries imported")
 
 # =============================
-# motors (same as your MyController)
+# motors
 # =============================
 
 PIN_AIN1 = 3
@@ -69,39 +86,31 @@ motor_right = Motor(forward=PIN_BIN2, backward=PIN_BIN1)
 throttle = 0.0  # forward/back (-1..+1)
 steer = 0.0     # left/right  (-1..+1)
 
-# controller vs GUI 優先度用
-last_controll_time = time.time()
+# controller vs GUI priority: a controller command holds the GUI off for CONTROLLER_HOLD_OFF seconds
+INPUT_PRIORITIES = {"controller": 2, "gui": 1}
+CONTROLLER_HOLD_OFF = 1.0  # [s]
+# stick handlers only update the target; the motors are written CONTROL_TICK_HZ times per second
+# at most (0: write on every event)
+CONTROL_TICK_HZ = 100
+
+# stick value (-32768 .. 32767, up / left negative) -> -1 .. +1, computed once at startup:
+# a stick handler is a single table lookup (deadzone and response curve are baked in)
+STICK_TABLE = axis_map.ps4_table(deadzone=0.15, curve="linear")
 
 
 def clamp(x: float, lo: float, hi: float) -> float:
     return max(lo, min(hi, x))
 
 
-def scale_axis(v: int) -> float:
-    """
-    Same idea as your scale_axis:
-    PS4 axis value (-32768 .. 32767) -> |value| 0.0 .. 1.0 (with deadzone)
-    """
-    v = abs(v)
-    val = v / 32767.0
-    if val < 0.15:
-        return 0.0
-    return clamp(val, 0.0, 1.0)
-
-
-def update_motors_from_state():
+def apply_motors(command: dict, source: str):
     """
-    Same motor mixing as your MyController.update_motors():
-        left  = throttle + steer
-        right = throttle - steer
+    Called by the arbiter with the winning command (motor_l / motor_r, -1..+1).
+    The only place that writes the motors.
     """
     global throttle, steer
 
-    left_power = throttle + steer
-    right_power = throttle - steer
-
-    left_power = clamp(left_power, -1.0, 1.0)
-    right_power = clamp(right_power, -1.0, 1.0)
+    left_power = clamp(command["motor_l"], -1.0, 1.0)
+    right_power = clamp(command["motor_r"], -1.0, 1.0)
 
     if abs(left_power) < 0.01 and abs(right_power) < 0.01:
         motor_left.stop()
@@ -109,18 +118,39 @@ def update_motors_from_state():
     else:
         motor_left.value = left_power
         motor_right.value = right_power
+    # latency from the controller callback (or GUI message) to the motor output
+    arbiter.mark_output(source)
+
+    # keep the global state in sync (inverse of input_backend.arcade_drive)
+    throttle = (left_power + right_power) / 2.0
+    steer = (left_power - right_power) / 2.0
 
     logger.debug(
-        "motors: L=%.2f R=%.2f (throttle=%.2f steer=%.2f)",
-        left_power, right_power, throttle, steer
+        "motors(%s): L=%.2f R=%.2f (throttle=%.2f steer=%.2f)",
+        source, left_power, right_power, throttle, steer
     )
+    telemetry.record(left_power, right_power, throttle, steer, source)
+    # push the new motor values to the browser right away
+    write_to_gui()
+
+
+# every applied command is also recorded in binary (read it with: python telemetry_ring.py telemetry.bin)
+telemetry = TelemetryRecorder("telemetry.bin")
+
+
+arbiter = CommandArbiter(
+    apply_motors,
+    INPUT_PRIORITIES,
+    hold_off=CONTROLLER_HOLD_OFF,
+    initial={"motor_l": 0.0, "motor_r": 0.0},
+    tick_rate=CONTROL_TICK_HZ,
+)
 
 
 def motor_init():
     logger.info("motor init: stop both")
     motor_left.stop()
     motor_right.stop()
-    time.sleep(0.3)
     logger.info("motor init done")
 
 
@@ -128,133 +158,57 @@ def motor_init():
 # speaker (optional)
 # =============================
 
-proces_aplay = None
+SOUND_FILES = [
+    "/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav",
+]
 
+# one long-lived player: clips are decoded once and the ALSA device stays open
+audio = audio_engine.AudioEngine(audio_engine.open_sink(), logger=logger)
+startup_timer.background("audio init", lambda: [audio.load(path) for path in SOUND_FILES])
 
-def audio_play(path: str):
-    global proces_aplay
-    if proces_aplay is None or proces_aplay.poll() is not None:
-        proces_aplay = subprocess.Popen(
-            f"aplay --device=hw:1,0 {path}",
-            shell=True,
-        )
+
+def audio_play(path: str, priority: int = 0, overlap: bool = True):
+    if audio.play(path, priority, overlap=overlap):
         logger.info("audio play: %s", path)
     else:
-        logger.info("audio already playing, skip")
+        logger.info("audio skipped: %s", path)
 
 
 # =============================
-# PS4 controller (your MyController, integrated)
+# PS4 controller (input_backend: js0 read directly, table-driven dispatch)
 # =============================
 
-class MyController(Controller):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-        # use global motors
-        self.motor_left = motor_left
-        self.motor_right = motor_right
-
-        self.throttle = 0.0  # forward/back
-        self.steer = 0.0     # left/right
-
-        print("Motors initialized, waiting for controller...")
-
-    # ----- left stick Y -----
-    def on_L3_up(self, value):
-        global throttle, last_controll_time
-        p = scale_axis(value)
-        self.throttle = p
-        throttle = self.throttle
-        last_controll_time = time.time()
-        self.update_motors()
-
-    def on_L3_down(self, value):
-        global throttle, last_controll_time
-        p = scale_axis(value)
-        self.throttle = -p
-        throttle = self.throttle
-        last_controll_time = time.time()
-        self.update_motors()
-
-    def on_L3_y_at_rest(self):
-        global throttle, last_controll_time
-        self.throttle = 0.0
-        throttle = 0.0
-        last_controll_time = time.time()
-        self.update_motors()
-
-    # ----- left stick X -----
-    def on_L3_right(self, value):
-        global steer, last_controll_time
-        p = scale_axis(value)
-        self.steer = p
-        steer = self.steer
-        last_controll_time = time.time()
-        self.update_motors()
-
-    def on_L3_left(self, value):
-        global steer, last_controll_time
-        p = scale_axis(value)
-        self.steer = -p
-        steer = self.steer
-        last_controll_time = time.time()
-        self.update_motors()
-
-    def on_L3_x_at_rest(self):
-        global steer, last_controll_time
-        self.steer = 0.0
-        steer = 0.0
-        last_controll_time = time.time()
-        self.update_motors()
-
-    # ----- X button (emergency stop) -----
-    def on_x_press(self):
-        global throttle, steer, last_controll_time
-        self.throttle = 0.0
-        self.steer = 0.0
-        throttle = 0.0
-        steer = 0.0
-        self.motor_left.stop()
-        self.motor_right.stop()
-        last_controll_time = time.time()
-        print("X pressed: EMERGENCY STOP")
-        # audio_play("/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav")
-
-    def update_motors(self):
-        """
-        exactly your update_motors()
-        """
-        left_power = self.throttle + self.steer
-        right_power = self.throttle - self.steer
-
-        left_power = clamp(left_power, -1.0, 1.0)
-        right_power = clamp(right_power, -1.0, 1.0)
-
-        if abs(left_power) < 0.01 and abs(right_power) < 0.01:
-            self.motor_left.stop()
-            self.motor_right.stop()
-        else:
-            self.motor_left.value = left_power
-            self.motor_right.value = right_power
-
-        logger.debug(
-            "motors(MyController): L=%.2f R=%.2f (thr=%.2f steer=%.2f)",
-            left_power, right_power, self.throttle, self.steer
-        )
-        # 同期のため global にも反映
-        global throttle, steer
-        throttle = self.throttle
-        steer = self.steer
+def emergency_stop():
+    controller_input.stop()
+    print("X pressed: EMERGENCY STOP")
+    # audio_play("/home/jaxai/Desktop/GLaDOS_escape_02_entry-00.wav", priority=1)
+
+
+# left stick: Y = throttle, X = steer; the controller always wins over the GUI in the arbiter
+controller_input = input_backend.DriveInput(
+    functools.partial(arbiter.push, "controller"),
+    input_backend.arcade_drive,
+    tables={"left_x": STICK_TABLE, "left_y": STICK_TABLE},
+    actions={"cross": emergency_stop},
+)
+joystick = input_backend.JoystickBackend(controller_input, input_backend.JS_HID_LAYOUT)
 
 
 def start_controller():
-    controller = MyController(
-        interface="/dev/input/js0",
-        connecting_using_ds4drv=False,
-    )
-    logger.info("Listening PS4 controller (left stick)...")
-    controller.listen()
+    print("Motors initialized, waiting for controller...")
+    while True:
+        logger.info("Listening PS4 controller (left stick)...")
+        joystick.listen("/dev/input/js0")
+        logger.warning("controller disconnected")
+
+
+async def start_controller_async():
+    """start_controller() for USE_ASYNCIO: js0 is opened O_NONBLOCK and read on the loop (no worker thread)"""
+    print("Motors initialized, waiting for controller...")
+    while True:
+        logger.info("Listening PS4 controller (left stick)...")
+        await joystick.listen_async("/dev/input/js0")
+        logger.warning("controller disconnected")
 
 
 # =============================
@@ -262,46 +216,55 @@ def start_controller():
 # =============================
 
 def read_from_gui():
-    global throttle, steer, last_controll_time
-
-    # controller入力から 1 秒以内は GUI からの上書きを無視
-    if time.time() - last_controll_time < 1.0:
-        return
-
     try:
-        with open("data_from_browser.json") as f:
-            d = json.load(f)
         # GUI からは direct に motor value を指定（-1..+1）
-        motor_left.value = float(d["motor_l"])
-        motor_right.value = float(d["motor_r"])
-        # global 状態も合わせておく
-        # ここは簡単に「平均」としておく（厳密でなくてOK）
-        throttle = (motor_left.value + motor_right.value) / 2.0
-        steer = (motor_left.value - motor_right.value) / 2.0
+        # the arbiter holds it off while the controller is in use
+        _, received, d = start_gui.gui_state.get_from_browser_timed()
+        arbiter.push(
+            "gui",
+            timestamp=received,
+            motor_l=float(d["motor_l"]),
+            motor_r=float(d["motor_r"]),
+        )
     except Exception:
         pass
 
 
 def write_to_gui():
-    try:
-        with open("data_to_browser.json") as f:
-            d = json.load(f)
-        d["motor_l"] = motor_left.value
-        d["motor_r"] = motor_right.value
-        d["light"] = False
-        d["buzzer"] = False
-        with open("data_to_browser.json", "w") as f:
-            f.write(json.dumps(d))
-    except Exception:
-        pass
+    start_gui.gui_state.update_to_browser(
+        motor_l=motor_left.value,
+        motor_r=motor_right.value,
+        light=False,
+        buzzer=False,
+    )
 
 
 def update_gui():
+    version = start_gui.gui_state.from_version
     while True:
         try:
-            read_from_gui()
+            # wake up as soon as the browser sends a command (WebSocket / POST), at least every 0.5 s
+            if start_gui.gui_state.wait_from_browser(version, timeout=0.5):
+                version = start_gui.gui_state.from_version
+                read_from_gui()
+            write_to_gui()
+        except Exception as e:
+            logger.error("GUI error: %s", e)
+
+
+async def update_gui_async(runtime):
+    """update_gui() for USE_ASYNCIO"""
+    browser_changed = runtime.notifier(start_gui.gui_state)
+    version = start_gui.gui_state.from_version
+    while True:
+        try:
+            deadline = time.monotonic() + 0.5
+            while start_gui.gui_state.from_version == version and time.monotonic() < deadline:
+                await browser_changed.wait(deadline - time.monotonic())
+            if start_gui.gui_state.from_version != version:
+                version = start_gui.gui_state.from_version
+                read_from_gui()
             write_to_gui()
-            time.sleep(0.5)
         except Exception as e:
             logger.error("GUI error: %s", e)
 
@@ -310,39 +273,111 @@ def update_gui():
 # camera
 # =============================
 
-picam2 = Picamera2()
-cfg = picam2.create_preview_configuration()
-picam2.configure(cfg)
-picam2.start()
+def init_camera() -> Picamera2:
+    camera = Picamera2()
+    camera.configure(camera.create_preview_configuration())
+    return camera
+
+
+CAMERA_TIMEOUT = 5.0  # [s] restart the encoder when no frame arrives for this long
+# with no browser watching, stop the JPEG encoder and take one picture every few seconds ("stop": stop the camera)
+CAMERA_IDLE_MODE = "keepalive"
+# True: capture and encode in a separate process (shm_frames.py) so the camera never holds this process's GIL;
+# frames come back through shared memory. The worker opens the camera itself.
+CAMERA_PROCESS = False
+
+# opening the camera takes about a second: do it in the background while the controller and server come up
+camera_ready = None if CAMERA_PROCESS else startup_timer.background("camera init", init_camera)
+
+
+def viewer_aware_camera(camera: Picamera2) -> ViewerAwareCamera:
+    """capture at full rate only while someone watches start_gui.camera_output (camera_power.py)"""
+    controller = ViewerAwareCamera(
+        camera,
+        start_gui.camera_output,
+        idle_mode=CAMERA_IDLE_MODE,
+        stall_timeout=CAMERA_TIMEOUT,
+        logger=logger,
+    )
+    start_gui.gui_state.add_stats("camera", controller.stats)
+    return controller
 
 
 def start_camera():
-    while True:
-        try:
-            picam2.capture_file("camera_temp.jpg")
-            os.replace("camera_temp.jpg", "camera.jpg")
-            time.sleep(0.1)
-        except Exception as e:
-            logger.error("Camera error: %s", e)
+    if CAMERA_PROCESS:
+        camera = CameraProcess(
+            start_gui.camera_output,
+            idle_mode=CAMERA_IDLE_MODE,
+            stall_timeout=CAMERA_TIMEOUT,
+            logger=logger,
+        )
+        start_gui.gui_state.add_stats("camera", camera.stats)
+        camera.run()
+        return
+    # the encoder writes every JPEG into start_gui.camera_output (RAM only, nothing on the SD card)
+    viewer_aware_camera(camera_ready.result()).run()
+
+
+async def start_camera_async():
+    """start_camera() for USE_ASYNCIO (frames reach the stream clients through add_listener)"""
+    await viewer_aware_camera(await asyncio.wrap_future(camera_ready)).run_async()
 
 
 # =============================
 # startup
 # =============================
 
-logger.info("motor init")
-motor_init()
+# True: run everything on one asyncio event loop (aio_runtime.py) instead of one thread each:
+# js0 input, the GUI server, the camera and the arbiter's CONTROL_TICK_HZ motor tick.
+# Loop-lag statistics are served at http://<ip>:8000/stats.json
+USE_ASYNCIO = False
 
-threading.Thread(target=start_controller, daemon=True).start()
-threading.Thread(
-    target=start_gui.start_server,
-    kwargs={"logger": logger},
-    daemon=True,
-).start()
-threading.Thread(target=update_gui, daemon=True).start()
-threading.Thread(target=start_camera, daemon=True).start()
+logger.info("motor init")
+with startup_timer.phase("motor init"):
+    motor_init()
+# look up the local IP and follow network changes (Wi-Fi roaming); importing start_gui does neither
+start_gui.init()
+start_gui.gui_state.add_stats("startup", startup_timer.stats)
+start_gui.gui_state.add_stats("arbiter", arbiter.stats)
+start_gui.gui_state.add_stats("logging", queued_logging.stats)
+start_gui.gui_state.add_stats("telemetry", telemetry.stats)
+start_gui.gui_state.add_stats("audio", audio.stats)
+start_gui.gui_state.add_stats("input", controller_input.stats)
+
+if USE_ASYNCIO:
+    runtime = aio_runtime.AsyncRuntime(logger=logger)
+    gui_server = aio_runtime.AsyncGuiServer(
+        runtime,
+        start_gui.gui_state,
+        start_gui.camera_output,
+        host=start_gui.HOST,
+        port=start_gui.PORT,
+    )
+    runtime.add_task("controller", start_controller_async)
+    runtime.add_task("arbiter", arbiter.run_ticks_async)  # the arbiter's tick thread stops once this runs
+    runtime.add_task("server", gui_server.serve)
+    runtime.add_task("gui", update_gui_async, runtime)
+    if CAMERA_PROCESS:
+        runtime.add_thread("camera", start_camera)  # waits on the worker's pipe, not on the loop
+    else:
+        runtime.add_task("camera", start_camera_async)
+    start_gui.gui_state.add_stats("runtime", runtime.stats)
+    logger.info("all systems started (asyncio)")
+    startup_timer.ready()  # the tasks start as soon as the loop runs
+    runtime.run()
+else:
+    threading.Thread(target=start_controller, daemon=True).start()
+    threading.Thread(
+        target=start_gui.start_server,
+        kwargs={"logger": logger},
+        daemon=True,
+    ).start()
+    threading.Thread(target=update_gui, daemon=True).start()
+    threading.Thread(target=start_camera, daemon=True).start()
+
+    logger.info("all systems started")
+    startup_timer.ready()
 
-logger.info("all systems started")
+    while True:
+        time.sleep(10)
 
-while True:
-    time.sleep(10)
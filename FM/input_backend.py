@@ -0,0 +1,325 @@
+# コントローラーの入力を，読み方(バックエンド)によらず同じ操作ロジックで扱うためのモジュールです
+# これまでは pyPS4Controller (/dev/input/js0) の MyController のコールバックと，
+# evdev の ecodes を if/elif で並べた処理の2通りがあり，機体ごとに操作の書き方が違っていました
+#
+# ・DriveInput が操作ロジック本体．スティックの値(正規化済み)とボタンを受け取り，
+#   フレームの終わり(sync())に drive 関数でモーターへの指令を作って push する
+# ・バックエンドはイベントを読んで DriveInput に渡すだけ
+#     JoystickBackend: /dev/input/js0 の js_event を直接読む (pyPS4Controller の代わり)
+#     EvdevBackend:    evdev の InputEvent (SYN_REPORT で1フレーム)
+# ・イベントの (type, code) → 処理 の表は起動時に1回だけ作る．イベントごとの処理は表を2回引くだけ
+# ・どのボタンで何をするか(actions)，どちらの操作方法か(tank_drive / arcade_drive)は機体ごとのスクリプトで決める
+#
+# 例：controller_input = DriveInput(push, tank_drive, tables={'left_y': table, 'right_y': table},
+#                                   actions={'cross': emergency_stop})
+#     joystick = JoystickBackend(controller_input, JS_DS4DRV_LAYOUT)
+#     joystick.listen('/dev/input/js0')  # asyncio のループでは await joystick.listen_async('/dev/input/js0')
+
+import asyncio
+import os
+import struct
+import time
+
+# ----- 操作方法 -----
+def clamp(x: float, lo: float, hi: float) -> float:
+    return max(lo, min(hi, x))
+
+
+def tank_drive(axes: dict) -> tuple:
+    """左スティックの上下で左のモーター，右スティックの上下で右のモーター (上が前進)"""
+    return -axes['left_y'], -axes['right_y']
+
+
+def arcade_drive(axes: dict) -> tuple:
+    """左スティックの上下で前後，左右で旋回"""
+    throttle = -axes['left_y']
+    steer = axes['left_x']
+    return clamp(throttle + steer, -1.0, 1.0), clamp(throttle - steer, -1.0, 1.0)
+
+
+AXES = ('left_x', 'left_y', 'right_x', 'right_y')
+
+
+# ----- 操作ロジック -----
+class DriveInput:
+    """
+    push:    push(timestamp=..., motor_l=..., motor_r=...) でモーターへの指令を送る関数
+             (functools.partial(arbiter.push, 'controller') など)
+    drive:   軸の値 {名前: -1~1} から (motor_l, motor_r) を返す関数
+    tables:  軸の名前 → 生の値から -1~1 への変換表 (axis_map)．表のない軸は無視する
+    actions: ボタンの名前 → 押されたときに呼ぶ関数 (引数なし)
+    バックエンドは1つのスレッド(またはイベントループ)から呼ぶ
+    """
+
+    def __init__(self, push, drive, *, tables: dict, actions: dict = None):
+        self._push = push
+        self.drive = drive
+        self.tables = dict(tables)
+        self.actions = dict(actions or {})
+        self.axes = dict.fromkeys(AXES, 0.0)
+        self._dirty = False
+        self._pressed = []  # このフレームで押されたボタンの処理
+        self.events = 0
+        self.frames = 0
+        self.pushes = 0
+        self.dropped = 0
+
+    def axis(self, name: str, raw: int):
+        self.axes[name] = self.tables[name][raw]
+        self._dirty = True
+
+    def press(self, name: str):
+        action = self.actions.get(name)
+        if action is not None:
+            self._pressed.append(action)
+
+    def sync(self, timestamp: float = None):
+        """1フレームの終わり．軸が変わっていれば指令を1回だけ送り，押されたボタンの処理を呼ぶ"""
+        self.frames += 1
+        if self._dirty:
+            self._dirty = False
+            motor_l, motor_r = self.drive(self.axes)
+            self._push(timestamp=timestamp, motor_l=motor_l, motor_r=motor_r)
+            self.pushes += 1
+        if self._pressed:
+            for action in self._pressed:
+                action()
+            self._pressed.clear()
+
+    def drop(self):
+        """途中のイベントが失われたとき．このフレームの変化を捨てる"""
+        self.dropped += 1
+        self._dirty = False
+        self._pressed.clear()
+
+    def stop(self):
+        """全部の軸を 0 にして，止める指令を送る (非常停止のボタンなど)"""
+        for name in self.axes:
+            self.axes[name] = 0.0
+        self._dirty = False
+        self._push(timestamp=None, motor_l=0.0, motor_r=0.0)
+        self.pushes += 1
+
+    def reset(self):
+        """つなぎ直したとき．前の接続のフレームの途中の変化を捨てる"""
+        self._dirty = False
+        self._pressed.clear()
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計"""
+        return {
+            'events': self.events,
+            'frames': self.frames,
+            'pushes': self.pushes,
+            'dropped': self.dropped,
+            'axes': dict(self.axes),
+        }
+
+
+def build_dispatch(layer: DriveInput, layout: dict, extra: dict = None) -> list:
+    """
+    layout {type: {code: 軸かボタンの名前}} から，dispatch[type][code] → handler(value) の表を作る
+    表のない軸・actions にないボタンは入れない (届いても何もしない)
+    """
+    axes = layer.axes
+    tables = layer.tables  # calibrate などで表を差し替えても，同じ dict を見る
+
+    def on_axis(name):
+        def handler(value):
+            axes[name] = tables[name][value]
+            layer._dirty = True
+        return handler
+
+    def on_button(name):
+        def handler(value):
+            if value == 1:  # 押したとき (離したとき 0，evdev のキーリピート 2 は無視)
+                layer.press(name)
+        return handler
+
+    dispatch = [{} for _ in range(256)]
+    for event_type, codes in layout.items():
+        for code, name in codes.items():
+            if name in layer.tables:
+                dispatch[event_type][code] = on_axis(name)
+            elif name in layer.actions:
+                dispatch[event_type][code] = on_button(name)
+    for (event_type, code), handler in (extra or {}).items():
+        dispatch[event_type][code] = handler
+    return dispatch
+
+
+# ----- /dev/input/js* (joydev) -----
+# struct js_event { __u32 time; __s16 value; __u8 type; __u8 number; }
+JS_EVENT = struct.Struct('IhBB')
+JS_EVENT_BUTTON = 0x01
+JS_EVENT_AXIS = 0x02
+JS_EVENT_INIT = 0x80  # つないだ直後に届く，今の状態
+
+# カーネルのドライバ(hid-sony)で Bluetooth 接続したとき (pyPS4Controller の connecting_using_ds4drv=False)
+JS_HID_LAYOUT = {
+    JS_EVENT_AXIS: {0: 'left_x', 1: 'left_y', 2: 'L2', 3: 'right_x', 4: 'right_y', 5: 'R2'},
+    JS_EVENT_BUTTON: {0: 'cross', 1: 'circle', 2: 'triangle', 3: 'square', 4: 'L1', 5: 'R1', 6: 'L2', 7: 'R2',
+                      8: 'share', 9: 'options', 10: 'ps', 11: 'L3', 12: 'R3'},
+}
+# ds4drv で接続したとき (右スティックの上下が 5 番の軸，ボタンの番号もずれる)
+JS_DS4DRV_LAYOUT = {
+    JS_EVENT_AXIS: {0: 'left_x', 1: 'left_y', 2: 'right_x', 5: 'right_y'},
+    JS_EVENT_BUTTON: {0: 'square', 1: 'cross', 2: 'circle', 3: 'triangle'},
+}
+READ_EVENTS = 64  # 1回の read で読むイベントの最大数
+OPEN_RETRY = 0.5  # [s] js0 がまだないときに開き直す間隔
+
+
+class JoystickBackend:
+    """
+    /dev/input/js* から js_event を読み，DriveInput に渡す
+    1回の read で届いていたイベントを全部処理してから sync() する (左右のスティックの変化は1回の指令になる)
+    """
+
+    def __init__(self, layer: DriveInput, layout: dict = JS_HID_LAYOUT):
+        self.layer = layer
+        self._dispatch = build_dispatch(layer, layout)
+
+    def feed(self, data: bytes):
+        """read で読んだバイト列(js_event の並び)を処理する"""
+        dispatch = self._dispatch
+        layer = self.layer
+        for _, value, event_type, number in JS_EVENT.iter_unpack(data):
+            layer.events += 1
+            if event_type & JS_EVENT_INIT:
+                if event_type & JS_EVENT_BUTTON:
+                    continue  # つないだときに押されていたボタンは，押したことにしない
+                event_type &= ~JS_EVENT_INIT
+            handler = dispatch[event_type].get(number)
+            if handler is not None:
+                handler(value)
+        layer.sync()
+
+    def listen(self, path: str = '/dev/input/js0', *, on_connect=None, on_disconnect=None):
+        """path が開けるまで待ち，切断されるまで読む．切断されたら on_disconnect() を呼んで戻る"""
+        while True:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                break
+            except OSError:
+                time.sleep(OPEN_RETRY)
+        self.layer.reset()
+        if on_connect is not None:
+            on_connect()
+        try:
+            while True:
+                data = os.read(fd, JS_EVENT.size * READ_EVENTS)
+                if not data:
+                    break
+                self.feed(data)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        if on_disconnect is not None:
+            on_disconnect()
+
+    async def listen_async(self, path: str = '/dev/input/js0', *, on_connect=None, on_disconnect=None):
+        """listen() の asyncio 版．js0 を O_NONBLOCK で開き，読めるようになったらループの上で読む (スレッドを使わない)"""
+        while True:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+                break
+            except OSError:
+                await asyncio.sleep(OPEN_RETRY)
+        self.layer.reset()
+        if on_connect is not None:
+            on_connect()
+        loop = asyncio.get_running_loop()
+        disconnected = loop.create_future()
+
+        def readable():
+            try:
+                data = os.read(fd, JS_EVENT.size * READ_EVENTS)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                if not disconnected.done():
+                    disconnected.set_result(None)
+                return
+            self.feed(data)
+
+        loop.add_reader(fd, readable)
+        try:
+            await disconnected
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+        if on_disconnect is not None:
+            on_disconnect()
+
+
+# ----- evdev -----
+# <linux/input-event-codes.h> (evdev をインポートしなくても表を作れるように)
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_REPORT = 0
+SYN_DROPPED = 3
+
+EVDEV_LAYOUT = {
+    EV_ABS: {0x00: 'left_x', 0x01: 'left_y', 0x03: 'right_x', 0x04: 'right_y'},  # ABS_X, ABS_Y, ABS_RX, ABS_RY
+    EV_KEY: {304: 'cross', 305: 'circle', 307: 'triangle', 308: 'square', 310: 'L1', 311: 'R1',  # BTN_SOUTH ...
+             314: 'share', 315: 'options', 316: 'ps', 317: 'L3', 318: 'R3'},
+}
+
+
+class EvdevBackend:
+    """
+    evdev の InputEvent を DriveInput に渡す．SYN_REPORT までを1フレームとしてまとめて反映する
+    SYN_DROPPED のあとは次の SYN_REPORT までのイベントを捨て，スティックの今の値を読み直す
+    """
+
+    def __init__(self, layer: DriveInput, layout: dict = EVDEV_LAYOUT):
+        self.layer = layer
+        self.layout = layout
+        self.device = None
+        self.monotonic = False
+        self._dropped = False
+        self._dispatch = build_dispatch(layer, layout, {(EV_SYN, SYN_REPORT): self._report, (EV_SYN, SYN_DROPPED): self._drop})
+        self._event = None  # 処理中のイベント (SYN_REPORT の時刻を指令に付けるため)
+
+    def attach(self, device, *, monotonic: bool = False):
+        """つながったデバイス．monotonic=True ならイベントの時刻を time.monotonic() の時刻として指令に付ける"""
+        self.device = device
+        self.monotonic = monotonic
+        self._dropped = False
+        self.layer.reset()
+
+    def handle(self, event):
+        self.layer.events += 1
+        handler = self._dispatch[event.type].get(event.code)
+        if handler is None:
+            return
+        if self._dropped and event.type != EV_SYN:
+            return  # 次の SYN_REPORT で読み直す
+        self._event = event
+        handler(event.value)
+
+    def _report(self, value):
+        if self._dropped:
+            self._dropped = False
+            self.resync()
+        self.layer.sync(self._event.timestamp() if self.monotonic else None)
+
+    def _drop(self, value):
+        self._dropped = True
+        self.layer.drop()
+
+    def resync(self):
+        """スティックの今の値をデバイスから読み直す"""
+        if self.device is None:
+            return
+        for code, name in self.layout.get(EV_ABS, {}).items():
+            if name in self.layer.tables:
+                try:
+                    self.layer.axis(name, self.device.absinfo(code).value)
+                except OSError:
+                    pass
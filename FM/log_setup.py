@@ -0,0 +1,97 @@
+# ログの書き込みを制御のスレッドから切り離すためのモジュールです
+# RotatingFileHandler は呼び出したスレッドでSDカードへ書き込み，ファイルのローテーションも行うので，
+# SDカードが遅いと logger.debug() を呼んだモーター制御のスレッドがそのまま止まってしまいます
+#
+# ・logger にはキューに積むだけの QueueHandler を付け，実際の書き込みは QueueListener のスレッドで行う
+# ・キューがいっぱいのときは待たずにレコードを捨て，捨てた数を数える
+# ・DEBUG のレコードは，呼び出し場所(ファイルと行)ごとに1秒あたりの件数を制限する (スティック操作などで大量に出るため)
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+
+QUEUE_SIZE = 10000  # キューに溜められるレコードの数
+DEBUG_RATE = 20  # 呼び出し場所ごとに，1秒あたりこの件数まで DEBUG のレコードを残す
+
+
+class DropCountingQueueHandler(logging.handlers.QueueHandler):
+    """キューがいっぱいなら待たずに捨てて，レベルごとに数える QueueHandler"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = {}
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    level 以下のレコードを，呼び出し場所ごとに1秒あたり rate 件までに間引く
+    間引いた数は suppressed に数える．level より重要なレコードはすべて通す
+    """
+
+    def __init__(self, rate: int = DEBUG_RATE, level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        self._windows = {}  # (ファイル, 行) → [この1秒の始まり, この1秒で通した数]
+
+    def filter(self, record) -> bool:
+        if record.levelno > self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = record.created
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= 1.0:
+                self._windows[key] = [now, 1]
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            self.suppressed += 1
+            return False
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # 終了の合図だけは，キューが空くのを待ってでも入れる
+
+
+class QueuedLogging:
+    """
+    logger の handlers をバックグラウンドのスレッドで動かす
+    handlers それぞれのレベル(setLevel)はそのまま使われる
+    """
+
+    def __init__(self, logger: logging.Logger, *handlers, queue_size: int = QUEUE_SIZE, debug_rate: int = DEBUG_RATE):
+        self.queue = queue.Queue(queue_size)
+        self.handler = DropCountingQueueHandler(self.queue)
+        self.rate_limit = RateLimitFilter(debug_rate)
+        self.handler.addFilter(self.rate_limit)
+        self.listener = _Listener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        self._running = True
+        logger.addHandler(self.handler)
+        atexit.register(self.stop)  # 終了するときはキューに残ったログを書き切る
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self.listener.stop()
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計"""
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': dict(self.handler.dropped),
+            'rate_limited': self.rate_limit.suppressed,
+        }
@@ -1,62 +1,192 @@
 import http.server
+import json
 from logging import getLogger, NullHandler, Logger
-import os
 import socket
-import socketserver
-import subprocess
+import threading
+import time
 
-# ローカルIPを取得
-local_ip = ""
+from frame_buffer import FrameBuffer
+from http_cache import etag_matches, make_etag
+from net_info import AddressWatcher
+from pooled_server import KeepAliveHandlerMixin, PooledHTTPServer, MAX_WORKERS
+from shared_state import SharedState
+from ws_server import WebSocket, accept_key
 
-# ラズパイ以外
-# local_ip = socket.gethostbyname_ex(socket.gethostname())[2][-1]
+HOST, PORT = '', 8000
+STREAM_TIMEOUT = 5  # [s] この間カメラから画像が届かなければストリームを終える
+WS_PING_INTERVAL = 5  # [s] WebSocketの生存確認(ping)の間隔
+WS_MIN_INTERVAL = 0.02  # [s] WebSocketでテレメトリを送る最短の間隔
 
-#ラズパイ
-str_out_lines = subprocess.Popen("ip addr", stdout=subprocess.PIPE, shell=True).communicate()[0].decode("ascii", "ignore").splitlines()
-for line in str_out_lines:
-    if line.startswith("    inet "):
-        local_ip = line.split()[1]
-        local_ip = (local_ip[0:-3] if local_ip[-3] == '/' else local_ip[0:-2])
+# ブラウザとやり取りするデータ (ファイルではなくメモリ上で共有する)
+gui_state = SharedState(
+    # 受信用
+    from_browser={"motor_l": 0, "motor_r": 0, "light": False, "buzzer": False},
+    # 送信用
+    to_browser={"motor_l": 0, "motor_r": 0, "light": True, "buzzer": False, "lat": None, "lon": None, "grav": [None, None, None], "mag": [None, None, None], "local_ip": ""},  # local_ip は init() で設定する
+)
 
-HOST, PORT = '', 8000
+# カメラで撮影した画像 (fm.py のエンコーダーが書き込む)
+camera_output = FrameBuffer()
+
+# ローカルIPアドレス．インポートしただけでは調べない (init() か，最初に local_ip を読んだときに調べる)
+# Wi-Fi がつなぎ直されてアドレスが変わったら，ブラウザに送る local_ip も更新する
+addresses = AddressWatcher(on_change=lambda address: gui_state.update_to_browser(local_ip=f'{address}:{PORT}'))
+
+def __getattr__(name):
+    # start_gui.local_ip は読むたびに今のアドレスを返す
+    if name == 'local_ip':
+        return addresses.address
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def init():
+    """サーバーを起動する前に呼ぶ．ローカルIPアドレスを調べ，ネットワークの変化の監視を始める (何度呼んでもよい)"""
+    gui_state.update_to_browser(local_ip=f'{addresses.address}:{PORT}')
+    addresses.start()
+
+class Handler(KeepAliveHandlerMixin, http.server.SimpleHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/data_to_browser.json':
+            self.send_to_browser(200, 'OK')
+        elif path == '/stats.json':
+            self.send_stats()
+        elif path == '/camera.jpg' and camera_output.frame is not None:
+            self.send_camera_frame()
+        elif path == '/ws':
+            if self.headers.get('Upgrade', '').lower() != 'websocket' or 'Sec-WebSocket-Key' not in self.headers:
+                self.send_error(400, 'WebSocket upgrade required')
+            elif not self.detach(self.run_websocket):
+                self.send_error(503, 'Too many connections')
+        elif path == '/stream.mjpg':
+            if not self.detach(self.stream_camera):
+                self.send_error(503, 'Too many streams')
+        else:
+            super().do_GET()
 
-# 一度削除
-try:
-    os.remove('./data_from_browser.json')
-    os.remove('./data_to_browser.json')
-except Exception as e:
-    pass
-
-try:
-    # 受信用のJSONファイルを作成
-    with open("./data_from_browser.json", "w") as f:
-        f.write('{"motor_l": 0, "motor_r": 0, "light": false, "buzzer": false }')
-
-    # 送信用のJSONファイルを作成
-    with open("./data_to_browser.json", "w") as f:
-        f.write('{"motor_l": 0, "motor_r": 0, "light": true, "buzzer": false, "lat": null, "lon": null, "grav": [null, null, null], "mag": [null, null, null], "local_ip": "' + f'{local_ip}:{PORT}' + '"}')
-except Exception as e:
-    print(f'<<エラー>>\nGUI送受信ファイルへの書き込みに失敗しました: {e}')
-# 書き込み権限を設定
-subprocess.run('chmod 664 data_from_browser.json', shell=True)
-subprocess.run('chmod 664 data_to_browser.json', shell=True)
-
-class Handler(http.server.SimpleHTTPRequestHandler):
     def do_POST(self):
         file_length = int(self.headers['Content-Length'])
-        with open("./data_from_browser.json", 'w') as f:
-            f.write(self.rfile.read(file_length).decode('utf-8'))
-        self.send_response(201, 'Created')
+        try:
+            data = json.loads(self.rfile.read(file_length).decode('utf-8'))
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            self.send_error(400, 'Invalid JSON')
+            return
+        gui_state.set_from_browser(data)
+        self.send_to_browser(201, 'Created')
+
+    def send_to_browser(self, code, message):
+        version, body = gui_state.to_browser_json()
+        if code == 200:
+            # GET はバージョンをETagにして，変わっていなければ 304 を返す
+            self.send_cacheable(body, 'application/json', make_etag('state', version))
+            return
+        self.send_response(code, message)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    # ブラウザが持っているものと同じ(If-None-Match が一致する)なら，本文を送らずに 304 を返す
+    # Cache-Control: no-cache でブラウザに毎回問い合わせ(再検証)をさせる
+    def send_cacheable(self, body, content_type, etag):
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304, 'Not Modified')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    # 実行中の統計 (gui_state.add_stats で登録されたもの)
+    def send_stats(self):
+        body = json.dumps(gui_state.get_stats()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    # カメラの最新の画像をメモリから直接送る
+    # フレーム番号をETagにして，新しい画像が届いていなければ 304 を返す
+    def send_camera_frame(self):
+        camera_output.touch()  # 写真を読みに来るブラウザも視聴者として数える (カメラを休ませない)
+        count, frame = camera_output.latest()
+        self.send_cacheable(frame, 'image/jpeg', make_etag('camera', count))
+
+    # WebSocketでブラウザと双方向に通信する
+    # ブラウザからは操作(POSTと同じJSON)が変化するたびに届き，こちらからはテレメトリを更新のたびに送る
+    def run_websocket(self):
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept_key(self.headers['Sec-WebSocket-Key']))
+        self.end_headers()
+        ws = WebSocket(self.rfile, self.wfile)
+        threading.Thread(target=self.push_to_browser, args=(ws,), daemon=True).start()
+        try:
+            while True:
+                message = ws.recv()
+                if message is None:
+                    return
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    continue
+                if isinstance(data, dict):
+                    gui_state.set_from_browser(data)
+        finally:
+            ws.close()
+
+    def push_to_browser(self, ws):
+        version = -1
+        last_ping = time.monotonic()
+        try:
+            while not ws.closed:
+                if gui_state.wait_to_browser(version, WS_PING_INTERVAL):
+                    version, body = gui_state.to_browser_json()
+                    ws.send(body)
+                    time.sleep(WS_MIN_INTERVAL)
+                if time.monotonic() - last_ping >= WS_PING_INTERVAL:
+                    ws.ping()
+                    last_ping = time.monotonic()
+        except OSError:
+            ws.close()
+
+    # MJPEG(multipart/x-mixed-replace)で，カメラの画像が届くたびにブラウザへ送る
+    def stream_camera(self):
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
         self.end_headers()
-        with open("./data_to_browser.json", "r") as f:
-            self.wfile.write(f.read().encode('utf-8'))
+        count = 0
+        with camera_output.watching():  # 送っている間はカメラを休ませない
+            while True:
+                new_frame = camera_output.wait_for_frame(count, STREAM_TIMEOUT)
+                if new_frame is None:
+                    return
+                count, frame = new_frame
+                self.wfile.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame))
+                self.wfile.write(frame)
+                self.wfile.write(b'\r\n')
 
-def start_server(*, logger: Logger = None):
-    logger = logger or getLogger(__name__).addHandler(NullHandler())
+def start_server(*, logger: Logger = None, max_workers: int = MAX_WORKERS):
+    if logger is None:
+        logger = getLogger(__name__)
+        logger.addHandler(NullHandler())
+    init()
     while True:
         try:
-            with socketserver.TCPServer((HOST, PORT), Handler) as httpd:
-                logger.info(f"サーバーが稼働しました！  同じネットワーク内のブラウザで http://%s:%d にアクセスしてください", local_ip, PORT)
+            with PooledHTTPServer((HOST, PORT), Handler, max_workers=max_workers) as httpd:
+                logger.info(f"サーバーが稼働しました！  同じネットワーク内のブラウザで http://%s:%d にアクセスしてください", addresses.address, PORT)
                 httpd.serve_forever()
         except Exception as e:
             logger.error(f'<<エラー>>\nGUI用のサーバーでエラーが発生しました: {e}')
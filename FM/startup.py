@@ -0,0 +1,129 @@
+# 起動にかかる時間を段階ごとに測り，互いに関係のない初期化を並行して行うためのモジュールです
+# これまでは仮想環境の確認で数秒待ち，ライブラリを1つずつインポートし，カメラを設定し，モーターを確認してから
+# ようやくスレッドを起動していたので，電源を入れてから操作できるまでに時間がかかっていました
+#
+# ・import_modules() は重いライブラリ(picamera2 など)を並行してインポートする
+#   あとから書く from picamera2 import Picamera2 などは，読み込み済みなのですぐに終わる
+# ・background() は初期化(カメラの設定など)をバックグラウンドで始め，結果は必要になったときに受け取る
+# ・phase() で囲んだ処理と，インポート・バックグラウンドの初期化の時間を記録し，ログと /stats.json に出す
+# ・ready() を呼んだ時点を「操作できるようになった時刻」として，プロセスの起動からの時間を記録する
+
+import concurrent.futures
+import contextlib
+import importlib
+import os
+import threading
+import time
+
+TARGET = 3.0  # [s] プロセスの起動から操作できるようになるまでの目標
+
+
+def process_start_time() -> float:
+    """このプロセスが起動した時刻 (time.monotonic() の時計)．/proc が読めなければ今の時刻"""
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()  # プロセス名に空白や ) が入っていてもよいように
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        started_after_boot = int(fields[19]) / os.sysconf('SC_CLK_TCK')  # 22番目の項目 starttime
+        return time.monotonic() - (uptime - started_after_boot)
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+class StartupTimer:
+    """起動の段階ごとの時間を記録する．どのスレッドから呼んでもよい"""
+
+    def __init__(self, logger=None, *, target: float = TARGET):
+        self.logger = logger
+        self.target = target
+        self.started = process_start_time()
+        self._lock = threading.Lock()
+        self._phases = {}  # 名前 → (始まり, 終わり) (プロセスの起動からの秒数)
+        self._errors = {}
+        self.ready_after = None  # [s] プロセスの起動から ready() まで
+
+    def _now(self) -> float:
+        return time.monotonic() - self.started
+
+    def _record(self, name: str, start: float, error: BaseException = None):
+        end = self._now()
+        with self._lock:
+            self._phases[name] = (start, end)
+            if error is not None:
+                self._errors[name] = f'{type(error).__name__}: {error}'
+        if self.logger is not None:
+            if error is None:
+                self.logger.debug('起動: %s %.3f s', name, end - start)
+            else:
+                self.logger.error('<<エラー>>\n起動: %s でエラーが発生しました: %s', name, error)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """with startup_timer.phase('名前'): で囲んだ処理の時間を記録する"""
+        start = self._now()
+        try:
+            yield
+        except BaseException as e:
+            self._record(name, start, e)
+            raise
+        self._record(name, start)
+
+    def _timed(self, name: str, func, *args):
+        start = self._now()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self._record(name, start, e)
+            raise
+        self._record(name, start)
+        return result
+
+    def import_modules(self, *names: str) -> dict:
+        """
+        names のモジュールを並行してインポートし，{名前: モジュール} を返す．インポートできなかったものは入らない
+        同じパッケージのモジュール(picamera2 と picamera2.encoders など)は並べず，親のパッケージだけを渡す
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(names) or 1, thread_name_prefix='import') as pool:
+            futures = {name: pool.submit(self._timed, f'import {name}', importlib.import_module, name) for name in names}
+        modules = {}
+        for name, future in futures.items():
+            if future.exception() is None:
+                modules[name] = future.result()
+        return modules
+
+    def background(self, name: str, func, *args) -> concurrent.futures.Future:
+        """func(*args) をバックグラウンドのスレッドで始めて，すぐに戻る．結果は Future.result() で受け取る"""
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(self._timed(name, func, *args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f'startup-{name}', daemon=True).start()
+        return future
+
+    def ready(self):
+        """操作できるようになったときに呼ぶ．起動からの時間と，段階ごとの時間をログに出す"""
+        self.ready_after = self._now()
+        if self.logger is None:
+            return
+        report = self.logger.info if self.ready_after <= self.target else self.logger.warning
+        report('起動から %.2f 秒で操作できるようになりました (目標 %.1f 秒)', self.ready_after, self.target)
+        with self._lock:
+            phases = sorted(self._phases.items(), key=lambda item: item[1][0])
+        for name, (start, end) in phases:
+            self.logger.info('  %-36s %6.3f s (%.3f → %.3f)', name, end - start, start, end)
+
+    def stats(self) -> dict:
+        """/stats.json 用の統計 (時刻はプロセスの起動からの秒数)"""
+        with self._lock:
+            return {
+                'ready_after_s': self.ready_after,
+                'target_s': self.target,
+                'phases': {name: {'start_s': start, 'end_s': end, 'duration_s': end - start}
+                           for name, (start, end) in sorted(self._phases.items(), key=lambda item: item[1][0])},
+                'errors': dict(self._errors),
+            }
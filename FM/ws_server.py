@@ -0,0 +1,131 @@
+# GUI用のサーバーでWebSocket(RFC 6455)を使うためのモジュールです
+# ブラウザのスティック操作を変化したときにすぐ受け取り，モーター出力などを更新のたびにすぐ送り返します
+# 標準ライブラリだけで動くように，必要な機能(テキスト/バイナリ, ping/pong, close)だけを実装しています
+
+import base64
+import hashlib
+import struct
+import threading
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_MESSAGE_SIZE = 64 * 1024  # [byte] これより大きいメッセージが来たら切断する
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+def accept_key(key: str) -> str:
+    """Sec-WebSocket-Key から Sec-WebSocket-Accept の値を作る"""
+    return base64.b64encode(hashlib.sha1((key + GUID).encode("ascii")).digest()).decode("ascii")
+
+
+def unmask(payload: bytes, mask: bytes) -> bytes:
+    """ブラウザから届いたフレームのマスクを外す (4バイトのマスクを整数のXORで一度に外す)"""
+    length = len(payload)
+    if length == 0:
+        return payload
+    full_mask = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(full_mask, "big")).to_bytes(length, "big")
+
+
+def encode_frame(opcode: int, payload: bytes = b"") -> bytes:
+    """サーバーから送るフレーム(マスクなし，FIN付き)を作る"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < (1 << 16):
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class WebSocket:
+    """
+    ハンドシェイクが終わった接続の上で，メッセージを送受信する
+    rfile, wfile は BaseHTTPRequestHandler のものをそのまま使う
+    send はどのスレッドから呼んでもよい
+    """
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def _read_exact(self, n: int) -> bytes:
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise ConnectionError("websocket closed by peer")
+        return data
+
+    def _read_frame(self):
+        b0, b1 = self._read_exact(2)
+        fin = bool(b0 & 0x80)
+        opcode = b0 & 0x0F
+        length = b1 & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read_exact(8))[0]
+        if length > MAX_MESSAGE_SIZE:
+            raise ConnectionError("websocket message too large")
+        mask = self._read_exact(4) if b1 & 0x80 else None
+        payload = self._read_exact(length)
+        if mask is not None:
+            payload = unmask(payload, mask)
+        return fin, opcode, payload
+
+    def recv(self):
+        """
+        次のメッセージ(テキストなら str，バイナリなら bytes)を返す
+        ping には自動で pong を返す．相手が閉じたら None
+        """
+        message = b""
+        message_opcode = None
+        while True:
+            fin, opcode, payload = self._read_frame()
+            if opcode == OP_CLOSE:
+                self.close()
+                return None
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode != OP_CONTINUATION:
+                message_opcode = opcode
+            message += payload
+            if len(message) > MAX_MESSAGE_SIZE:
+                raise ConnectionError("websocket message too large")
+            if fin:
+                return message.decode("utf-8") if message_opcode == OP_TEXT else message
+
+    def _send_frame(self, opcode: int, payload: bytes = b""):
+        frame = encode_frame(opcode, payload)
+        with self._send_lock:
+            if self.closed and opcode != OP_CLOSE:
+                raise ConnectionError("websocket already closed")
+            self.wfile.write(frame)
+
+    def send(self, message):
+        """テキストメッセージを送る (str または UTF-8 の bytes)"""
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        self._send_frame(OP_TEXT, message)
+
+    def ping(self):
+        self._send_frame(OP_PING)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._send_frame(OP_CLOSE, struct.pack("!H", 1000))
+        except OSError:
+            pass
+        self.closed = True
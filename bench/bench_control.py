@@ -0,0 +1,340 @@
+# コントローラー入力からモーター出力までの処理を，実機なしで測るベンチマークです
+# ノートPCで動かし，Raspberry Pi に書き込む前に遅くなっていないかを確かめます
+#
+# ・fm.py などはインポートするとモーターやカメラを初期化してしまうので，
+#   ast で必要な関数・クラスの定義だけを取り出して実行する
+# ・モーターは gpiozero の MockFactory (ピンのモック) で動かす
+# ・スティックを動かしたときのようなイベント列を作り，1イベントずつ処理時間を測る
+# ・結果(イベント/秒，1イベントの処理時間，メモリの確保)を baseline.json と比べ，遅くなっていたら失敗にする
+#
+# 必要なもの：pip install gpiozero pyPS4Controller (evdev の経路を測るときは evdev も．Linux のみ)
+# 実行：python bench/bench_control.py             # baseline.json と比べる
+#       python bench/bench_control.py --save      # 今の結果を baseline.json に保存する
+
+import argparse
+import ast
+import functools
+import json
+import logging
+import math
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+EVENTS = 20000  # 1つのベンチマークで処理するイベントの数
+WARMUP = 1000  # 測り始める前に処理するイベントの数
+REPEAT = 5  # イベント/秒 を測る回数 (一番速い回を使う)
+SEED = 2025
+TOLERANCE = 0.25  # イベント/秒 が baseline よりこの割合以上下がったら失敗
+ALLOC_TOLERANCE = 1.5  # 1イベントあたりのメモリ確保が baseline のこの倍を超えたら失敗
+
+sys.path.insert(0, str(REPO / 'FM'))  # command_arbiter などの共通モジュール
+
+
+# ----- ベンチマークの対象を読み込む -----
+def load_definitions(path: Path, names: set, namespace: dict) -> dict:
+    """path のトップレベルから，names にある関数・クラス・代入だけを namespace 上で実行する"""
+    tree = ast.parse(path.read_text(encoding='utf-8'), filename=str(path))
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id in names for t in node.targets):
+            body.append(node)
+    found = {getattr(node, 'name', None) or node.targets[0].id for node in body}
+    missing = names - found
+    if missing:
+        raise LookupError(f'{path.relative_to(REPO)}: not found: {", ".join(sorted(missing))}')
+    exec(compile(ast.Module(body=body, type_ignores=[]), str(path), 'exec'), namespace)
+    return namespace
+
+
+def null_logger() -> logging.Logger:
+    """fm.py と同じく DEBUG を出す logger．書き込み先は捨てる (キューに積むところまでは測る)"""
+    import log_setup
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    if not logger.handlers:
+        log_setup.QueuedLogging(logger, logging.NullHandler())
+    return logger
+
+
+def gui_module():
+    """write_to_gui() から使う start_gui の代わり (サーバーは起動せず，共有データだけを持つ)"""
+    from shared_state import SharedState
+    return types.SimpleNamespace(gui_state=SharedState(
+        {'motor_l': 0, 'motor_r': 0, 'light': False, 'buzzer': False},
+        {'motor_l': 0, 'motor_r': 0, 'light': False, 'buzzer': False},
+    ))
+
+
+def control_namespace(path: Path, apply_names: set, tick_rate: float = 0) -> dict:
+    """fm.py 系の apply_motors / write_to_gui / 調停を，モックのモーターで組み立てる"""
+    from gpiozero import Motor
+    import axis_map
+    from command_arbiter import CommandArbiter
+    import input_backend
+    from telemetry_ring import TelemetryRecorder
+
+    ns = {
+        'Motor': Motor,
+        'axis_map': axis_map,
+        'input_backend': input_backend,
+        'functools': functools,
+        'motor_left': Motor(forward=2, backward=3),
+        'motor_right': Motor(forward=17, backward=27),
+        'logger': null_logger(),
+        'start_gui': gui_module(),
+        'start_gui_2': None,
+        'throttle': 0.0,
+        'steer': 0.0,
+        'telemetry': TelemetryRecorder(str(Path(tempfile.mkdtemp()) / 'telemetry.bin'), file_capacity=1 << 16),
+        'audio_play': lambda *args, **kwargs: None,
+        'print': lambda *args, **kwargs: None,
+    }
+    ns['start_gui_2'] = ns['start_gui']
+    load_definitions(path, apply_names, ns)
+    ns['arbiter'] = CommandArbiter(ns['apply_motors'], {'controller': 2, 'gui': 1}, initial={'motor_l': 0.0, 'motor_r': 0.0}, tick_rate=tick_rate)
+    return ns
+
+
+# ----- イベント列 -----
+def stick_values(n: int, rng: random.Random):
+    """スティックをゆっくり回したときのような，なめらかに変わる値 (-32767..32767)"""
+    phase = 0.0
+    for _ in range(n):
+        phase += rng.uniform(0.005, 0.05)
+        yield int(32767 * math.sin(phase) * rng.uniform(0.9, 1.0))
+
+
+def ps4_calls(controller, n: int, rng: random.Random):
+    """pyPS4Controller が呼ぶのと同じ on_L3_* の呼び出し列"""
+    calls = []
+    for i, v in enumerate(stick_values(n, rng)):
+        if i % 2 == 0:
+            handler = controller.on_L3_y_at_rest if v == 0 else (controller.on_L3_up if v < 0 else controller.on_L3_down)
+        else:
+            handler = controller.on_L3_x_at_rest if v == 0 else (controller.on_L3_left if v < 0 else controller.on_L3_right)
+        calls.append((handler, () if v == 0 else (v,)))
+    return calls
+
+
+def js_packets(n: int, rng: random.Random):
+    """/dev/input/js0 から1回の read で読む js_event (左スティックの Y と X を交互に)"""
+    import input_backend
+    packets = []
+    for i, v in enumerate(stick_values(n, rng)):
+        number = 1 if i % 2 == 0 else 0  # left_y / left_x
+        packets.append(input_backend.JS_EVENT.pack(i * 2, max(-32767, v), input_backend.JS_EVENT_AXIS, number))
+    return packets
+
+
+def evdev_events(n: int, rng: random.Random):
+    """evdev の InputEvent の列 (左右のスティックY と SYN_REPORT)"""
+    from evdev import InputEvent, ecodes
+    events = []
+    now = time.time()
+    for i, v in enumerate(stick_values(n, rng)):
+        sec, usec = int(now), int((now % 1) * 1e6)
+        if i % 3 == 2:
+            events.append(InputEvent(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+        else:
+            code = ecodes.ABS_Y if i % 3 == 0 else ecodes.ABS_RY
+            events.append(InputEvent(sec, usec, ecodes.EV_ABS, code, (v + 32768) * 255 // 65535))
+        now += 0.002
+    return events
+
+
+# ----- 測定 -----
+def measure(name: str, calls: list) -> dict:
+    """calls の (関数, 引数) を順に呼び，1回ずつの処理時間とメモリ確保を測る"""
+    for func, args in calls[:WARMUP]:
+        func(*args)
+    calls = calls[WARMUP:]
+
+    # イベント/秒 は，時間を測る処理を挟まずに REPEAT 回まわした中で一番速い回から求める
+    perf = time.perf_counter_ns
+    total = None
+    for _ in range(REPEAT):
+        start = perf()
+        for func, args in calls:
+            func(*args)
+        elapsed = perf() - start
+        total = elapsed if total is None else min(total, elapsed)
+
+    durations = []
+    for func, args in calls:
+        t = perf()
+        func(*args)
+        durations.append(perf() - t)
+
+    # メモリの確保は別の回で測る (tracemalloc を動かすと遅くなるため)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for func, args in calls:
+        func(*args)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    diff = [d for d in after.compare_to(before, 'filename') if 'tracemalloc' not in (d.traceback[0].filename or '')]
+    retained = sum(d.size_diff for d in diff)
+    blocks = sum(d.count_diff for d in diff)
+
+    durations.sort()
+    n = len(durations)
+    return {
+        'name': name,
+        'events': n,
+        'events_per_s': n / (total / 1e9),
+        'p50_us': durations[n // 2] / 1000,
+        'p99_us': durations[min(n - 1, n * 99 // 100)] / 1000,
+        'max_us': durations[-1] / 1000,
+        'alloc_peak_bytes': peak,
+        'retained_bytes_per_event': retained / n,
+        'retained_blocks_per_event': blocks / n,
+    }
+
+
+# ----- ベンチマーク -----
+def bench_scalar(rng):
+    """スティックの値 → 出力の変換表 (axis_map) と clamp を単体で"""
+    import axis_map
+    results = []
+    values = list(stick_values(EVENTS + WARMUP, rng))
+    for path, names in (
+        (REPO / 'FM' / 'fm.py', ('STICK_TABLE', 'clamp')),
+        (REPO / 'motor' / 'Mutsume_motor_2.py', ('STICK_TABLE',)),
+        (REPO / 'EM' / 'fm.py', ('STICK_TABLE',)),
+        (REPO / 'EM' / 'em_evdev.py', ('left_stick_table',)),
+        (REPO / 'motor' / 'Mutsume_motor.py', ('STICK_TABLE',)),
+    ):
+        ns = load_definitions(path, set(names) | ({'STICK_DEADZONE', 'STICK_CURVE'} if path.name == 'em_evdev.py' else set()), {'axis_map': axis_map})
+        for name in names:
+            if name == 'clamp':
+                calls = [(ns[name], (v / 32767 * 1.5, -1.0, 1.0)) for v in values]
+            elif path.name == 'em_evdev.py':  # evdev の値は 0..255
+                calls = [(ns[name].__getitem__, ((v + 32768) * 255 // 65535,)) for v in values]
+            else:
+                calls = [(ns[name].__getitem__, (v,)) for v in values]
+            results.append(measure(f'{path.relative_to(REPO)}:{name}', calls))
+    return results
+
+
+def bench_ps4(rng):
+    """js0 のイベント → input_backend → モーター (motor/ は pyPS4Controller のコールバック → モーター)"""
+    from pyPS4Controller.controller import Controller
+    import axis_map
+    results = []
+
+    # FM/fm.py: js_event → JoystickBackend → 調停 → apply_motors (tick_rate=0 ですぐに反映)
+    # 同じく周期実行のモード (イベントは目標値を更新するだけ)
+    tick_rate = load_definitions(REPO / 'FM' / 'fm.py', {'CONTROL_TICK_HZ'}, {})['CONTROL_TICK_HZ']
+    for mode, rate in (('immediate', 0), ('tick', tick_rate)):
+        ns = control_namespace(REPO / 'FM' / 'fm.py', {'clamp', 'STICK_TABLE', 'apply_motors', 'write_to_gui'}, rate)
+        load_definitions(REPO / 'FM' / 'fm.py', {'emergency_stop', 'controller_input', 'joystick'}, ns)
+        results.append(measure(f'FM/fm.py:JoystickBackend ({mode})', [(ns['joystick'].feed, (packet,)) for packet in js_packets(EVENTS + WARMUP, rng)]))
+
+    # motor/Mutsume_motor_2.py: コールバックから直接モーターへ
+    ns = load_definitions(REPO / 'motor' / 'Mutsume_motor_2.py', {'PIN_AIN1', 'PIN_AIN2', 'PIN_BIN1', 'PIN_BIN2', 'clamp', 'STICK_TABLE'}, {'axis_map': axis_map})
+    from gpiozero import Motor
+    ns.update(Motor=Motor, Controller=Controller, print=lambda *args, **kwargs: None)
+    load_definitions(REPO / 'motor' / 'Mutsume_motor_2.py', {'MyController'}, ns)
+    controller = ns['MyController'](interface='/dev/null', connecting_using_ds4drv=False)
+    results.append(measure('motor/Mutsume_motor_2.py:MyController', ps4_calls(controller, EVENTS + WARMUP, rng)))
+    return results
+
+
+def bench_evdev(rng):
+    """evdev のイベント → EvdevBackend (SYN_REPORT ごとにまとめる) → 調停 → モーター"""
+    from evdev import ecodes
+    ns = control_namespace(REPO / 'EM' / 'em_evdev.py', {'STICK_DEADZONE', 'STICK_CURVE', 'left_stick_table', 'right_stick_table', 'apply_motors', 'write_to_gui'})
+    ns['ecodes'] = ecodes
+    load_definitions(REPO / 'EM' / 'em_evdev.py', {'button_sound', 'controller_input', 'evdev_input'}, ns)
+    events = evdev_events(EVENTS + WARMUP, rng)
+    return [measure('EM/em_evdev.py:EvdevBackend', [(ns['evdev_input'].handle, (event,)) for event in events])]
+
+
+# ----- 結果の表示と baseline との比較 -----
+def calibrate() -> float:
+    """このPCの速さの目安 (決まった計算の 回/秒)．baseline と違うPC・負荷でも比べられるように使う"""
+    def work(x):
+        return max(-1.0, min(1.0, x / 32767.0)) if abs(x) > 100 else 0.0
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter_ns()
+        for x in range(-50000, 50000):
+            work(x)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return 100000 / (best / 1e9)
+
+
+def compare(results: list, baseline: dict, speed: float, tolerance: float) -> list:
+    """baseline より悪くなった項目のメッセージを返す．イベント/秒 は calibrate() の値で割って比べる"""
+    failures = []
+    base_speed = baseline.get('_calibration', {}).get('ops_per_s', speed)
+    for r in results:
+        base = baseline.get(r['name'])
+        if base is None:
+            continue
+        expected = base['events_per_s'] * speed / base_speed
+        if r['events_per_s'] < expected * (1 - tolerance):
+            failures.append(f"{r['name']}: {r['events_per_s']:.0f} events/s < {expected:.0f} expected from baseline")
+        limit = max(base['retained_bytes_per_event'] * ALLOC_TOLERANCE, 1.0)
+        if r['retained_bytes_per_event'] > limit:
+            failures.append(f"{r['name']}: {r['retained_bytes_per_event']:.1f} B/event retained > baseline {base['retained_bytes_per_event']:.1f}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='control path microbenchmarks (no hardware needed)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed drop in events/s (default: %(default)s)')
+    args = parser.parse_args()
+
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory, MockPWMPin
+    Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+
+    speed = calibrate()
+    rng = random.Random(SEED)
+    results = bench_scalar(rng) + bench_ps4(rng)
+    try:
+        results += bench_evdev(rng)
+    except ImportError:
+        print('evdev is not installed: skipping the evdev dispatch benchmark', file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'benchmark':<44}{'events/s':>12}{'p50 us':>9}{'p99 us':>9}{'max us':>10}{'B/event':>9}{'peak kB':>9}")
+        for r in results:
+            print(f"{r['name']:<44}{r['events_per_s']:>12.0f}{r['p50_us']:>9.2f}{r['p99_us']:>9.2f}{r['max_us']:>10.1f}"
+                  f"{r['retained_bytes_per_event']:>9.1f}{r['alloc_peak_bytes'] / 1024:>9.1f}")
+
+    if args.save:
+        baseline = {'_calibration': {'ops_per_s': speed}}
+        baseline.update((r['name'], r) for r in results)
+        BASELINE.write_text(json.dumps(baseline, indent=2) + '\n', encoding='utf-8')
+        print(f'baseline saved: {BASELINE.relative_to(REPO)}')
+        return 0
+    if not BASELINE.exists():
+        print('no baseline yet (run with --save to create one)')
+        return 0
+    failures = compare(results, json.loads(BASELINE.read_text(encoding='utf-8')), speed, args.tolerance)
+    for failure in failures:
+        print('REGRESSION', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,366 @@
+# GUI用のサーバーに，たくさんのブラウザ(スマホ)がつながったときの負荷を再現するベンチマークです
+# オープンキャンパスなどでは20台以上のスマホが同時につながるので，どこでサーバーが耐えられなくなるかを調べます
+#
+# ・サーバーは別のプロセスで start_gui.start_server() を起動する (クライアントと GIL を取り合わないように)
+#   カメラの代わりに，ダミーのJPEGを CAMERA_FPS で camera_output に書き込む
+# ・1台のブラウザは index.html と同じ通信をする
+#   poll: 1秒ごとに POST /，GET /data_to_browser.json，GET /camera.jpg (WebSocket やストリームが使えないとき)
+#         GET は index.html と同じく If-None-Match で再検証し，304 の数も数える
+#   live: WebSocket で 20ms ごとに操作を送り，stream.mjpg で映像を受信する (ふだんの通信)
+# ・ブラウザの台数を --clients の順に増やし，段階ごとにスループット・遅れ(p50/p95/p99/max)・エラー率を表示する
+#
+# 実行：python bench/bench_gui_load.py --clients 1,5,10,20,40 --duration 10
+#       python bench/bench_gui_load.py --pattern live --dir EM --server start_gui_2
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+PORT = 8765
+CAMERA_FPS = 30
+FRAME_SIZE = 40 * 1024  # [byte] ダミーのJPEGの大きさ (640x480 の画像くらい)
+REQUEST_TIMEOUT = 5.0  # [s] これより遅い応答はエラーとして数える
+WS_INTERVAL = 0.02  # [s] index.html の pushData() の間隔
+FALL_OVER_ERROR_RATE = 0.01  # エラー率がこれを超えたら「耐えられない」とみなす
+FALL_OVER_P99 = 1.0  # [s] p99 の遅れがこれを超えたら「耐えられない」とみなす
+
+
+# ----- サーバー側 (--serve で起動される) -----
+def serve(directory: str, server_module: str, port: int, workers: int):
+    os.chdir(REPO / directory)
+    sys.path.insert(0, str(REPO / directory))
+    start_gui = __import__(server_module)
+    start_gui.PORT = port
+
+    def feed_camera():
+        # 本物のエンコーダーのように，毎回新しいバイト列を書き込む
+        body = os.urandom(FRAME_SIZE - 4)
+        while True:
+            start_gui.camera_output.write(b'\xff\xd8' + body + b'\xff\xd9')
+            time.sleep(1 / CAMERA_FPS)
+
+    threading.Thread(target=feed_camera, daemon=True).start()
+    kwargs = {'max_workers': workers} if workers else {}
+    start_gui.start_server(**kwargs)
+
+
+# ----- 結果の集計 -----
+class Recorder:
+    """リクエストの種類ごとに，遅れとエラーを数える"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.not_modified = {}
+        self.bytes = 0
+
+    def ok(self, kind: str, seconds: float, size: int = 0):
+        with self._lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            self.bytes += size
+
+    def ok_not_modified(self, kind: str, seconds: float):
+        with self._lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            self.not_modified[kind] = self.not_modified.get(kind, 0) + 1
+
+    def error(self, kind: str, reason: str):
+        with self._lock:
+            self.errors.setdefault(kind, {})
+            self.errors[kind][reason] = self.errors[kind].get(reason, 0) + 1
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+# ----- 1台のブラウザ (poll) -----
+def timed_request(conn_holder: list, recorder: Recorder, kind: str, method: str, path: str, body: bytes = None, etag_holder: list = None):
+    """
+    keep-alive の接続で1回リクエストする．接続が切れていたらつなぎ直す
+    etag_holder を渡すと，前回の ETag を If-None-Match に付けて再検証する (fetch の cache: "no-cache" と同じ)
+    """
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    if etag_holder is not None and etag_holder[0] is not None:
+        headers['If-None-Match'] = etag_holder[0]
+    start = time.perf_counter()
+    try:
+        if conn_holder[0] is None:
+            conn_holder[0] = http.client.HTTPConnection('127.0.0.1', PORT, timeout=REQUEST_TIMEOUT)
+        conn = conn_holder[0]
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+            conn_holder[0] = None
+        if response.status >= 400:
+            recorder.error(kind, f'HTTP {response.status}')
+            return
+        if response.status == 304:
+            recorder.ok_not_modified(kind, time.perf_counter() - start)
+            return
+        if etag_holder is not None:
+            etag_holder[0] = response.getheader('ETag')
+        recorder.ok(kind, time.perf_counter() - start, len(data))
+    except (OSError, http.client.HTTPException) as e:
+        recorder.error(kind, type(e).__name__)
+        if conn_holder[0] is not None:
+            conn_holder[0].close()
+        conn_holder[0] = None
+
+
+def poll_loop(stop: threading.Event, recorder: Recorder, kind: str, method: str, path: str, make_body=None):
+    """index.html の setInterval(..., 1000) と同じく，1秒ごとにリクエストする"""
+    conn_holder = [None]
+    etag_holder = [None] if method == 'GET' else None
+    next_time = time.monotonic() + random.uniform(0, 1)  # ブラウザごとに開いた時刻がばらばら
+    while not stop.is_set():
+        stop.wait(max(0.0, next_time - time.monotonic()))
+        if stop.is_set():
+            break
+        next_time += 1.0
+        timed_request(conn_holder, recorder, kind, method, path, make_body() if make_body else None, etag_holder)
+    if conn_holder[0] is not None:
+        conn_holder[0].close()
+
+
+def poll_browser(stop: threading.Event, recorder: Recorder) -> list:
+    conn_holder = [None]
+    timed_request(conn_holder, recorder, 'index.html', 'GET', '/index.html')
+    if conn_holder[0] is not None:
+        conn_holder[0].close()
+
+    def state():
+        return json.dumps({'motor_l': round(random.uniform(-1, 1), 3), 'motor_r': round(random.uniform(-1, 1), 3), 'light': False, 'buzzer': False}).encode()
+    return [
+        threading.Thread(target=poll_loop, args=(stop, recorder, 'POST /', 'POST', '/', state), daemon=True),
+        threading.Thread(target=poll_loop, args=(stop, recorder, 'data_to_browser.json', 'GET', '/data_to_browser.json'), daemon=True),
+        threading.Thread(target=poll_loop, args=(stop, recorder, 'camera.jpg', 'GET', '/camera.jpg'), daemon=True),
+    ]
+
+
+# ----- 1台のブラウザ (live) -----
+def ws_connect() -> socket.socket:
+    sock = socket.create_connection(('127.0.0.1', PORT), timeout=REQUEST_TIMEOUT)
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall((f'GET /ws HTTP/1.1\r\nHost: 127.0.0.1:{PORT}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+    response = b''
+    while b'\r\n\r\n' not in response:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('closed during handshake')
+        response += chunk
+    if not response.startswith(b'HTTP/1.1 101'):
+        raise ConnectionError(response.split(b'\r\n', 1)[0].decode(errors='replace'))
+    return sock
+
+
+def ws_frame(text: str) -> bytes:
+    """ブラウザから送るテキストフレーム (マスク付き)"""
+    payload = text.encode()
+    mask = os.urandom(4)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    length = len(payload)
+    header = struct.pack('!BB', 0x81, 0x80 | length) if length < 126 else struct.pack('!BBH', 0x81, 0x80 | 126, length)
+    return header + mask + masked
+
+
+def ws_loop(stop: threading.Event, recorder: Recorder):
+    """20ms ごとに操作を送り，送信にかかった時間を測る．サーバーからのメッセージは読み捨てる"""
+    try:
+        start = time.perf_counter()
+        sock = ws_connect()
+        recorder.ok('ws connect', time.perf_counter() - start)
+    except (OSError, ConnectionError) as e:
+        recorder.error('ws connect', type(e).__name__)
+        return
+    sock.setblocking(False)
+    next_time = time.monotonic()
+    try:
+        while not stop.is_set():
+            stop.wait(max(0.0, next_time - time.monotonic()))
+            next_time += WS_INTERVAL
+            message = json.dumps({'motor_l': round(random.uniform(-1, 1), 3), 'motor_r': round(random.uniform(-1, 1), 3), 'light': False, 'buzzer': False})
+            start = time.perf_counter()
+            sock.setblocking(True)
+            sock.sendall(ws_frame(message))
+            sock.setblocking(False)
+            recorder.ok('ws send', time.perf_counter() - start)
+            try:
+                while sock.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+    except OSError as e:
+        recorder.error('ws send', type(e).__name__)
+    finally:
+        sock.close()
+
+
+def stream_loop(stop: threading.Event, recorder: Recorder):
+    """stream.mjpg を受信し，フレームの間隔を測る"""
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=REQUEST_TIMEOUT)
+        conn.request('GET', '/stream.mjpg')
+        response = conn.getresponse()
+        if response.status != 200:
+            recorder.error('stream frame', f'HTTP {response.status}')
+            conn.close()
+            return
+        last = time.perf_counter()
+        while not stop.is_set():
+            line = response.fp.readline()
+            if not line:
+                raise ConnectionError('stream ended')
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':', 1)[1])
+                response.fp.readline()
+                data = response.fp.read(length)
+                now = time.perf_counter()
+                recorder.ok('stream frame', now - last, len(data))
+                last = now
+        conn.close()
+    except (OSError, ConnectionError, http.client.HTTPException) as e:
+        recorder.error('stream frame', type(e).__name__)
+
+
+def live_browser(stop: threading.Event, recorder: Recorder) -> list:
+    conn_holder = [None]
+    timed_request(conn_holder, recorder, 'index.html', 'GET', '/index.html')
+    if conn_holder[0] is not None:
+        conn_holder[0].close()
+    return [
+        threading.Thread(target=ws_loop, args=(stop, recorder), daemon=True),
+        threading.Thread(target=stream_loop, args=(stop, recorder), daemon=True),
+    ]
+
+
+# ----- 段階ごとの実行 -----
+def run_stage(clients: int, duration: float, pattern: str) -> dict:
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = []
+    browser = poll_browser if pattern == 'poll' else live_browser
+    for _ in range(clients):
+        for t in browser(stop, recorder):
+            t.start()
+            threads.append(t)
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join(REQUEST_TIMEOUT + 1)
+
+    kinds = {}
+    total_ok = total_err = 0
+    for kind in sorted(set(recorder.latencies) | set(recorder.errors)):
+        values = sorted(recorder.latencies.get(kind, []))
+        errors = sum(recorder.errors.get(kind, {}).values())
+        total_ok += len(values)
+        total_err += errors
+        kinds[kind] = {
+            'ok': len(values),
+            'not_modified': recorder.not_modified.get(kind, 0),
+            'errors': recorder.errors.get(kind, {}),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': (values[-1] if values else 0.0) * 1000,
+        }
+    total = total_ok + total_err
+    return {
+        'clients': clients,
+        'requests_per_s': total_ok / duration,
+        'mbytes_per_s': recorder.bytes / duration / 1e6,
+        'error_rate': total_err / total if total else 0.0,
+        'kinds': kinds,
+    }
+
+
+def fell_over(stage: dict, pattern: str) -> bool:
+    if stage['error_rate'] > FALL_OVER_ERROR_RATE:
+        return True
+    # live の stream frame の値はフレームの間隔なので，遅れの判定には使わない
+    checked = [k for k in stage['kinds'] if not (pattern == 'live' and k == 'stream frame')]
+    return any(stage['kinds'][k]['p99_ms'] > FALL_OVER_P99 * 1000 for k in checked)
+
+
+def print_stage(stage: dict):
+    print(f"\n== {stage['clients']} clients: {stage['requests_per_s']:.1f} ok/s, {stage['mbytes_per_s']:.2f} MB/s, error rate {stage['error_rate'] * 100:.2f}%")
+    print(f"   {'request':<22}{'ok':>8}{'304':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  errors")
+    for kind, k in stage['kinds'].items():
+        errors = ', '.join(f'{reason}: {n}' for reason, n in k['errors'].items()) or '-'
+        print(f"   {kind:<22}{k['ok']:>8}{k['not_modified']:>7}{k['p50_ms']:>10.1f}{k['p95_ms']:>10.1f}{k['p99_ms']:>10.1f}{k['max_ms']:>10.1f}  {errors}")
+
+
+def wait_for_server(process: subprocess.Popen):
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('the GUI server exited during startup')
+        try:
+            socket.create_connection(('127.0.0.1', PORT), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('the GUI server did not start')
+
+
+def main():
+    global PORT
+    parser = argparse.ArgumentParser(description='load test for the GUI server (simulates N browsers running index.html)')
+    parser.add_argument('--clients', default='1,5,10,20,30,40', help='comma separated client counts (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per stage (default: %(default)s)')
+    parser.add_argument('--pattern', choices=('poll', 'live'), default='poll', help='poll: 1 s POST/GET fallback, live: WebSocket + MJPEG')
+    parser.add_argument('--dir', default='FM', choices=('FM', 'EM'), help='directory of the server and index.html')
+    parser.add_argument('--server', default='start_gui', choices=('start_gui', 'start_gui_2'))
+    parser.add_argument('--workers', type=int, default=0, help='max_workers for start_server (default: the module default)')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    PORT = args.port
+
+    if args.serve:
+        serve(args.dir, args.server, args.port, args.workers)
+        return 0
+
+    command = [sys.executable, __file__, '--serve', '--dir', args.dir, '--server', args.server, '--port', str(args.port), '--workers', str(args.workers)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_for_server(server)
+        for clients in (int(c) for c in args.clients.split(',')):
+            stage = run_stage(clients, args.duration, args.pattern)
+            results.append(stage)
+            if not args.json:
+                print_stage(stage)
+                if fell_over(stage, args.pattern):
+                    print(f'   -> the server falls over at {clients} clients '
+                          f'(error rate > {FALL_OVER_ERROR_RATE * 100:.0f}% or p99 > {FALL_OVER_P99:.1f} s)')
+    finally:
+        server.terminate()
+        server.wait()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,9 @@ from gpiozero import Motor
 from gpiozero.pins.pigpio import PiGPIOFactory
 import subprocess
 
+import axis_map
+from slew import SlewRateLimiter, BRAKE_RATE
+
 
 # 機体ごとに違ったらマズい
 PIN_AIN1 = 4
@@ -32,91 +35,40 @@ def motor_setup(AIN1, AIN2, BIN1, BIN2):
     return right, left
 
 
-def brake(right, left):
-    power_r = float(right.value)
-    power_l = float(left.value)
-    delta_power = 0.15
-
-    for i in range(int(1 / delta_power)):
-        if 0<=power_r<=1 and 0<=power_l<=1:
-            right.value = power_r
-            left.value = power_l
-        if power_r > 0:
-            power_r -= delta_power
-        elif power_r < 0:
-            power_r += delta_power
-        else:
-            pass
-        if power_l > 0:
-            power_l -= delta_power
-        elif power_l < 0:
-            power_l += delta_power
-        else:
-            pass
-
-
-def transf(raw):
-    temp = (raw + 32767) / 65534 / 2
-    # Filter values that are too weak for the motors to move
-    if abs(temp) < 0.9:
-        return 0
-    # Return a value between 0.3 and 1.0
-    else:
-        return round(temp, 1)
-    
+# スティックの値(-32768~32767)から -1~1 への変換表 (axis_map.py を参照)
+# これまでの transf() は 0~0.5 の値を 0.9 と比べていたので，いつも 0 を返していた
+STICK_TABLE = axis_map.ps4_table(deadzone=0.15, resolution=0.1)
+
 
 class MyController(Controller):
 
     def __init__(self, **kwargs):
         Controller.__init__(self, **kwargs)
         self.motor_right, self.motor_left = motor_setup(PIN_AIN1, PIN_AIN2, PIN_BIN1, PIN_BIN2)
-        brake(self.motor_right, self.motor_left)
+        # 出力はバックグラウンドのスレッドが目標値へ少しずつ近づける (slew.py を参照)
+        # コールバックは目標値を書き換えるだけなので，イベントの受け取りが止まらない
+        self.slew = SlewRateLimiter({"right": self.motor_right, "left": self.motor_left})
+        self.slew.stop()
 
     # 左スティックの入力値を反映
     def on_R2_press(self, value):
-        value = -transf(value)
-        parmission_power = 0.25
-        delta_power = 0.15
-
-        while (value >= self.motor_right.value + parmission_power) or (value <= self.motor_right.value - parmission_power):
-            if -1.0 <= self.motor_right.value + value <= 1.0:
-                if value > self.motor_right.value:
-                    self.motor_right.value + delta_power
-                elif value < self.motor_left.value:
-                    self.motor_right.value - delta_power
-            else:
-                print("over motor value 1 or -1")
-                break
-
-        self.motor_right.value = value
+        value = -STICK_TABLE[value]
+        self.slew.set_target("right", value)
         print(f"R3 {value}")
     
     def on_R2_release(self):
-        brake(self.motor_right, self.motor_left)
+        self.slew.stop()
         print("R3 FREE, brake")
     
     def on_L3_press(self, value):
         # Lスティックの入力なんだっけ？
-        # 'value' becomes 0 or a float between -1.0 and -0.3
-        value = -transf(value)
-        parmission_power = 0.25
-        delta_power = 0.15
-
-        while (value >= self.motor_left.value + parmission_power) or (value <= self.motor_left.value - parmission_power):
-            if -1.0 <= self.motor_left.value + value <= 1.0:
-                if value > self.motor_left.value:
-                    self.motor_left.value + delta_power
-                elif value < self.motor_left.value:
-                    self.motor_left.value - delta_power
-            else:
-                print("over motor value 1 or -1")
-                break
-
-        self.motor_left.value = value
+        # 'value' becomes a float between -1.0 and 1.0 (0 inside the deadzone)
+        value = -STICK_TABLE[value]
+        self.slew.set_target("left", value)
         print(f"R3 {value}")
     
     def on_L3_release(self):
-        self.motor_left.value = 0
+        self.slew.set_target("left", 0.0, BRAKE_RATE)
         print("L3 FREE, brake")
 
     def on_triangle_press(self):
@@ -1,6 +1,8 @@
 from pyPS4Controller.controller import Controller
 from gpiozero import Motor
 
+import axis_map
+
 
 # モータのピン（あなたの機体に合わせた値）
 PIN_AIN1 = 4
@@ -13,19 +15,10 @@ def clamp(x: float, lo: float, hi: float) -> float:
     return max(lo, min(hi, x))
 
 
-def scale_axis(v: int) -> float:
-    """
-    L3_* の value（スティックの倒し量）を 0.0〜1.0 に正規化。
-    上/下・左/右の向きはコールバック名で分かれているので、
-    ここでは「絶対値＝どれくらい倒したか」だけを見る。
-    """
-    v = abs(v)              # ← ここがポイント（マイナスも正にして使う）
-    # 値のレンジは 0〜32767 相当を想定
-    val = v / 32767.0
-    # デッドゾーン：これ以下は 0 扱い（微妙な揺れ無視）
-    if val < 0.15:
-        return 0.0
-    return clamp(val, 0.0, 1.0)
+# L3_* の value（スティックの倒し量，-32768〜32767）を -1.0〜1.0 に変換する表（axis_map.py を参照）。
+# 起動時に一度だけ作るので、コールバックでは表を引くだけ。上/左が負。
+# デッドゾーン：これ以下は 0 扱い（微妙な揺れ無視）
+STICK_TABLE = axis_map.ps4_table(deadzone=0.15)
 
 
 class MyController(Controller):
@@ -45,14 +38,12 @@ class MyController(Controller):
     # ===== 左スティック Y方向 =====
     def on_L3_up(self, value):
         # 上 = 前進（正）
-        p = scale_axis(value)
-        self.throttle = p
+        self.throttle = -STICK_TABLE[value]
         self.update_motors()
 
     def on_L3_down(self, value):
         # 下 = 後退（負）
-        p = scale_axis(value)
-        self.throttle = -p
+        self.throttle = -STICK_TABLE[value]
         self.update_motors()
 
     def on_L3_y_at_rest(self):
@@ -63,14 +54,12 @@ class MyController(Controller):
     # ===== 左スティック X方向 =====
     def on_L3_right(self, value):
         # 右 = 右旋回（正）
-        p = scale_axis(value)
-        self.steer = p
+        self.steer = STICK_TABLE[value]
         self.update_motors()
 
     def on_L3_left(self, value):
         # 左 = 左旋回（負）
-        p = scale_axis(value)
-        self.steer = -p
+        self.steer = STICK_TABLE[value]
         self.update_motors()
 
     def on_L3_x_at_rest(self):
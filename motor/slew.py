@@ -0,0 +1,94 @@
+# モーターの出力を，目標値へ一定の速さで近づけるモジュールです (急発進・急停止でギアや電源に負担をかけないように)
+# これまでの brake() や on_R2_press() は，sleep なしのループで出力を変えようとしていて，
+# CPU を1コア使い切ったうえに，コントローラーのイベントを受け取るスレッドが止まっていました
+#
+# ・set_target() は目標値を書き換えるだけで，すぐに戻る
+# ・バックグラウンドのスレッドが TICK_RATE 回/秒，経過時間 × rate だけ出力を目標値へ近づける
+# ・全部の出力が目標値に着いたら，次の set_target() まで眠る (止まっているときは CPU を使わない)
+#
+# 例：slew = SlewRateLimiter({'right': motor_right, 'left': motor_left})
+#     slew.set_target('right', 0.8)
+#     slew.stop()  # 全部 0 へ (BRAKE_RATE で)
+
+import threading
+import time
+
+RATE = 2.0  # [/s] 1秒あたりに変える出力の大きさ (0 → 1 に 0.5 秒)
+BRAKE_RATE = 4.0  # [/s] stop() のときの速さ
+TICK_RATE = 100  # [回/s] 出力を書き込む回数
+
+
+class SlewRateLimiter:
+    """
+    outputs は 名前 → value 属性を持つもの (gpiozero の Motor など)
+    set_target() / stop() はどのスレッドから呼んでもよい．出力に書き込むのはバックグラウンドのスレッドだけ
+    """
+
+    def __init__(self, outputs: dict, *, rate: float = RATE, tick_rate: float = TICK_RATE):
+        self.outputs = outputs
+        self.rate = rate
+        self.interval = 1 / tick_rate
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._values = {name: float(output.value or 0.0) for name, output in outputs.items()}
+        self._targets = dict(self._values)
+        self._rates = {name: rate for name in outputs}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set_target(self, name: str, value: float, rate: float = None):
+        """name の出力の目標値を value (-1~1) にする．rate を省略すると self.rate"""
+        with self._lock:
+            self._targets[name] = max(-1.0, min(1.0, float(value)))
+            self._rates[name] = rate or self.rate
+        self._wake.set()
+
+    def stop(self, rate: float = BRAKE_RATE):
+        """全部の出力を 0 へ近づける"""
+        for name in self.outputs:
+            self.set_target(name, 0.0, rate)
+
+    def value(self, name: str) -> float:
+        """いま出力している値"""
+        with self._lock:
+            return self._values[name]
+
+    def settled(self) -> bool:
+        """全部の出力が目標値に着いていれば True"""
+        with self._lock:
+            return self._values == self._targets
+
+    def _step(self, elapsed: float) -> dict:
+        """elapsed 秒ぶん目標値へ近づけ，変わった出力を返す"""
+        changed = {}
+        with self._lock:
+            for name, target in self._targets.items():
+                value = self._values[name]
+                if value == target:
+                    continue
+                delta = self._rates[name] * elapsed
+                value = min(target, value + delta) if target > value else max(target, value - delta)
+                self._values[name] = value
+                changed[name] = value
+        return changed
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._closed:
+            if self.settled():
+                # 目標値に着いていれば，次の set_target() まで眠る
+                self._wake.wait()
+                self._wake.clear()
+                last = time.monotonic()
+                continue
+            time.sleep(self.interval)
+            now = time.monotonic()
+            for name, value in self._step(now - last).items():
+                self.outputs[name].value = value
+            last = now
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout=1.0)